@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+'''Benchmark the transports of Filter_external.
+
+Passes messages through a chain of three Filter_external filters running
+/bin/cat, once per transport (the "transport" filter parameter), with the
+transports interleaved so that they see the same system load.
+
+usage: bench_filters.py [message size in bytes] [transport ...]
+'''
+
+import sys
+import time
+
+import localservers
+from getmailcore import logging
+from getmailcore import filters
+from getmailcore.message import Message
+
+MESSAGES = 200
+CHAIN = 3
+
+#######################################
+class Retriever(object):
+    received_from = received_with = received_by = None
+
+#######################################
+def main():
+    log = logging.Logger()
+    log.clearhandlers()
+    log.addhandler(sys.stderr, logging.WARNING)
+    args = sys.argv[1:]
+    size = 2000
+    if args:
+        size = int(args.pop(0))
+    transports = args or ['file', 'pipe', 'memfd']
+    chains = {}
+    for transport in transports:
+        chains[transport] = [
+            filters.Filter_external(path='/bin/cat', transport=transport,
+                                    allow_root_commands=True)
+            for i in range(CHAIN)
+        ]
+    original = Message(fromstring=localservers.make_message(1, size))
+    original.sender = 'sender@example.org'
+    elapsed = dict([(transport, 0.0) for transport in transports])
+    for i in range(MESSAGES):
+        for transport in transports:
+            t = time.time()
+            msg = original
+            for f in chains[transport]:
+                msg = f.filter_message(msg, Retriever())
+            elapsed[transport] += time.time() - t
+    for transport in transports:
+        print '%-6s %8d bytes: %6.0f msgs/s through %d filters' % (
+            transport, size, MESSAGES / elapsed[transport], CHAIN
+        )
+
+#######################################
+if __name__ == '__main__':
+    main()
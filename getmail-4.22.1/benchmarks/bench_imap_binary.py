@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+'''Benchmark the bytes an IMAP server sends with use_binary and
+fetch_content_types.
+
+Runs getmail against a local stand-in IMAP server offering BINARY, which
+holds messages with a 200 KB JPEG and a 1 MB PDF attachment (base64), once
+per retriever configuration.  Prints the bytes the server sent and the time
+taken, and checks that every delivered JPEG attachment decodes to the
+original.  The times include the stand-in server's own MIME parsing, which
+it repeats for every part requested, so only the byte counts are telling.
+
+usage: bench_imap_binary.py [number of messages]
+'''
+
+import os
+import sys
+import time
+import base64
+import shutil
+import mailbox
+import tempfile
+
+import localservers
+
+GETMAIL = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       os.pardir, 'getmail')
+
+CONFIGURATIONS = (
+    ('full RFC822 fetch', ''),
+    ('use_binary', 'use_binary = true'),
+    ("fetch_content_types=('image/jpeg',)",
+     "fetch_content_types = ('image/jpeg',)"),
+    ('both', "use_binary = true\nfetch_content_types = ('image/jpeg',)"),
+)
+
+#######################################
+def make_message(i):
+    '''Return a message with text, HTML, JPEG and PDF parts, and the JPEG
+    data.'''
+    jpeg = os.urandom(200000)
+    pdf = os.urandom(1000000)
+    return (localservers.crlf(
+        'From: sender@example.org\n'
+        'To: recipient@example.org\n'
+        'Subject: photo %d\n'
+        'MIME-Version: 1.0\n'
+        'Content-Type: multipart/mixed; boundary="outer"\n'
+        '\n'
+        '--outer\n'
+        'Content-Type: multipart/alternative; boundary="alt"\n'
+        '\n'
+        '--alt\n'
+        'Content-Type: text/plain; charset=us-ascii\n'
+        '\n'
+        'plain text %d\n'
+        '--alt\n'
+        'Content-Type: text/html; charset=us-ascii\n'
+        '\n'
+        '<p>html %d</p>\n'
+        '--alt--\n'
+        '\n'
+        '--outer\n'
+        'Content-Type: image/jpeg; name="photo.jpg"\n'
+        'Content-Transfer-Encoding: base64\n'
+        '\n'
+        '%s'
+        '--outer\n'
+        'Content-Type: application/pdf; name="document.pdf"\n'
+        'Content-Transfer-Encoding: base64\n'
+        '\n'
+        '%s'
+        '--outer--\n'
+        % (i, i, i, base64.encodestring(jpeg), base64.encodestring(pdf))
+    ), jpeg)
+
+#######################################
+def run(server, options):
+    '''Run getmail once with the retriever options given; return the
+    messages delivered to an mbox.'''
+    getmaildir = tempfile.mkdtemp(prefix='getmail-bench-')
+    try:
+        mbox = os.path.join(getmaildir, 'mbox')
+        open(mbox, 'w').close()
+        destination = ''
+        if os.geteuid() == 0:
+            # getmail won't deliver as root
+            destination = 'user = nobody\n'
+            os.chmod(getmaildir, 0777)
+            os.chmod(mbox, 0666)
+        open(os.path.join(getmaildir, 'getmailrc'), 'w').write(
+            '[retriever]\ntype = SimpleIMAPRetriever\nserver = 127.0.0.1\n'
+            'port = %d\nusername = user\npassword = password\n%s\n'
+            '[destination]\ntype = Mboxrd\npath = %s\n%s'
+            '[options]\nread_all = true\nverbose = 0\n'
+            % (server.port, options, mbox, destination)
+        )
+        server.sent = 0
+        t = time.time()
+        rc = os.system('%s %s --getmaildir %s'
+                       % (sys.executable, GETMAIL, getmaildir))
+        elapsed = time.time() - t
+        if rc:
+            raise SystemExit('getmail failed with %s' % options)
+        return ([msg for msg in mailbox.mbox(mbox)], elapsed)
+    finally:
+        shutil.rmtree(getmaildir, True)
+
+#######################################
+def main():
+    count = 10
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    msgs = [make_message(i) for i in range(count)]
+    server = localservers.IMAPServer([data for (data, jpeg) in msgs],
+                                     caps=('IMAP4rev1', 'BINARY'))
+    for (name, options) in CONFIGURATIONS:
+        (delivered, elapsed) = run(server, options)
+        if len(delivered) != count:
+            raise SystemExit('%s: %d of %d messages delivered'
+                             % (name, len(delivered), count))
+        for msg in delivered:
+            i = int(msg['subject'].split()[1])
+            jpegs = [part.get_payload(decode=True) for part in msg.walk()
+                     if part.get_content_type() == 'image/jpeg']
+            if jpegs != [msgs[i][1]]:
+                raise SystemExit('%s: JPEG of message %d differs' % (name, i))
+        print '%-40s %6.2f MB sent %6.2f s' % (name, server.sent / 1e6,
+                                               elapsed)
+
+#######################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+'''Benchmark creating and flattening a large Message.
+
+Each round builds a Message from a multipart message with several base64
+"photo" attachments (CRLF line endings, as retrieved over IMAP), reads a
+header, adds one as a classifier filter would, and flattens it for
+delivery.  Peak memory is printed where /proc provides it.
+
+usage: bench_message.py [number of attachments] [attachment size in MB]
+'''
+
+import os
+import sys
+import time
+import base64
+
+import localservers
+from getmailcore import logging
+from getmailcore.message import Message
+
+ROUNDS = 10
+
+#######################################
+def make_mime(attachments, size):
+    parts = [
+        'Return-Path: <sender@example.org>\r\n'
+        'From: Sender <sender@example.org>\r\n'
+        'To: recipient@example.org\r\n'
+        'Subject: photos\r\n'
+        'MIME-Version: 1.0\r\n'
+        'Content-Type: multipart/mixed; boundary="BND"\r\n'
+        '\r\n'
+        'Preamble\r\n'
+        '--BND\r\n'
+        'Content-Type: text/plain\r\n'
+        '\r\n'
+        'Hello\r\n'
+        'From here\r\n'
+    ]
+    for i in range(attachments):
+        data = os.urandom(size)
+        parts.append('--BND\r\nContent-Type: image/jpeg\r\n'
+                     'Content-Transfer-Encoding: base64\r\n\r\n'
+                     + localservers.crlf(base64.encodestring(data)))
+    parts.append('--BND--\r\n')
+    return ''.join(parts)
+
+#######################################
+def peak_memory():
+    '''Return the peak resident set size in MB, or None.'''
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+#######################################
+def main():
+    log = logging.Logger()
+    log.clearhandlers()
+    log.addhandler(sys.stderr, logging.WARNING)
+    attachments = 4
+    size = 1.5
+    if len(sys.argv) > 1:
+        attachments = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        size = float(sys.argv[2])
+    data = make_mime(attachments, int(size * 1000000))
+    before = peak_memory()
+    t = time.time()
+    for i in range(ROUNDS):
+        msg = Message(fromstring=data)
+        msg.sender
+        msg.get_all('subject')
+        msg.add_header('X-getmail-filter-classifier', 'clean')
+        out = msg.flatten(True, True)
+        del msg, out
+    elapsed = (time.time() - t) / ROUNDS
+    print 'parse+flatten %.1f MB: %.1f ms/msg, %.1f MB/s' % (
+        len(data) / 1e6, elapsed * 1000, len(data) / 1e6 / elapsed
+    )
+    after = peak_memory()
+    if after is not None:
+        print 'peak RSS %.1f MB before, %.1f MB after (message %.1f MB)' % (
+            before, after, len(data) / 1048576.0
+        )
+
+#######################################
+if __name__ == '__main__':
+    main()
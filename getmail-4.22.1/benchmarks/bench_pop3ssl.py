@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+'''Benchmark RETR of a large message over POP3-SSL.
+
+Compares Python's poplib.POP3_SSL with getmail's POP3SSL class at several
+values of its read size (the ssl_read_size retriever parameter).  128 bytes
+was the read size getmail used before it was made configurable.  The server
+is a local stand-in, so the figures measure client-side overhead only.
+
+usage: bench_pop3ssl.py [message size in MB] [read size ...]
+'''
+
+import os
+import sys
+import time
+import base64
+import poplib
+
+import localservers
+from getmailcore import logging
+from getmailcore._pop3ssl import POP3SSL
+
+ROUNDS = 3
+
+#######################################
+def best_time(server, cls, **kwargs):
+    '''Return the fastest of ROUNDS retrievals of message 1.'''
+    best = None
+    for i in range(ROUNDS):
+        conn = cls('127.0.0.1', server.port, **kwargs)
+        t = time.time()
+        conn.retr(1)
+        elapsed = time.time() - t
+        conn.quit()
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+#######################################
+def main():
+    log = logging.Logger()
+    log.clearhandlers()
+    log.addhandler(sys.stderr, logging.WARNING)
+    args = sys.argv[1:]
+    size = 5
+    if args:
+        size = float(args.pop(0))
+    readsizes = [int(arg) for arg in args] or [128, 4096, 16384, 65536]
+    # A "photo" attachment: base64 lines of 76 characters
+    body = base64.encodestring(os.urandom(int(size * 750000)))
+    msg = localservers.make_message(0, 10) + localservers.crlf(body)
+    server = localservers.POP3Server([msg], ssl=True)
+    print 'message of %d bytes, best of %d' % (len(msg), ROUNDS)
+    runs = [('poplib.POP3_SSL', poplib.POP3_SSL, {})]
+    for readsize in readsizes:
+        runs.append(('POP3SSL, %d byte reads' % readsize, POP3SSL,
+                     {'readsize' : readsize}))
+    for (name, cls, kwargs) in runs:
+        elapsed = best_time(server, cls, **kwargs)
+        print '%-30s %7.3f s %7.1f MB/s' % (name, elapsed,
+                                           len(msg) / elapsed / 1e6)
+
+#######################################
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+'''Minimal local stand-in mail servers for the getmail benchmarks.
+
+These implement just enough of each protocol for getmail (and poplib) to
+retrieve messages from them over the loopback interface.  They do no
+authentication and keep their mailboxes in memory.  They are not a test of
+protocol conformance.
+'''
+
+import os
+import re
+import sys
+import email
+import socket
+import shutil
+import atexit
+import tempfile
+import threading
+
+# Benchmarks import getmailcore from the tree they are in
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+#######################################
+def crlf(s):
+    '''Return s with CRLF line endings.'''
+    return s.replace('\r\n', '\n').replace('\n', '\r\n')
+
+#######################################
+def make_message(i, size=100, sender='sender@example.org'):
+    '''Return a simple text message of about size bytes, with CRLF EOL.'''
+    body = ('line %d ' % i) * (size // 8 + 1)
+    return crlf(
+        'Return-Path: <%s>\nFrom: %s\nTo: recipient@example.org\n'
+        'Subject: message %d\nMessage-Id: <%d@example.org>\n\n%s\n'
+        % (sender, sender, i, i, body)
+    )
+
+#######################################
+def make_certificate():
+    '''Create a throwaway self-signed key and certificate with openssl(1)
+    and return their paths as (keyfile, certfile).'''
+    tmpdir = tempfile.mkdtemp(prefix='getmail-bench-')
+    atexit.register(shutil.rmtree, tmpdir, True)
+    keyfile = os.path.join(tmpdir, 'key.pem')
+    certfile = os.path.join(tmpdir, 'cert.pem')
+    rc = os.system('openssl req -x509 -newkey rsa:2048 -nodes -days 1 '
+                   '-subj /CN=localhost -keyout %s -out %s >/dev/null 2>&1'
+                   % (keyfile, certfile))
+    if rc:
+        raise SystemExit('openssl failed to create a test certificate')
+    return (keyfile, certfile)
+
+#######################################
+class ServerBase(object):
+    '''Listen on an ephemeral loopback port and serve each connection in a
+    daemon thread with self.handle(sock).  With ssl set, connections are
+    wrapped with a throwaway certificate.  self.sent counts the bytes sent
+    to clients.'''
+    def __init__(self, ssl=False):
+        self.sent = 0
+        self.certificate = None
+        if ssl:
+            self.certificate = make_certificate()
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(20)
+        self.port = self.sock.getsockname()[1]
+        self.start(self.serve)
+
+    def start(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.setDaemon(True)
+        t.start()
+
+    def serve(self):
+        while True:
+            (conn, unused) = self.sock.accept()
+            if self.certificate:
+                import ssl
+                (keyfile, certfile) = self.certificate
+                conn = ssl.wrap_socket(conn, server_side=True,
+                                       keyfile=keyfile, certfile=certfile)
+            self.start(self.handle, conn)
+
+    def send(self, conn, data):
+        self.sent += len(data)
+        conn.sendall(data)
+
+#######################################
+class POP3Server(ServerBase):
+    '''POP3 server holding the messages (CRLF strings) in msgs.'''
+    def __init__(self, msgs, capa=('UIDL', 'PIPELINING'), ssl=False):
+        self.msgs = list(msgs)
+        self.capa = capa
+        ServerBase.__init__(self, ssl)
+
+    def handle(self, conn):
+        f = conn.makefile('rb')
+        self.send(conn, '+OK ready\r\n')
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            words = line.split()
+            cmd = words[0].upper()
+            out = []
+            if cmd in ('USER', 'PASS', 'NOOP', 'RSET', 'DELE'):
+                out.append('+OK')
+            elif cmd == 'CAPA':
+                out = ['+OK'] + list(self.capa) + ['.']
+            elif cmd in ('UIDL', 'LIST'):
+                out.append('+OK')
+                for (i, msg) in enumerate(self.msgs):
+                    if cmd == 'UIDL':
+                        out.append('%d uid%d' % (i + 1, i + 1))
+                    else:
+                        out.append('%d %d' % (i + 1, len(msg)))
+                out.append('.')
+            elif cmd in ('RETR', 'TOP'):
+                msg = self.msgs[int(words[1]) - 1]
+                if cmd == 'TOP':
+                    msg = msg.split('\r\n\r\n')[0] + '\r\n\r\n'
+                out.append('+OK')
+                for line in msg.split('\r\n')[:-1]:
+                    if line.startswith('.'):
+                        line = '.' + line
+                    out.append(line)
+                out.append('.')
+            elif cmd == 'QUIT':
+                self.send(conn, '+OK bye\r\n')
+                break
+            else:
+                out.append('-ERR unknown command')
+            self.send(conn, '\r\n'.join(out) + '\r\n')
+        conn.close()
+
+#######################################
+def imap_quote(s):
+    if s is None:
+        return 'NIL'
+    return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+#######################################
+def bodystructure(part):
+    '''Return the IMAP BODYSTRUCTURE of an email.Message, basic fields
+    only.'''
+    if part.is_multipart():
+        return '(%s %s ("BOUNDARY" %s) NIL NIL NIL)' % (
+            ''.join([bodystructure(sub) for sub in part.get_payload()]),
+            imap_quote(part.get_content_subtype().upper()),
+            imap_quote(part.get_boundary())
+        )
+    params = []
+    for (name, value) in (part.get_params() or [])[1:]:
+        params.append('%s %s' % (imap_quote(name.upper()), imap_quote(value)))
+    body = part.get_payload()
+    extra = ''
+    if part.get_content_maintype() == 'text':
+        extra = ' %d' % body.count('\n')
+    return '(%s %s %s NIL NIL %s %d%s)' % (
+        imap_quote(part.get_content_maintype().upper()),
+        imap_quote(part.get_content_subtype().upper()),
+        params and '(%s)' % ' '.join(params) or 'NIL',
+        imap_quote((part.get('content-transfer-encoding') or '7BIT').upper()),
+        len(crlf(body)), extra
+    )
+
+#######################################
+def imap_part(msg, spec):
+    '''Return the part of the email.Message msg numbered spec (e.g.
+    "2.1").'''
+    part = msg
+    for n in spec.split('.'):
+        if part.is_multipart():
+            part = part.get_payload()[int(n) - 1]
+    return part
+
+#######################################
+def imap_section(data, spec):
+    '''Return section spec of the message data, as BODY[spec] would.'''
+    if spec == '':
+        return data
+    hdr_end = data.find('\r\n\r\n') + 4
+    if spec == 'HEADER':
+        return data[:hdr_end]
+    if spec == 'TEXT':
+        return data[hdr_end:]
+    msg = email.message_from_string(data.replace('\r\n', '\n'))
+    if spec.endswith('.MIME'):
+        part = imap_part(msg, spec[:-5])
+        return ''.join(['%s: %s\r\n' % item for item in part.items()]) + '\r\n'
+    return crlf(imap_part(msg, spec).get_payload())
+
+IMAP_ITEM_RE = re.compile(r'(BINARY|BODY)(\.PEEK)?\[([^\]]*)\]|[A-Z0-9.]+',
+                          re.IGNORECASE)
+
+#######################################
+class IMAPServer(ServerBase):
+    '''IMAP server with a single mailbox holding the messages (CRLF strings)
+    in msgs; message n has UID n.  It supports only what getmail needs to
+    retrieve messages without deleting them: FETCH and UID FETCH of UID,
+    RFC822.SIZE, FLAGS, RFC822, RFC822.HEADER, BODYSTRUCTURE, BODY[...] and,
+    if BINARY is among the capabilities, BINARY[...].'''
+    def __init__(self, msgs, caps=('IMAP4rev1', ), ssl=False):
+        self.msgs = list(msgs)
+        self.caps = caps
+        ServerBase.__init__(self, ssl)
+
+    def handle(self, conn):
+        f = conn.makefile('rb')
+        self.send(conn, '* OK ready\r\n')
+        while True:
+            line = f.readline()
+            if not line:
+                break
+            (tag, cmd, args) = (line.rstrip('\r\n').split(' ', 2) + [''])[:3]
+            cmd = cmd.upper()
+            if cmd == 'UID':
+                (cmd, args) = (args.split(' ', 1) + [''])[:2]
+                cmd = cmd.upper()
+            if cmd == 'CAPABILITY':
+                self.send(conn, '* CAPABILITY %s\r\n' % ' '.join(self.caps))
+            elif cmd in ('SELECT', 'EXAMINE'):
+                self.send(conn, '* %d EXISTS\r\n* 0 RECENT\r\n'
+                          '* OK [UIDVALIDITY 1] ok\r\n'
+                          '* OK [UIDNEXT %d] ok\r\n'
+                          % (len(self.msgs), len(self.msgs) + 1))
+            elif cmd == 'FETCH':
+                self.fetch(conn, args)
+            elif cmd == 'LOGOUT':
+                self.send(conn, '* BYE bye\r\n')
+            elif cmd not in ('LOGIN', 'NOOP', 'CLOSE'):
+                self.send(conn, '%s BAD unsupported command\r\n' % tag)
+                continue
+            self.send(conn, '%s OK done\r\n' % tag)
+            if cmd == 'LOGOUT':
+                break
+        conn.close()
+
+    def fetch(self, conn, args):
+        (msgset, items) = args.split(' ', 1)
+        last = len(self.msgs)
+        numbers = []
+        for piece in msgset.replace('*', str(last)).split(','):
+            ends = [int(n) for n in piece.split(':')]
+            numbers.extend(range(min(ends), min(max(ends), last) + 1))
+        for i in numbers:
+            data = self.msgs[i - 1]
+            out = ['UID %d' % i]
+            for match in IMAP_ITEM_RE.finditer(items):
+                item = match.group(0).upper()
+                (kind, spec) = (match.group(1), match.group(3))
+                if kind and kind.upper() == 'BINARY':
+                    part = imap_part(
+                        email.message_from_string(data.replace('\r\n', '\n')),
+                        spec
+                    ).get_payload(decode=True)
+                    out.append('BINARY[%s] ~{%d}\r\n%s'
+                               % (spec, len(part), part))
+                elif kind:
+                    section = imap_section(data, spec.upper())
+                    out.append('BODY[%s] {%d}\r\n%s'
+                               % (spec, len(section), section))
+                elif item == 'RFC822.SIZE':
+                    out.append('RFC822.SIZE %d' % len(data))
+                elif item == 'FLAGS':
+                    out.append('FLAGS ()')
+                elif item in ('RFC822', 'RFC822.HEADER'):
+                    section = data
+                    if item == 'RFC822.HEADER':
+                        section = imap_section(data, 'HEADER')
+                    out.append('%s {%d}\r\n%s' % (item, len(section), section))
+                elif item == 'BODYSTRUCTURE':
+                    out.append('BODYSTRUCTURE %s' % bodystructure(
+                        email.message_from_string(data.replace('\r\n', '\n'))
+                    ))
+            self.send(conn, '* %d FETCH (%s)\r\n' % (i, ' '.join(out)))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python2.3
+'''Provide IMAP COMPRESS=DEFLATE (RFC 4978) support for imaplib connections.
+
+'''
+
+__all__ = [
+    'DEFLATE_READ_SIZE',
+    'DeflateStream',
+    'deflate_connection',
+]
+
+import zlib
+
+from getmailcore.exceptions import *
+import getmailcore.logging
+log = getmailcore.logging.Logger()
+
+# Maximum number of compressed bytes to read from the connection at once.
+DEFLATE_READ_SIZE = 16384
+
+class DeflateStream(object):
+    '''Raw DEFLATE codec over a connection, providing the .read(), .readline()
+    and .send() methods imaplib.IMAP4 uses for its I/O.
+
+    recv is a function returning whatever data is available from the
+    connection, up to a given number of bytes, or an empty string at EOF.
+    sendall is a function sending all of the given data.
+
+    Data sent is flushed with Z_SYNC_FLUSH after every write, as the server
+    must be able to decompress each command as soon as it arrives.  The
+    number of bytes before and after compression is counted in each
+    direction.
+    '''
+    def __init__(self, recv, sendall, readsize=DEFLATE_READ_SIZE):
+        log.trace()
+        self.recv = recv
+        self.sendall = sendall
+        self.readsize = readsize
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION,
+                                           zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.buf = ''
+        # Offset of the first unconsumed byte in self.buf
+        self.pos = 0
+        self.received = 0
+        self.received_compressed = 0
+        self.sent = 0
+        self.sent_compressed = 0
+
+    def _fill(self):
+        '''Replace the (consumed) buffer with the next decompressed data.
+        Returns False at EOF.'''
+        while True:
+            data = self.recv(self.readsize)
+            if not data:
+                return False
+            self.received_compressed += len(data)
+            try:
+                data = self.decompressor.decompress(data)
+            except zlib.error, o:
+                raise getmailOperationError(
+                    'IMAP error (bad compressed data from server: %s)' % o
+                )
+            if data:
+                self.received += len(data)
+                self.buf = data
+                self.pos = 0
+                return True
+
+    def read(self, size):
+        '''Return size bytes, or fewer at EOF.'''
+        chunks = []
+        while size > 0:
+            if self.pos >= len(self.buf) and not self._fill():
+                break
+            chunk = self.buf[self.pos:self.pos + size]
+            self.pos += len(chunk)
+            size -= len(chunk)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def readline(self):
+        '''Return the next line, including its LF, or the partial line left
+        at EOF.'''
+        chunks = []
+        while True:
+            if self.pos >= len(self.buf) and not self._fill():
+                break
+            i = self.buf.find('\n', self.pos)
+            if i != -1:
+                chunks.append(self.buf[self.pos:i + 1])
+                self.pos = i + 1
+                break
+            chunks.append(self.buf[self.pos:])
+            self.pos = len(self.buf)
+        return ''.join(chunks)
+
+    def send(self, data):
+        self.sent += len(data)
+        data = (self.compressor.compress(data)
+                + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.sent_compressed += len(data)
+        self.sendall(data)
+
+def deflate_connection(conn):
+    '''Switch the I/O of imaplib.IMAP4 (or IMAP4_SSL) instance conn to
+    DEFLATE compression, after the server has accepted COMPRESS DEFLATE.
+    Returns the DeflateStream, which keeps the byte counts.
+    '''
+    log.trace()
+    sslobj = getattr(conn, 'sslobj', None)
+    if sslobj is not None:
+        recv = sslobj.read
+    else:
+        recv = conn.sock.recv
+    stream = DeflateStream(recv, conn.send)
+    conn.read = stream.read
+    conn.readline = stream.readline
+    conn.send = stream.send
+    return stream
@@ -5,12 +5,18 @@
 
 __all__ = [
     'POP3_ssl_port',
+    'SSL_READ_SIZE',
     'sslsocket',
     'POP3SSL',
 ]
 
 import socket
 from poplib import POP3, CR, LF, CRLF, error_proto
+try:
+    import ssl
+except ImportError:
+    # Python 2.5 and earlier; use socket.ssl()
+    ssl = None
 
 from getmailcore.exceptions import *
 import getmailcore.logging
@@ -18,6 +24,10 @@ log = getmailcore.logging.Logger()
 
 POP3_ssl_port = 995
 
+# Maximum number of bytes to read from the SSL connection at once.  A TLS
+# record carries at most 16 KiB, so larger reads rarely return more.
+SSL_READ_SIZE = 16384
+
 class sslsocket(object):
     '''The Python poplib.POP3() class mixes socket-like .sendall() and
     file-like .readline() for communications.  That would be okay, except that
@@ -27,35 +37,34 @@ class sslsocket(object):
     This class takes a standard, connected socket.socket() object, sets it
     to blocking mode (required for socket.ssl() to work correctly, though
     apparently not documented), wraps .write() for .sendall() and implements
-    .readline().
+    .readline().  The ssl module is used instead of socket.ssl() where
+    available.
+
+    Data is read from the SSL connection in blocks of up to readsize bytes.
+    .readline() finds line ends by offset into the buffered block and only
+    copies the (partial) remainder when the next block is read, so large
+    messages don't cost a read per 128 bytes or a copy of the buffer per
+    line.
 
     The modified POP3 class below can then use this to provide POP3-over-SSL.
 
     Thanks to Frank Benkstein for the inspiration.
     '''
-    def __init__(self, sock, keyfile=None, certfile=None):
+    def __init__(self, sock, keyfile=None, certfile=None,
+                 readsize=SSL_READ_SIZE):
         log.trace()
         self.sock = sock
         self.sock.setblocking(1)
-        if keyfile and certfile:
+        if ssl:
+            self.ssl = ssl.wrap_socket(self.sock, keyfile, certfile)
+        elif keyfile and certfile:
             self.ssl = socket.ssl(self.sock, keyfile, certfile)
         else:
             self.ssl = socket.ssl(self.sock)
+        self.readsize = readsize
         self.buf = ''
-        self.bufsize = 128
-
-    def _fillbuf(self):
-        '''Fill an internal buffer for .readline() to use.
-        '''
-        log.trace()
-        want = self.bufsize - len(self.buf)
-        log.trace('want %i bytes\n' % want)
-        if want <= 0:
-            return
-        s = self.ssl.read(want)
-        got = len(s)
-        log.trace('got %i bytes\n' % got)
-        self.buf += s
+        # Offset of the first unconsumed byte in self.buf
+        self.pos = 0
 
     def close(self):
         self.sock.close()
@@ -64,41 +73,36 @@ class sslsocket(object):
     # self.sock.sendall
     def sendall(self, s):
         # Maybe only set blocking around this call?
-        self.ssl.write(s)
+        if ssl:
+            self.ssl.sendall(s)
+        else:
+            self.ssl.write(s)
 
     # self.file.readline
     def readline(self):
-        '''Simple hack to implement .readline() on a non-file object that
-        only supports .read().
+        '''Implement .readline() on a non-file object that only supports
+        .read().
         '''
-        log.trace()
-        line = ''
         try:
-            if not self.buf:
-                self._fillbuf()
-            log.trace('checking self.buf\n')
-            if self.buf:
-                log.trace('self.buf = "%r", len %i\n'
-                          % (self.buf, len(self.buf)))
-                while True:
-                    log.trace('looking for EOL\n')
-                    i = self.buf.find('\n')
-                    if i != -1:
-                        log.trace('EOL found at %d\n' % i)
-                        line += self.buf[:i + 1]
-                        self.buf = self.buf[i + 1:]
-                        break
-                    # else
-                    log.trace('EOL not found, trying to fill self.buf\n')
-                    line += self.buf
+            # Where to start looking for EOL; the part of self.buf before
+            # this has already been searched.
+            start = self.pos
+            while True:
+                i = self.buf.find('\n', start)
+                if i != -1:
+                    line = self.buf[self.pos:i + 1]
+                    self.pos = i + 1
+                    return line
+                s = self.ssl.read(self.readsize)
+                if not s:
+                    # EOF; return whatever partial line is left
+                    line = self.buf[self.pos:]
                     self.buf = ''
-                    self._fillbuf()
-                    if not self.buf:
-                        log.trace('nothing read, exiting\n')
-                        break
-                    log.trace('end of loop\n')
-            log.trace('returning line "%r"\n' % line)
-            return line
+                    self.pos = 0
+                    return line
+                start = len(self.buf) - self.pos
+                self.buf = self.buf[self.pos:] + s
+                self.pos = 0
         except (socket.sslerror, socket.error), o:
             raise getmailOperationError(
                 'socket/ssl error while reading from server (%s)' % o
@@ -112,7 +116,8 @@ class POP3SSL(POP3):
     This gets rid of the .file attribute from os.makefile(rawsock) and relies on
     sslsocket() above to provide .readline() instead.
     '''
-    def __init__(self, host, port=POP3_ssl_port, keyfile=None, certfile=None):
+    def __init__(self, host, port=POP3_ssl_port, keyfile=None, certfile=None,
+                 readsize=SSL_READ_SIZE):
         if not ((certfile and keyfile) or (keyfile == certfile == None)):
             raise getmailConfigurationError('certfile requires keyfile')
         self.host = host
@@ -127,9 +132,10 @@ class POP3SSL(POP3):
                 self.rawsock = socket.socket(af, socktype, proto)
                 self.rawsock.connect(sa)
                 if certfile and keyfile:
-                    self.sock = sslsocket(self.rawsock, keyfile, certfile)
+                    self.sock = sslsocket(self.rawsock, keyfile, certfile,
+                                          readsize)
                 else:
-                    self.sock = sslsocket(self.rawsock)
+                    self.sock = sslsocket(self.rawsock, readsize=readsize)
             except socket.error, msg:
                 if self.rawsock:
                     self.rawsock.close()
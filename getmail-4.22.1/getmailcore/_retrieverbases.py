@@ -19,6 +19,10 @@ Base classes:
   MultidropPOP3RetrieverBase
   IMAPRetrieverBase
   MultidropIMAPRetrieverBase
+
+Helper classes:
+
+  IMAPBackfill
 '''
 
 __all__ = [
@@ -28,6 +32,7 @@ __all__ = [
     'MultidropPOP3RetrieverBase',
     'MultidropIMAPRetrieverBase',
     'POP3_ssl_port',
+    'SSL_READ_SIZE',
     'POP3initMixIn',
     'POP3RetrieverBase',
     'POP3SSLinitMixIn',
@@ -43,6 +48,9 @@ import email
 import poplib
 import imaplib
 import re
+import threading
+import tempfile
+import base64
 
 try:
     # do we have a recent pykerberos?
@@ -58,7 +66,8 @@ from getmailcore.compatibility import *
 from getmailcore.constants import *
 from getmailcore.message import *
 from getmailcore.utilities import *
-from getmailcore._pop3ssl import POP3SSL, POP3_ssl_port
+from getmailcore._pop3ssl import POP3SSL, POP3_ssl_port, SSL_READ_SIZE
+from getmailcore._imapdeflate import deflate_connection
 from getmailcore.baseclasses import *
 
 NOT_ENVELOPE_RECIPIENT_HEADERS = (
@@ -78,9 +87,63 @@ NOT_ENVELOPE_RECIPIENT_HEADERS = (
 # 30 days.
 VANISHED_AGE = (60 * 60 * 24 * 30)
 
+# How long to wait in IMAP IDLE before re-issuing the command.  RFC 2177
+# requires clients to do so at least every 29 minutes to avoid being logged
+# off for inactivity.  This is in seconds.
+IDLE_TIMEOUT = (29 * 60)
+
 # Regex used to remove problematic characters from oldmail filenames
 STRIP_CHAR_RE = r'[/\:;<>|]+'
 
+# Regex used to find the mailbox an IMAP msgid belongs to
+MSGID_MAILBOX_RE = re.compile(r'^\d+/(.+?)/\d+$')
+
+# Messages delivered or deleted are recorded in a journal next to each oldmail
+# file as they happen, instead of rewriting the oldmail files at the end of
+# every session.  The journals are synced to disk at most this often (and at
+# the end of the session).  This is in seconds.
+JOURNAL_SYNC_INTERVAL = 5
+
+# The journals are folded back into the oldmail files in the background once
+# they hold at least this many records, and more records than there are
+# messages in the oldmail files.
+JOURNAL_COMPACT_RECORDS = 1000
+
+# Tokens of an IMAP response line:  parentheses, quoted strings, literal
+# announcements at the end of the line, and atoms (which may include
+# bracketed parts such as BODY[HEADER.FIELDS (FROM)]<0>).
+IMAP_TOKEN_RE = re.compile(
+    r'\s*(?:(?P<paren>[()])'
+    r'|"(?P<quoted>(?:[^"\\]|\\.)*)"'
+    r'|(?P<literal>~?\{\d+\})$'
+    r'|(?P<atom>(?:[^\s()"\[\]]|\[[^\]]*\])+))'
+)
+IMAP_LITERAL_RE = re.compile(r'~?\{(\d+)\}$')
+# A literal holding the decoded content of a BINARY item, which servers may
+# send as an ordinary literal if it has no NULs
+IMAP_BINARY_LITERAL_RE = re.compile(r'BINARY\[[^\]]*\]\s+~?\{\d+\}$',
+                                    re.IGNORECASE)
+
+# Messages larger than the max_in_memory_message_size option are read from the
+# server into a spool file in pieces of this size.
+SPOOL_CHUNK_SIZE = 1048576
+
+# Spooled parts fetched with IMAP BINARY are base64-encoded again in pieces
+# of this size, a multiple of the 57 octets encoded per line.
+BASE64_CHUNK_SIZE = 57 * 16384
+
+# Sizes, BODYSTRUCTUREs and headers are fetched for at most this many UIDs at
+# once, to keep command lines, and the responses held at once, reasonably
+# short.
+SEARCH_FETCH_UIDS = 1000
+
+# A backfill over backfill_connections extra connections is only started for
+# a mailbox with at least this many messages to retrieve.  The messages are
+# fetched this many at a time, and each connection may be at most two such
+# chunks ahead of the messages the application has asked for.
+BACKFILL_MIN_MESSAGES = 100
+BACKFILL_CHUNK_MESSAGES = 25
+
 # Kerberos authentication state constants
 (GSS_STATE_STEP, GSS_STATE_WRAP) = (0, 1)
 
@@ -106,6 +169,11 @@ if sys.version_info < (2, 5, 3):
     
     imaplib.IMAP4_SSL = IMAP4_SSL
 
+# imaplib doesn't know the MOVE extension (RFC 6851), and refuses to send
+# UID commands it doesn't know.
+if not 'MOVE' in imaplib.Commands:
+    imaplib.Commands['MOVE'] = ('SELECTED', )
+
 #
 # Mix-in classes
 #
@@ -129,8 +197,8 @@ class POP3initMixIn(object):
                 % (self.conf['server'], o)
             )
 
-        self.log.trace('POP3 connection %s established' % self.conn
-                       + os.linesep)
+        self.log.trace('POP3 connection %s established%s', self.conn,
+                       os.linesep)
 
 #######################################
 class Py24POP3SSLinitMixIn(object):
@@ -147,19 +215,18 @@ class Py24POP3SSLinitMixIn(object):
         try:
             if keyfile:
                 self.log.trace(
-                    'establishing POP3 SSL connection to %s:%d with '
-                    'keyfile %s, certfile %s'
-                    % (self.conf['server'], self.conf['port'], keyfile,
-                       certfile)
-                    + os.linesep
+                    'establishing POP3 SSL connection to %s:%d with keyfile '
+                    '%s, certfile %s%s',
+                    self.conf['server'], self.conf['port'], keyfile, certfile,
+                    os.linesep
                 )
                 self.conn = poplib.POP3_SSL(
                     self.conf['server'], self.conf['port'], keyfile, certfile
                 )
             else:
-                self.log.trace('establishing POP3 SSL connection to %s:%d'
-                               % (self.conf['server'], self.conf['port'])
-                               + os.linesep)
+                self.log.trace('establishing POP3 SSL connection to %s:%d%s',
+                               self.conf['server'], self.conf['port'],
+                               os.linesep)
                 self.conn = poplib.POP3_SSL(self.conf['server'],
                                             self.conf['port'])
             self.setup_received(self.conn.sock)
@@ -174,13 +241,14 @@ class Py24POP3SSLinitMixIn(object):
             )
 
         self.conn.sock.setblocking(1)
-        self.log.trace('POP3 connection %s established' % self.conn
-                       + os.linesep)
+        self.log.trace('POP3 connection %s established%s', self.conn,
+                       os.linesep)
 
 #######################################
 class Py23POP3SSLinitMixIn(object):
     '''Mix-In class to do POP3 over SSL initialization with custom-implemented
-    code to support SSL with Python 2.3's poplib.POP3 class.
+    code to support SSL with Python 2.3's poplib.POP3 class.  Used with later
+    Python versions as well, for the faster buffered reads of POP3SSL.
     '''
     def _connect(self):
         self.log.trace()
@@ -189,24 +257,25 @@ class Py23POP3SSLinitMixIn(object):
                 'SSL not supported by this installation of Python'
             )
         (keyfile, certfile) = check_ssl_key_and_cert(self.conf)
+        readsize = self.conf.get('ssl_read_size', SSL_READ_SIZE)
+        if readsize < 1:
+            raise getmailConfigurationError('ssl_read_size must be positive')
         try:
             if keyfile:
                 self.log.trace(
                     'establishing POP3 SSL connection to %s:%d with keyfile '
-                    '%s, certfile %s'
-                    % (self.conf['server'], self.conf['port'],
-                       keyfile, certfile)
-                    + os.linesep
+                    '%s, certfile %s%s',
+                    self.conf['server'], self.conf['port'], keyfile, certfile,
+                    os.linesep
                 )
                 self.conn = POP3SSL(self.conf['server'], self.conf['port'],
-                                    keyfile, certfile)
+                                    keyfile, certfile, readsize)
             else:
-                self.log.trace(
-                    'establishing POP3 SSL connection to %s:%d'
-                    % (self.conf['server'], self.conf['port'])
-                    + os.linesep
-                )
-                self.conn = POP3SSL(self.conf['server'], self.conf['port'])
+                self.log.trace('establishing POP3 SSL connection to %s:%d%s',
+                               self.conf['server'], self.conf['port'],
+                               os.linesep)
+                self.conn = POP3SSL(self.conf['server'], self.conf['port'],
+                                    readsize=readsize)
             self.setup_received(self.conn.rawsock)
         except poplib.error_proto, o:
             raise getmailOperationError('POP error (%s)' % o)
@@ -219,8 +288,8 @@ class Py23POP3SSLinitMixIn(object):
                 'socket sslerror during connect (%s)' % o
             )
 
-        self.log.trace('POP3 SSL connection %s established' % self.conn
-                       + os.linesep)
+        self.log.trace('POP3 SSL connection %s established%s', self.conn,
+                       os.linesep)
 
 #######################################
 class IMAPinitMixIn(object):
@@ -238,8 +307,8 @@ class IMAPinitMixIn(object):
         except socket.gaierror, o:
             raise getmailOperationError('socket error during connect (%s)' % o)
 
-        self.log.trace('IMAP connection %s established' % self.conn
-                       + os.linesep)
+        self.log.trace('IMAP connection %s established%s', self.conn,
+                       os.linesep)
 
 #######################################
 class IMAPSSLinitMixIn(object):
@@ -256,19 +325,17 @@ class IMAPSSLinitMixIn(object):
             if keyfile:
                 self.log.trace(
                     'establishing IMAP SSL connection to %s:%d with keyfile '
-                    '%s, certfile %s'
-                    % (self.conf['server'], self.conf['port'],
-                       keyfile, certfile)
-                    + os.linesep
+                    '%s, certfile %s%s',
+                    self.conf['server'], self.conf['port'], keyfile, certfile,
+                    os.linesep
                 )
                 self.conn = imaplib.IMAP4_SSL(
                     self.conf['server'], self.conf['port'], keyfile, certfile
                 )
             else:
-                self.log.trace(
-                    'establishing IMAP SSL connection to %s:%d'
-                    % (self.conf['server'], self.conf['port']) + os.linesep
-                )
+                self.log.trace('establishing IMAP SSL connection to %s:%d%s',
+                               self.conf['server'], self.conf['port'],
+                               os.linesep)
                 self.conn = imaplib.IMAP4_SSL(self.conf['server'],
                                               self.conf['port'])
             self.setup_received(self.conn.sock)
@@ -283,8 +350,8 @@ class IMAPSSLinitMixIn(object):
                 'socket sslerror during connect (%s)' % o
             )
 
-        self.log.trace('IMAP SSL connection %s established' % self.conn
-                       + os.linesep)
+        self.log.trace('IMAP SSL connection %s established%s', self.conn,
+                       os.linesep)
 
 #
 # Base classes
@@ -343,6 +410,29 @@ class RetrieverSkeleton(ConfigurableBase):
       __del__(self)
       initialize(self, options)
       checkconf(self)
+      _getheadersbyid(self, msgids, keep) - retrieve the headers of several
+                                 messages, calling keep(msgid, header) with
+                                 each header-only Message() object as it
+                                 arrives, and returning a dictionary of
+                                 those keep() returned True for, keyed by
+                                 message identifier.  The default calls
+                                 _getheaderbyid() for each; protocols which
+                                 can fetch them in bulk should do so, without
+                                 holding all of them at once.
+
+    Long-running sessions which handle several batches of messages over one
+    connection should call checkpoint() after each batch.  A retriever is
+    only used for one session; fresh() returns a new one with the same
+    configuration for the next.
+
+    The oldmail state is kept in an oldmail file per mailbox, plus a journal
+    (the oldmail filename with ".journal" appended) to which each delivered
+    message is appended as it is delivered, and each deleted or vanished
+    message when it is forgotten.  Reading the state replays the journal over
+    the oldmail file, so a session which dies part way through only loses
+    what was delivered since the last sync of the journal.  The oldmail file
+    itself is only rewritten when the journal has grown large (see
+    JOURNAL_COMPACT_RECORDS), in a background thread.
     '''
 
     def __init__(self, **args):
@@ -355,11 +445,29 @@ class RetrieverSkeleton(ConfigurableBase):
         self.deleted = {}
         self.__delivered = {}
         self.timestamp = int(time.time())
+        self._notretrieving = {}
+        self._skipped = {}
         self.__oldmail_written = False
         self.__initialized = False
         self.gotmsglist = False
+        self._journals = {}
+        self._journalrecords = 0
+        self._journalsynced = time.time()
+        self._snapshotneeded = False
+        self._compactor = None
+        self.__args = args.copy()
         ConfigurableBase.__init__(self, **args)
 
+    def fresh(self):
+        '''Return a new, uninitialized retriever with the same configuration
+        (including any password entered interactively), for another
+        session.'''
+        self.log.trace()
+        args = self.__args.copy()
+        if self.conf.get('password') is not None:
+            args['password'] = self.conf['password']
+        return self.__class__(**args)
+
     def setup_received(self, sock):
         serveraddr = sock.getpeername()
         if len(serveraddr) == 2:
@@ -388,22 +496,112 @@ class RetrieverSkeleton(ConfigurableBase):
         return len(self.msgnum_by_msgid)
 
     def __getitem__(self, i):
-        self.log.trace('i == %d' % i)
+        self.log.trace('i == %d', i)
         if not self.__initialized:
             raise getmailOperationError('not initialized')
         return self.sorted_msgnum_msgid[i][1]
 
+    def _oldmailfilename(self, mailbox):
+        '''Return the name of the oldmail file for mailbox.'''
+        filename = self.oldmail_filename
+        if mailbox:
+            filename += '-' + re.sub(STRIP_CHAR_RE, '.', mailbox)
+        return filename
+
+    def _msgidmailbox(self, msgid):
+        '''Return the mailbox msgid belongs to, or None.'''
+        match = MSGID_MAILBOX_RE.match(msgid)
+        if match:
+            return match.group(1)
+        return None
+
+    def _replayjournal(self, filename):
+        '''Apply the records of journal filename to the oldmail state, and
+        return the number of records applied.'''
+        self.log.trace()
+        records = 0
+        for line in open(filename, 'rb'):
+            if not line.endswith('\n'):
+                # Partial record left by an interrupted write
+                continue
+            line = line.strip()
+            try:
+                if line[:1] == '+':
+                    (msgid, timestamp) = line[1:].split('\0', 1)
+                    self.oldmail[msgid] = int(timestamp)
+                elif line[:1] == '-' and line[1:]:
+                    if line[1:] in self.oldmail:
+                        del self.oldmail[line[1:]]
+                else:
+                    raise ValueError(line)
+                records += 1
+            except ValueError:
+                # malformed
+                self.log.info(
+                    'skipped malformed journal line "%r" for %s%s'
+                    % (line, self, os.linesep)
+                )
+        return records
+
+    def _openjournal(self, mailbox):
+        '''Open the journal for mailbox for appending records.'''
+        self.log.trace()
+        filename = self._oldmailfilename(mailbox) + '.journal'
+        try:
+            fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                         0600)
+            self._journals[mailbox] = os.fdopen(fd, 'ab')
+        except (IOError, OSError), o:
+            self.log.error('failed opening oldmail journal for %s (%s)'
+                           % (self, o) + os.linesep)
+            # Fall back to writing the oldmail files at the end of the session
+            self._snapshotneeded = True
+
+    def _journal(self, msgid, timestamp=None):
+        '''Record msgid in the journal with timestamp, or record that it is
+        forgotten if timestamp is None.'''
+        mailbox = self._msgidmailbox(msgid)
+        if not mailbox in self._journals:
+            return
+        if timestamp is None:
+            record = '-%s%s' % (msgid, os.linesep)
+        else:
+            record = '+%s\0%i%s' % (msgid, timestamp, os.linesep)
+        try:
+            self._journals[mailbox].write(record)
+            self._journals[mailbox].flush()
+            self._journalrecords += 1
+            if time.time() - self._journalsynced >= JOURNAL_SYNC_INTERVAL:
+                self._syncjournals()
+        except (IOError, OSError), o:
+            self.log.error('failed writing oldmail journal for %s (%s)'
+                           % (self, o) + os.linesep)
+            del self._journals[mailbox]
+            self._snapshotneeded = True
+
+    def _syncjournals(self):
+        '''Flush the journals to disk.'''
+        for f in self._journals.values():
+            f.flush()
+            os.fsync(f.fileno())
+        self._journalsynced = time.time()
+
+    def _forget(self, msgid):
+        '''Remove msgid from the oldmail state.'''
+        del self.oldmail[msgid]
+        self._journal(msgid)
+
     def _read_oldmailfile(self):
-        '''Read contents of oldmail file.'''
+        '''Read contents of oldmail file and replay its journal.'''
         self.log.trace()
         # Read separate oldmail file for each folder (IMAP).
         mailboxes = self.conf.get('mailboxes', (None, ))
         for mailbox in mailboxes:
-            filename = self.oldmail_filename
+            filename = self._oldmailfilename(mailbox)
+            journal = filename + '.journal'
             mailbox_logstr = ''
             if mailbox:
                 mailbox_logstr = 'mailbox %s in ' % mailbox
-                filename += '-' + re.sub(STRIP_CHAR_RE, '.', mailbox)
                 if not os.path.isfile(filename):
                     # use existing oldmail file, to enable smooth migration to 
                     # oldmail filenames with appended mailbox name
@@ -412,6 +610,7 @@ class RetrieverSkeleton(ConfigurableBase):
                         % (filename, self.oldmail_filename, os.linesep)
                     )
                     filename = self.oldmail_filename
+                    self._snapshotneeded = True
             try:
                 oldlength = len(self.oldmail)
                 for line in open(filename, 'rb'):
@@ -428,53 +627,95 @@ class RetrieverSkeleton(ConfigurableBase):
                             'skipped malformed line "%r" for %s%s'
                             % (line, self, os.linesep)
                         )
-                self.log.moreinfo(
-                    'read %i uids for %s%s%s'
-                    % (len(self.oldmail) - oldlength, mailbox_logstr, self, 
-                       os.linesep)
-                )
+                self.log.moreinfo('read %i uids for %s%s%s',
+                                  len(self.oldmail) - oldlength,
+                                  mailbox_logstr, self, os.linesep)
             except IOError:
-                self.log.moreinfo('no oldmail file for %s%s%s'
-                                  % (mailbox_logstr, self, os.linesep))
-        self.log.moreinfo('read %i uids in total for %s%s'
-                          % (len(self.oldmail), self, os.linesep))
+                self.log.moreinfo('no oldmail file for %s%s%s', mailbox_logstr,
+                                  self, os.linesep)
+                self._snapshotneeded = True
+            # A journal renamed aside by a compaction which did not finish
+            # comes before the current one.
+            for filename in (journal + '.old', journal):
+                try:
+                    records = self._replayjournal(filename)
+                    self._journalrecords += records
+                    self.log.moreinfo('replayed %i journal records for %s%s%s',
+                                      records, mailbox_logstr, self,
+                                      os.linesep)
+                except IOError:
+                    pass
+            self._openjournal(mailbox)
+        self.log.moreinfo('read %i uids in total for %s%s', len(self.oldmail),
+                          self, os.linesep)
+
+    def _compact(self, forget_deleted=True):
+        '''Fold the journals back into the oldmail files.
+
+        The journals are renamed aside and new ones started, and a background
+        thread writes the oldmail files and then removes the renamed journals.
+        Replaying a journal over an oldmail file which already includes its
+        records is harmless, so this is safe to interrupt at any point.
+        '''
+        self.log.trace()
+        self._finishcompaction()
+        state = self.oldmail.copy()
+        for msgid in self.__delivered:
+            if not msgid in state:
+                state[msgid] = self.timestamp
+        if forget_deleted:
+            for msgid in self.deleted:
+                if msgid in state:
+                    del state[msgid]
+        mailboxes = self.conf.get('mailboxes', (None, ))
+        journals = []
+        for mailbox in mailboxes:
+            journal = self._oldmailfilename(mailbox) + '.journal'
+            journals.append(journal + '.old')
+            if os.path.exists(journal + '.old'):
+                # Left over from an interrupted compaction; keep appending to
+                # the current journal, whose records are in this state too.
+                continue
+            if mailbox in self._journals:
+                self._journals[mailbox].close()
+                del self._journals[mailbox]
+            try:
+                os.rename(journal, journal + '.old')
+            except OSError:
+                # No journal yet
+                pass
+            self._openjournal(mailbox)
+        self._journalrecords = 0
+        self._snapshotneeded = False
+        self._compactor = threading.Thread(target=self._writeoldmailfiles,
+                                           args=(state, mailboxes, journals))
+        self._compactor.start()
+
+    def _finishcompaction(self):
+        '''Wait for a compaction started by _compact() to finish.
+
+        Called at the end of the session, as the process may then leave
+        through os._exit(), which would kill the thread part way through.
+        '''
+        self.log.trace()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
 
-    def write_oldmailfile(self, forget_deleted=True):
-        '''Write oldmail info to oldmail file.'''
+    def _writeoldmailfiles(self, state, mailboxes, journals):
+        '''Write state to the oldmail files, then remove the journals it
+        includes.'''
         self.log.trace()
-        if (self.__oldmail_written or not self.__initialized
-                or not self.gotmsglist):
-            return
-        mailboxes = self.conf.get('mailboxes', (None,))
         wrote = {}
-        for mailbox in mailboxes:
-            wrote[mailbox] = 0
         f = {}
         try:
             # Write each folders msgids/data to a separate oldmail file.
             for mailbox in mailboxes:
-                filename = self.oldmail_filename
-                if mailbox:
-                    filename += '-' + re.sub(STRIP_CHAR_RE, '.', mailbox)
-                f[mailbox] = updatefile(filename)
-            msgids = frozenset(
-                self.__delivered.keys()
-            ).union(frozenset(self.oldmail.keys()))
-            for msgid in msgids:
-                self.log.debug('msgid %s ...' % msgid)
-                if forget_deleted and msgid in self.deleted:
-                    # Already deleted, don't remember this one
-                    self.log.debug(' was deleted, skipping' + os.linesep)
-                    continue
-                # else:
-                # not deleted, remember this one's time stamp
-                t = self.oldmail.get(msgid, self.timestamp)
-                self.log.debug(' timestamp %s' % t + os.linesep)
-                mailbox = None
-                match = re.match('^\d+/(.+?)/\d+$', msgid)
-                if match:
-                    mailbox = match.group(1)
-                if mailbox in mailboxes:
+                wrote[mailbox] = 0
+                f[mailbox] = updatefile(self._oldmailfilename(mailbox))
+            for (msgid, t) in state.iteritems():
+                mailbox = self._msgidmailbox(msgid)
+                if mailbox in f:
                     f[mailbox].write('%s\0%i%s' % (msgid, t, os.linesep))
                     wrote[mailbox] += 1
                 else:
@@ -485,16 +726,68 @@ class RetrieverSkeleton(ConfigurableBase):
                 mailbox_logstr = ''
                 if mailbox != None:
                     mailbox_logstr = 'mailbox %s in ' % mailbox
-                self.log.moreinfo('wrote %i uids for %s%s%s'
-                                  % (wrote[mailbox], mailbox_logstr, self, 
-                                     os.linesep))
-        except IOError, o:
+                self.log.moreinfo('wrote %i uids for %s%s%s', wrote[mailbox],
+                                  mailbox_logstr, self, os.linesep)
+            for journal in journals:
+                try:
+                    os.unlink(journal)
+                except OSError:
+                    pass
+        except (IOError, OSError), o:
             self.log.error('failed writing oldmail file for %s (%s)'
                            % (self, o) + os.linesep)
-            for file in f:
+            for file in f.values():
                 file.abort()
+
+    def write_oldmailfile(self, forget_deleted=True):
+        '''Save oldmail info.
+
+        Deleted messages are recorded in the journal (unless forget_deleted
+        is False, when the deletions may not have taken effect), and the
+        journal is synced to disk.  The oldmail files are rewritten from the
+        journal in the background if it has grown large.
+        '''
+        self.log.trace()
+        if (self.__oldmail_written or not self.__initialized
+                or not self.gotmsglist):
+            return
+        if forget_deleted:
+            for msgid in self.deleted:
+                self._journal(msgid)
+        try:
+            self._syncjournals()
+        except (IOError, OSError), o:
+            self.log.error('failed syncing oldmail journal for %s (%s)'
+                           % (self, o) + os.linesep)
+            self._snapshotneeded = True
+        if (self._snapshotneeded
+                or (self._journalrecords >= JOURNAL_COMPACT_RECORDS
+                    and self._journalrecords > len(self.oldmail))):
+            self._compact(forget_deleted)
         self.__oldmail_written = True
 
+    def checkpoint(self):
+        '''Save oldmail state in the middle of a session.
+
+        Delivered messages are remembered with the current time and deleted
+        ones are forgotten, and the next checkpoint or write_oldmailfile()
+        call saves the oldmail state again.
+        '''
+        self.log.trace()
+        self.timestamp = int(time.time())
+        self._notretrieving = {}
+        self.__oldmail_written = False
+        self.write_oldmailfile()
+        for msgid in self.__delivered:
+            if not msgid in self.oldmail:
+                self.oldmail[msgid] = self.timestamp
+        for msgid in self.deleted:
+            if msgid in self.oldmail:
+                del self.oldmail[msgid]
+        self.__delivered = {}
+        self.deleted = {}
+        self.__oldmail_written = False
+
     def initialize(self, options):
         # Options - dict of application-wide settings, including ones that 
         # aren't used in initializing the retriever.
@@ -523,6 +816,49 @@ class RetrieverSkeleton(ConfigurableBase):
 
     def delivered(self, msgid):
         self.__delivered[msgid] = None
+        self._journal(msgid, self.oldmail.get(msgid, self.timestamp))
+
+    def _willretrieve(self, msgid):
+        '''Guess whether the application will retrieve msgid, going by the
+        options it initialized the retriever with.  Used to read ahead.'''
+        options = self.app_options or {}
+        if msgid in self._notretrieving:
+            return False
+        if not options.get('read_all', True) and msgid in self.oldmail:
+            return False
+        if (options.get('max_message_size')
+                and self.msgsizes.get(msgid, 0) > options['max_message_size']):
+            return False
+        return True
+
+    def _spoolsize(self, size):
+        '''Return True if a message of size octets should be retrieved into
+        a spool file rather than into memory.'''
+        limit = (self.app_options or {}).get('max_in_memory_message_size', 0)
+        return bool(limit and size > limit)
+
+    def not_retrieving(self, msgid):
+        '''Tell the retriever that the application has decided not to
+        retrieve msgid, so that it isn't read ahead.'''
+        self._notretrieving[msgid] = None
+        self._skipped[msgid] = None
+
+    def was_delivered(self, msgid):
+        return msgid in self.__delivered
+
+    def was_skipped(self, msgid):
+        '''Return True if the application will not retrieve msgid in this or
+        any later session with the same options:  it said so with
+        not_retrieving(), or the message is larger than max_message_size or
+        max_bytes_per_session.'''
+        if msgid in self._skipped:
+            return True
+        options = self.app_options or {}
+        size = self.msgsizes.get(msgid, 0)
+        for name in ('max_message_size', 'max_bytes_per_session'):
+            if options.get(name) and size > options[name]:
+                return True
+        return False
 
     def getheader(self, msgid):
         if not self.__initialized:
@@ -531,9 +867,54 @@ class RetrieverSkeleton(ConfigurableBase):
             self.headercache[msgid] = self._getheaderbyid(msgid)
         return self.headercache[msgid]
 
+    def _getheadersbyid(self, msgids, keep):
+        self.log.trace()
+        headers = {}
+        for msgid in msgids:
+            try:
+                header = self._getheaderbyid(msgid)
+            except getmailRetrievalError, o:
+                self.log.debug('no header for msgid %s (%s)%s', msgid, o,
+                               os.linesep)
+                continue
+            if keep(msgid, header):
+                headers[msgid] = header
+        return headers
+
+    def getheaders(self, msgids, keep=None):
+        '''Return a dictionary of the headers of msgids, as header-only
+        Message() objects, retrieving those not already in the header cache
+        in bulk where the protocol allows.  Messages whose header the server
+        fails to provide are left out.
+
+        If keep is given, it is called with each msgid and header as the
+        header is retrieved (or found in the cache), and only the headers it
+        returns True for are returned and cached, so that the others need
+        not all be held at once.'''
+        if not self.__initialized:
+            raise getmailOperationError('not initialized')
+        if keep is None:
+            keep = lambda msgid, header: True
+        headers = {}
+        wanted = []
+        for msgid in msgids:
+            if not msgid in self.headercache:
+                wanted.append(msgid)
+            elif keep(msgid, self.headercache[msgid]):
+                headers[msgid] = self.headercache[msgid]
+            else:
+                del self.headercache[msgid]
+        if wanted:
+            retrieved = self._getheadersbyid(wanted, keep)
+            self.headercache.update(retrieved)
+            headers.update(retrieved)
+        return headers
+
     def getmsg(self, msgid):
         if not self.__initialized:
             raise getmailOperationError('not initialized')
+        # The whole message supersedes any header retrieved earlier
+        self.headercache.pop(msgid, None)
         return self._getmsgbyid(msgid)
 
     def getmsgsize(self, msgid):
@@ -553,10 +934,23 @@ class RetrieverSkeleton(ConfigurableBase):
 #######################################
 class POP3RetrieverBase(RetrieverSkeleton):
     '''Base class for single-user POP3 mailboxes.
+
+    If the pipelining_window parameter is set and the server advertises
+    PIPELINING in its CAPA response (RFC 2449), RETR, TOP and DELE commands
+    are pipelined:  retrieving a message also sends RETR commands for the
+    messages the application is expected to retrieve next, keeping up to
+    that many commands outstanding, and responses are read back in order as
+    they are needed.  Servers without CAPA or PIPELINING get one command at a
+    time as before.
     '''
     def __init__(self, **args):
         RetrieverSkeleton.__init__(self, **args)
         self.log.trace()
+        self._pipelinewindow = 0
+        self._pipeline = []
+        self._pipelineresults = {}
+        self._msgindex = None
+        self._readaheadnext = 0
 
     def __del__(self):
         RetrieverSkeleton.__del__(self)
@@ -571,8 +965,8 @@ class POP3RetrieverBase(RetrieverSkeleton):
         self.log.trace()
         try:
             response, msglist, octets = self.conn.uidl()
-            self.log.debug('UIDL response "%s", %d octets'
-                           % (response, octets) + os.linesep)
+            self.log.debug('UIDL response "%s", %d octets%s', response, octets,
+                           os.linesep)
             for (i, line) in enumerate(msglist):
                 try:
                     (msgnum, msgid) = line.split(None, 1)
@@ -590,8 +984,8 @@ class POP3RetrieverBase(RetrieverSkeleton):
                     # Server is broken.
                     if self.conf.get('delete_dup_msgids', False):
                         self.log.debug('deleting message %s with duplicate '
-                                       'msgid %s' % (msgnum, msgid)
-                                       + os.linesep)
+                                       'msgid %s%s',
+                                       msgnum, msgid, os.linesep)
                         self.conn.dele(msgnum)
                     else:
                         raise getmailOperationError(
@@ -603,8 +997,9 @@ class POP3RetrieverBase(RetrieverSkeleton):
                 else:
                     self.msgnum_by_msgid[msgid] = msgnum
                     self.msgid_by_msgnum[msgnum] = msgid
-            self.log.debug('Message IDs: %s'
-                           % sorted(self.msgnum_by_msgid.keys()) + os.linesep)
+            if self.log.isEnabledFor(DEBUG):
+                self.log.debug('Message IDs: %s%s',
+                               sorted(self.msgnum_by_msgid.keys()), os.linesep)
             self.sorted_msgnum_msgid = sorted(self.msgid_by_msgnum.items())
             response, msglist, octets = self.conn.list()
             for line in msglist:
@@ -619,19 +1014,147 @@ class POP3RetrieverBase(RetrieverSkeleton):
             )
         self.gotmsglist = True
 
+    def _getcapabilities(self):
+        '''Return the server's CAPA capability names, upper-cased, or an
+        empty list if it doesn't support CAPA.'''
+        self.log.trace()
+        try:
+            response, lines, octets = self.conn._longcmd('CAPA')
+        except poplib.error_proto, o:
+            self.log.debug('CAPA not supported (%s)%s', o, os.linesep)
+            return []
+        self.log.debug('CAPA response %s%s', lines, os.linesep)
+        return [line.split()[0].upper() for line in lines if line.strip()]
+
+    def _pipelinesend(self, key, command, msgid):
+        '''Send a command without waiting for its response.  key is
+        (command name, message number).'''
+        self.log.trace()
+        self.conn._putcmd(command)
+        self._pipeline.append((key, msgid))
+
+    def _pipelineread(self):
+        '''Read the response to the oldest outstanding pipelined command.'''
+        self.log.trace()
+        ((cmd, msgnum), msgid) = self._pipeline.pop(0)
+        try:
+            if cmd == 'DELE':
+                self.conn._getresp()
+            elif cmd == 'RETR':
+                self._pipelineresults[(cmd, msgnum)] = self._retrresp(msgid)
+            else:
+                self._pipelineresults[(cmd, msgnum)] = (
+                    self.conn._getlongresp()
+                )
+        except poplib.error_proto, o:
+            if cmd == 'DELE':
+                # Too late to raise this to the caller; keep the message
+                # in the oldmail file instead.
+                self.log.error('failed to delete msgid %s; server said %s'
+                               % (msgid, o) + os.linesep)
+                if msgid in self.deleted:
+                    del self.deleted[msgid]
+            else:
+                self._pipelineresults[(cmd, msgnum)] = o
+
+    def _pipelineresult(self, key):
+        '''Read responses until the one for pipelined command key has
+        arrived, and return it.'''
+        self.log.trace()
+        while not key in self._pipelineresults:
+            if not self._pipeline:
+                raise getmailOperationError('no pipelined command %s %s'
+                                            % key)
+            self._pipelineread()
+        result = self._pipelineresults.pop(key)
+        if isinstance(result, poplib.error_proto):
+            raise result
+        return result
+
+    def _drainpipeline(self):
+        '''Read all outstanding pipelined responses, so that another command
+        can be issued.'''
+        while self._pipeline:
+            self._pipelineread()
+
+    def _pipelined(self, key):
+        for (_key, unused) in self._pipeline:
+            if _key == key:
+                return True
+        return key in self._pipelineresults
+
+    def _readahead(self, msgid):
+        '''Pipeline RETR for the messages expected to be retrieved after
+        msgid while the window has room.'''
+        self.log.trace()
+        if self._msgindex is None:
+            self._msgindex = {}
+            for (i, (msgnum, _msgid)) in enumerate(self.sorted_msgnum_msgid):
+                self._msgindex[_msgid] = i
+        i = max(self._readaheadnext, self._msgindex[msgid] + 1)
+        while (len(self._pipeline) < self._pipelinewindow
+                and i < len(self.sorted_msgnum_msgid)):
+            (msgnum, _msgid) = self.sorted_msgnum_msgid[i]
+            i += 1
+            if (self._willretrieve(_msgid)
+                    and not self._pipelined(('RETR', msgnum))):
+                self._pipelinesend(('RETR', msgnum), 'RETR %s' % msgnum,
+                                   _msgid)
+        self._readaheadnext = i
+
+    def _retrresp(self, msgid):
+        '''Read the response to a RETR command for msgid, as
+        poplib.POP3.retr() returns it.  A message larger than the
+        max_in_memory_message_size option is written line by line to a spool
+        file, which is returned in place of the list of lines.'''
+        self.log.trace()
+        if not self._spoolsize(self.msgsizes.get(msgid, 0)):
+            return self.conn._getlongresp()
+        self.log.debug('spooling msgid %s (%d octets)%s', msgid,
+                       self.msgsizes[msgid], os.linesep)
+        response = self.conn._getresp()
+        spool = tempfile.TemporaryFile()
+        octets = 0
+        (line, o) = self.conn._getline()
+        while line != '.':
+            if line[:2] == '..':
+                o -= 1
+                line = line[1:]
+            octets += o
+            spool.write(line + os.linesep)
+            (line, o) = self.conn._getline()
+        return (response, spool, octets)
+
     def _delmsgbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
+        if self._pipelinewindow:
+            self._pipelinesend(('DELE', msgnum), 'DELE %s' % msgnum, msgid)
+            return
         self.conn.dele(msgnum)
 
     def _getmsgbyid(self, msgid):
-        self.log.debug('msgid %s' % msgid + os.linesep)
+        self.log.debug('msgid %s%s', msgid, os.linesep)
         msgnum = self._getmsgnumbyid(msgid)
-        self.log.debug('msgnum %i' % msgnum + os.linesep)
+        self.log.debug('msgnum %i%s', msgnum, os.linesep)
         try:
-            response, lines, octets = self.conn.retr(msgnum)
-            self.log.debug('RETR response "%s", %d octets'
-                           % (response, octets) + os.linesep)
+            if self._pipelinewindow:
+                if not self._pipelined(('RETR', msgnum)):
+                    self._pipelinesend(('RETR', msgnum), 'RETR %s' % msgnum,
+                                       msgid)
+                self._readahead(msgid)
+                response, lines, octets = self._pipelineresult(('RETR',
+                                                                msgnum))
+                # Keep the window full while this message is processed
+                self._readahead(msgid)
+            else:
+                self.conn._putcmd('RETR %s' % msgnum)
+                response, lines, octets = self._retrresp(msgid)
+            self.log.debug('RETR response "%s", %d octets%s', response, octets,
+                           os.linesep)
+            if type(lines) != list:
+                # Spooled
+                return Message(fromspool=lines)
             msg = Message(fromlines=lines)
             return msg
         except poplib.error_proto, o:
@@ -643,9 +1166,40 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def _getheaderbyid(self, msgid):
         self.log.trace()
         msgnum = self._getmsgnumbyid(msgid)
-        response, headerlist, octets = self.conn.top(msgnum, 0)
-        parser = email.Parser.HeaderParser()
-        return parser.parsestr(os.linesep.join(headerlist))
+        if self._pipelinewindow:
+            if not self._pipelined(('TOP', msgnum)):
+                self._pipelinesend(('TOP', msgnum), 'TOP %s 0' % msgnum,
+                                   msgid)
+            response, headerlist, octets = self._pipelineresult(('TOP',
+                                                                 msgnum))
+        else:
+            response, headerlist, octets = self.conn.top(msgnum, 0)
+        return Message(fromlines=headerlist)
+
+    def _getheadersbyid(self, msgids, keep):
+        '''Retrieve headers with TOP, keeping up to pipelining_window TOP
+        commands outstanding if the server supports pipelining.'''
+        self.log.trace()
+        headers = {}
+        sent = 0
+        for (i, msgid) in enumerate(msgids):
+            while (self._pipelinewindow and sent < len(msgids)
+                    and sent - i < self._pipelinewindow):
+                msgnum = self._getmsgnumbyid(msgids[sent])
+                if not self._pipelined(('TOP', msgnum)):
+                    self._pipelinesend(('TOP', msgnum), 'TOP %s 0' % msgnum,
+                                       msgids[sent])
+                sent += 1
+            try:
+                header = self._getheaderbyid(msgid)
+            except poplib.error_proto, o:
+                # TOP is optional; the message will be retrieved whole
+                self.log.debug('TOP failed for msgid %s (%s)%s', msgid, o,
+                               os.linesep)
+                continue
+            if keep(msgid, header):
+                headers[msgid] = header
+        return headers
 
     def initialize(self, options):
         self.log.trace()
@@ -662,22 +1216,32 @@ class POP3RetrieverBase(RetrieverSkeleton):
             else:
                 self.conn.user(self.conf['username'])
                 self.conn.pass_(self.conf['password'])
+            if self.conf.get('pipelining_window', 0) > 0:
+                if 'PIPELINING' in self._getcapabilities():
+                    self._pipelinewindow = self.conf['pipelining_window']
+                    self.log.debug('pipelining up to %d commands%s',
+                                   self._pipelinewindow, os.linesep)
+                else:
+                    self.log.debug('server does not support PIPELINING'
+                                   + os.linesep)
             self._getmsglist()
-            self.log.debug('msgids: %s'
-                           % sorted(self.msgnum_by_msgid.keys()) + os.linesep)
-            self.log.debug('msgsizes: %s' % self.msgsizes + os.linesep)
+            if self.log.isEnabledFor(DEBUG):
+                self.log.debug('msgids: %s%s',
+                               sorted(self.msgnum_by_msgid.keys()), os.linesep)
+            self.log.debug('msgsizes: %s%s', self.msgsizes, os.linesep)
             # Remove messages from state file that are no longer in mailbox
             for msgid in self.oldmail.keys():
                 if not self.msgsizes.has_key(msgid):
-                    self.log.debug('removing vanished message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+                    self.log.debug('removing vanished message id %s%s', msgid,
+                                   os.linesep)
+                    self._forget(msgid)
         except poplib.error_proto, o:
             raise getmailOperationError('POP error (%s)' % o)
 
     def abort(self):
         self.log.trace()
         try:
+            self._drainpipeline()
             self.conn.rset()
             self.conn.quit()
         except (poplib.error_proto, socket.error), o:
@@ -687,9 +1251,11 @@ class POP3RetrieverBase(RetrieverSkeleton):
     def quit(self):
         self.log.trace()
         self.write_oldmailfile()
+        self._finishcompaction()
         if not getattr(self, 'conn', None):
             return
         try:
+            self._drainpipeline()
             self.conn.quit()
             self.conn = None
         except (poplib.error_proto, socket.error), o:
@@ -757,15 +1323,266 @@ class MultidropPOP3RetrieverBase(POP3RetrieverBase):
         msg.recipient = address_no_brackets(line.strip())
         return msg
 
+#######################################
+class IMAPBackfill(object):
+    '''Retrieve messages from one mailbox of an IMAPRetrieverBase over several
+    extra connections at once.
+
+    msgids are split into chunks of BACKFILL_CHUNK_MESSAGES consecutive
+    messages, and each connection thread fetches the next chunk nobody has
+    taken yet with one UID FETCH command, from the mailbox EXAMINEd
+    read-only.  The threads stop taking chunks while two chunks per
+    connection have been fetched but not asked for, so the messages held at
+    once stay bounded.  get() waits for a message and hands it over;
+    messages it is not asked for before a later one are thrown away.  A
+    message whose chunk failed is not retried here, and get() returns None
+    for it.
+    '''
+    def __init__(self, retriever, mailbox, msgids, conns):
+        self.log = retriever.log
+        self.log.trace()
+        self.retriever = retriever
+        self.mailbox = mailbox
+        self.uidvalidity = retriever.uidvalidity
+        self.msgids = msgids
+        self.position = {}
+        for (i, msgid) in enumerate(msgids):
+            self.position[msgid] = i
+        self.nextchunk = 0
+        self.nchunks = ((len(msgids) + BACKFILL_CHUNK_MESSAGES - 1)
+                        // BACKFILL_CHUNK_MESSAGES)
+        self.done = {}
+        self.fetched = {}
+        # Position of the next message expected to be asked for
+        self.consumed = 0
+        self.limit = 2 * len(conns) * BACKFILL_CHUNK_MESSAGES
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.running = len(conns)
+        self.threads = []
+        for conn in conns:
+            thread = threading.Thread(target=self._run, args=(conn, ))
+            thread.setDaemon(True)
+            self.threads.append(thread)
+            thread.start()
+
+    def _run(self, conn):
+        try:
+            try:
+                typ, data = conn.select(self.mailbox, True)
+                if typ != 'OK':
+                    raise getmailOperationError('EXAMINE returned %s' % data)
+                uidvalidity = conn.response('UIDVALIDITY')[1][0]
+                if uidvalidity != self.uidvalidity:
+                    raise getmailOperationError('UIDVALIDITY changed')
+                while True:
+                    self.cond.acquire()
+                    try:
+                        while (len(self.fetched) >= self.limit
+                                and not self.stopping):
+                            self.cond.wait()
+                        if self.stopping or self.nextchunk >= self.nchunks:
+                            break
+                        n = self.nextchunk
+                        self.nextchunk += 1
+                    finally:
+                        self.cond.release()
+                    try:
+                        self._fetchchunk(conn, n)
+                    finally:
+                        self.cond.acquire()
+                        self.done[n] = None
+                        self.cond.notifyAll()
+                        self.cond.release()
+            except (getmailOperationError, imaplib.IMAP4.error,
+                    socket.error), o:
+                self.log.warning('backfill of mailbox "%s" lost a connection'
+                                 ' (%s)%s' % (self.mailbox, o, os.linesep))
+        finally:
+            try:
+                conn.logout()
+            except (imaplib.IMAP4.error, socket.error), o:
+                pass
+            self.cond.acquire()
+            self.running -= 1
+            self.cond.notifyAll()
+            self.cond.release()
+
+    def _fetchchunk(self, conn, n):
+        '''Fetch chunk n of the messages over conn.'''
+        msgids = self.msgids[n * BACKFILL_CHUNK_MESSAGES:
+                             (n + 1) * BACKFILL_CHUNK_MESSAGES]
+        uids = [self.retriever._mboxuids[msgid][1] for msgid in msgids]
+        self.log.debug('backfill fetching UIDs %s%s',
+                       self.retriever._uidset(uids), os.linesep)
+        results = self.retriever._uidfetch(self.retriever._uidset(uids),
+                                           '(UID RFC822)', conn)
+        self.cond.acquire()
+        try:
+            for items in results:
+                if not (items.get('UID') and items.get('RFC822')):
+                    continue
+                msgid = '%s/%s/%s' % (self.uidvalidity, self.mailbox,
+                                      items['UID'])
+                if self.position.get(msgid, -1) >= self.consumed:
+                    self.fetched[msgid] = items['RFC822']
+                elif not isinstance(items['RFC822'], str):
+                    items['RFC822'].close()
+        finally:
+            self.cond.release()
+
+    def _discard(self, msgid):
+        data = self.fetched.pop(msgid, None)
+        if data is not None and not isinstance(data, str):
+            data.close()
+
+    def get(self, msgid):
+        '''Wait for msgid to be fetched and return its content, or None if
+        it isn't going to be.'''
+        if not msgid in self.position:
+            return None
+        i = self.position[msgid]
+        n = i // BACKFILL_CHUNK_MESSAGES
+        self.cond.acquire()
+        try:
+            if i < self.consumed:
+                # Already passed over and thrown away
+                return None
+            while self.consumed < i:
+                self._discard(self.msgids[self.consumed])
+                self.consumed += 1
+            self.cond.notifyAll()
+            # msgid itself is only consumed once it is handed over, so its
+            # chunk keeps it if it arrives while we wait
+            while (not msgid in self.fetched and not n in self.done
+                    and (n < self.nextchunk or self.running)):
+                self.cond.wait()
+            self.consumed = i + 1
+            data = self.fetched.pop(msgid, None)
+            self.cond.notifyAll()
+            return data
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        '''Stop the connection threads once their current chunks are done,
+        and throw away anything not asked for.'''
+        self.log.trace()
+        self.cond.acquire()
+        self.stopping = True
+        self.cond.notifyAll()
+        self.cond.release()
+        for thread in self.threads:
+            thread.join()
+        for msgid in self.fetched.keys():
+            self._discard(msgid)
+
 #######################################
 class IMAPRetrieverBase(RetrieverSkeleton):
     '''Base class for single-user IMAP mailboxes.
+
+    If the incremental_sync parameter is set, the UIDVALIDITY and UIDNEXT
+    values of each mailbox are saved in a state file next to the oldmail
+    file, and subsequent sessions only list messages with UIDs from the saved
+    UIDNEXT onwards.  A full listing is done only when the mailbox UIDVALIDITY
+    changes.  Note that messages below the saved UIDNEXT are then never looked
+    at again, so delete_after will not apply to them.
+
+    If the search parameter is set to IMAP SEARCH criteria (for instance,
+    "UNSEEN LARGER 10000 SINCE 1-Oct-2026"), each mailbox is listed with
+    UID SEARCH, and UIDs and sizes are only fetched for the matching
+    messages.  Other messages are treated as if they weren't in the mailbox
+    at all.
+
+    For long-running sessions, idle() waits with IMAP IDLE until a mailbox
+    changes, and listnew() lists only messages which arrived since the
+    mailbox was last listed.
+
+    If the fetch_batch_size parameter is set, retrieving a message also
+    requests the following messages in the same mailbox which the
+    application is expected to retrieve, up to that many bytes in total, with
+    a single UID FETCH command.  The response is read as a stream, so each
+    message is returned as soon as it has arrived; other commands wait until
+    the rest of the batch has been read.
+
+    If the backfill_connections parameter is set, a mailbox with at least
+    BACKFILL_MIN_MESSAGES messages to retrieve (such as one being retrieved
+    for the first time) is backfilled:  that many more connections are opened
+    (or as many as the server allows), each EXAMINEs the mailbox, and they
+    fetch the messages in chunks of consecutive UIDs in parallel (see
+    IMAPBackfill).  Messages are still handed to the application, delivered
+    and deleted in order over the main connection, and each delivery is
+    journalled to the oldmail file as usual, so an interrupted backfill
+    resumes where it stopped.  Messages retrieved part by part (see below)
+    are left out of the backfill.
+
+    The mailboxes are listed last to first, so that the first one is still
+    selected when retrieval starts, and messages are retrieved mailbox by
+    mailbox.  If the mailbox_connections parameter is set, getmail instead
+    runs a separate session for each mailbox, each with its own connection,
+    all at the same time (except with --idle); each mailbox is then selected
+    just once.  How long each mailbox was selected for, and how many messages
+    were retrieved from it, is logged at the end of the session.
+
+    Deletions are queued per mailbox and carried out delete_batch_size
+    messages at a time, with one UID MOVE (for move_on_delete, if the server
+    supports MOVE) or UID STORE (after UID COPY for move_on_delete) command
+    per mailbox.  The queue is also flushed before another mailbox is
+    selected, at checkpoints and at the end of the session.  A message is
+    only recorded as deleted in the oldmail file once its deletion command
+    has succeeded.
+
+    Unless the use_compression parameter is turned off, the connection is
+    compressed with COMPRESS=DEFLATE (RFC 4978) after logging in, if the
+    server supports it.  The number of bytes transferred before and after
+    compression is logged at the end of the session.
+
+    If the use_binary parameter is set and the server supports the BINARY
+    extension (RFC 3516), messages with base64-encoded parts (or a
+    base64-encoded body) are retrieved part by part as described below, and
+    those parts are fetched decoded with BINARY.PEEK, saving the encoding
+    overhead on the wire.  They are encoded again locally, so destinations
+    still get the message in its RFC 822 form (although the base64 line
+    length may differ from the original).
+
+    If the fetch_content_types parameter is set (for instance, to
+    "('image/jpeg', )"), the BODYSTRUCTURE of the messages about to be
+    retrieved is fetched first, SEARCH_FETCH_UIDS messages at a time, and
+    only the header of each multipart message and the MIME parts with one of
+    those content types (or a type/* pattern) are downloaded.  The
+    message is then put back together with its original MIME boundaries, and
+    each of the other parts is replaced by a short text/plain placeholder
+    giving its content type and size.  The preamble and epilogue of multipart
+    bodies are not kept.  Messages which are not multipart, or in which every
+    part would be kept, are retrieved whole, with fetch_batch_size and
+    backfill_connections as usual.
     '''
     def __init__(self, **args):
         RetrieverSkeleton.__init__(self, **args)
         self.log.trace()
         self.mailbox = None
         self.uidvalidity = None
+        self.uidnext = None
+        self._uidstate = {}
+        self._listedstate = {}
+        self._nextlisted = {}
+        self.__uidstate_written = False
+        self._msgindex = None
+        self._fetchtag = None
+        self._fetchmailbox = None
+        self._fetched = {}
+        # Parts to fetch of messages whose BODYSTRUCTURE has been fetched;
+        # None for messages to be retrieved whole
+        self._plans = {}
+        self._deletes = {}
+        self._deletecount = 0
+        # Mailboxes with messages flagged \Deleted but not yet expunged
+        self._expunge = {}
+        self._deflate = None
+        self._backfill = None
+        self._backfilled = {}
+        self._selected = None
+        self._mailboxstats = {}
         self.gss_step = 0
         self.gss_vc = None
         self.gssapi = False
@@ -814,6 +1631,7 @@ class IMAPRetrieverBase(RetrieverSkeleton):
 
     def _parse_imapcmdresponse(self, cmd, *args):
         self.log.trace()
+        self._endfetch()
         try:
             result, resplist = getattr(self.conn, cmd)(*args)
         except imaplib.IMAP4.error, o:
@@ -824,17 +1642,15 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 % ('%s %s' % (cmd, args), result, resplist)
             )
         if cmd.lower().startswith('login'):
-            self.log.debug('login command response %s' % resplist + os.linesep)
+            self.log.debug('login command response %s%s', resplist, os.linesep)
         else:
-            self.log.debug(
-                'command %s response %s'
-                % ('%s %s' % (cmd, args), resplist)
-                + os.linesep
-            )
+            self.log.debug('command %s response %s%s', '%s %s' % (cmd, args),
+                           resplist, os.linesep)
         return resplist
 
     def _parse_imapuidcmdresponse(self, cmd, *args):
         self.log.trace()
+        self._endfetch()
         try:
             result, resplist = self.conn.uid(cmd, *args)
         except imaplib.IMAP4.error, o:
@@ -844,13 +1660,13 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 'IMAP error (command %s returned %s %s)'
                 % ('%s %s' % (cmd, args), result, resplist)
             )
-        self.log.debug('command uid %s response %s'
-                       % ('%s %s' % (cmd, args), resplist) + os.linesep)
+        self.log.debug('command uid %s response %s%s', '%s %s' % (cmd, args),
+                       resplist, os.linesep)
         return resplist
 
     def _parse_imapattrresponse(self, line):
-        self.log.trace('parsing attributes response line %s' % line
-                       + os.linesep)
+        self.log.trace('parsing attributes response line %s%s', line,
+                       os.linesep)
         r = {}
         try:
             parts = line[line.index('(') + 1:line.rindex(')')].split()
@@ -872,17 +1688,23 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             raise getmailOperationError(
                 'IMAP error (failed to parse UID response line "%s")' % line
             )
-        self.log.trace('got %s' % r + os.linesep)
+        self.log.trace('got %s%s', r, os.linesep)
         return r
 
     def _selectmailbox(self, mailbox):
         self.log.trace()
         if mailbox == self.mailbox:
             return
+        self._endfetch()
         if self.mailbox is not None:
             # Close current mailbox so deleted mail is expunged.
+            self._flushdeletes(self.mailbox)
             self.conn.close()
-        self.log.debug('selecting mailbox "%s"' % mailbox + os.linesep)
+            if self.mailbox in self._expunge:
+                del self._expunge[self.mailbox]
+            self._deselected()
+        self.log.debug('selecting mailbox "%s"%s', mailbox, os.linesep)
+        selected = time.time()
         try:
             #response = self._parse_imapcmdresponse('SELECT', mailbox)
             #count = int(response[-1]) # use *last* EXISTS returned
@@ -893,6 +1715,11 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             status, count = self.conn.select(mailbox, read_only)
             count = int(count[-1])
             uidvalidity = self.conn.response('UIDVALIDITY')[1][0]
+            try:
+                uidnext = int(self.conn.response('UIDNEXT')[1][-1])
+            except (TypeError, ValueError):
+                # Server didn't supply UIDNEXT in the SELECT response
+                uidnext = None
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
         except (IndexError, ValueError), o:
@@ -900,61 +1727,401 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 'IMAP server failed to return correct SELECT response (%s)'
                 % response
             )
-        self.log.debug('select(%s) returned message count of %d'
-                       % (mailbox, count) + os.linesep)
+        self.log.debug('select(%s) returned message count of %d%s', mailbox,
+                       count, os.linesep)
         self.mailbox = mailbox
         self.uidvalidity = uidvalidity
+        self.uidnext = uidnext
+        self._selected = selected
+        self._mailboxstats.setdefault(mailbox, [0, 0.0, 0])[0] += 1
         return count
 
+    def _deselected(self):
+        '''Add the time since the current mailbox was selected to its
+        statistics.'''
+        if self._selected is None:
+            return
+        self._mailboxstats[self.mailbox][1] += time.time() - self._selected
+        self._selected = None
+
+    def _logmailboxstats(self):
+        '''Log the number of times each mailbox was selected, for how long
+        in total, and the number of messages retrieved from it.'''
+        if (self.app_options or {}).get('verbose', 0) > 1:
+            log = self.log.info
+        else:
+            log = self.log.debug
+        for mailbox in self.conf['mailboxes']:
+            if not mailbox in self._mailboxstats:
+                continue
+            (selections, seconds, retrieved) = self._mailboxstats[mailbox]
+            log('  mailbox "%s": selected %d times for %.2f seconds, %d '
+                'messages retrieved%s' % (mailbox, selections, seconds,
+                                          retrieved, os.linesep))
+
+    def _read_uidstatefile(self):
+        '''Read saved UIDVALIDITY and UIDNEXT values for incremental sync,
+        and return them in a dictionary keyed by mailbox.'''
+        self.log.trace()
+        state = {}
+        try:
+            for line in open(self.uidstate_filename, 'rb'):
+                line = line.strip()
+                try:
+                    (mailbox, uidvalidity, uidnext) = line.split('\0')
+                    state[mailbox] = (uidvalidity, int(uidnext))
+                except ValueError:
+                    # malformed
+                    self.log.info(
+                        'skipped malformed line "%r" for %s%s'
+                        % (line, self, os.linesep)
+                    )
+        except IOError:
+            self.log.moreinfo('no uidstate file for %s%s', self, os.linesep)
+        return state
+
+    def _write_uidstatefile(self):
+        '''Save the UIDVALIDITY and UIDNEXT values to resume listing from.
+
+        The saved UIDNEXT is the lowest UID listed this session which was
+        neither delivered nor previously seen, so messages left unretrieved
+        because the session ended early, failed or reached
+        max_bytes_per_session are listed again next time.  Messages which
+        will never be retrieved with the current options (see was_skipped())
+        don't hold it back.
+        '''
+        self.log.trace()
+        if self.__uidstate_written or not self.gotmsglist:
+            return
+        pending = {}
+        highest = {}
+        for msgid in self._mboxuidorder:
+            (mailbox, uid) = self._mboxuids[msgid]
+            uid = int(uid)
+            highest[mailbox] = max(highest.get(mailbox, 0), uid)
+            if (msgid in self.oldmail or msgid in self.deleted
+                    or self.was_delivered(msgid) or self.was_skipped(msgid)):
+                continue
+            pending[mailbox] = min(pending.get(mailbox, uid), uid)
+        try:
+            # Sessions for other mailboxes (see mailbox_connections) may be
+            # updating the file at the same time, so it is locked and read
+            # again, and only the mailboxes listed here are changed.
+            lockfile = open(self.uidstate_filename + '.lock', 'ab')
+            lock_file(lockfile, 'flock')
+            try:
+                state = self._read_uidstatefile()
+                for (mailbox, (uidvalidity, uidnext)) in \
+                        self._listedstate.items():
+                    if mailbox in pending:
+                        uidnext = pending[mailbox]
+                    elif uidnext is None and mailbox in highest:
+                        uidnext = highest[mailbox] + 1
+                    if uidnext is None:
+                        continue
+                    state[mailbox] = (uidvalidity, uidnext)
+                f = updatefile(self.uidstate_filename)
+                for (mailbox, (uidvalidity, uidnext)) in state.items():
+                    f.write('%s\0%s\0%i%s' % (mailbox, uidvalidity, uidnext,
+                                               os.linesep))
+                f.close()
+            finally:
+                unlock_file(lockfile, 'flock')
+                lockfile.close()
+        except IOError, o:
+            self.log.error('failed writing uidstate file for %s (%s)'
+                           % (self, o) + os.linesep)
+        self.__uidstate_written = True
+
+    def _incremental_start(self, mailbox):
+        '''Return the UID to start listing the selected mailbox from, or None
+        for a full listing.'''
+        self.log.trace()
+        if not self.conf['incremental_sync'] or not mailbox in self._uidstate:
+            return None
+        (uidvalidity, uidnext) = self._uidstate[mailbox]
+        if uidvalidity != self.uidvalidity:
+            self.log.info('UIDVALIDITY of mailbox %s changed (%s -> %s), '
+                          'listing all messages%s'
+                          % (mailbox, uidvalidity, self.uidvalidity,
+                             os.linesep))
+            return None
+        return uidnext
+
+    def _addmsgs(self, mailbox, response, since=None):
+        '''Add messages from a "FETCH (UID RFC822.SIZE)" response for mailbox
+        to the message list, and return the new msgids.'''
+        self.log.trace()
+        msgids = []
+        for line in response:
+            if not line:
+                continue
+            r = self._parse_imapattrresponse(line)
+            if not 'uid' in r or not 'rfc822.size' in r:
+                # Unsolicited FETCH response, e.g. for flag changes
+                continue
+            uid = int(r['uid'])
+            if since and uid < since:
+                continue
+            self._nextlisted[mailbox] = max(self._nextlisted.get(mailbox, 1),
+                                            uid + 1)
+            msgid = '%s/%s/%s' % (self.uidvalidity, mailbox, r['uid'])
+            if msgid in self.msgsizes:
+                continue
+            self._mboxuids[msgid] = (mailbox, r['uid'])
+            self._mboxuidorder.append(msgid)
+            self.msgnum_by_msgid[msgid] = None
+            self.msgsizes[msgid] = int(r['rfc822.size'])
+            msgids.append(msgid)
+        self._msgindex = None
+        return msgids
+
+    def _searchlist(self, since=None):
+        '''Return a "FETCH (UID RFC822.SIZE)" response for the messages in
+        the selected mailbox which match the search parameter, starting from
+        UID since if given.'''
+        self.log.trace()
+        args = []
+        if since:
+            args.extend(['UID', '%d:*' % since])
+        # Parenthesized, so that imaplib doesn't quote it
+        args.append('(%s)' % self.conf['search'])
+        response = self._parse_imapuidcmdresponse('SEARCH', *args)
+        uids = []
+        for line in response:
+            if line:
+                uids.extend([int(uid) for uid in line.split()])
+        if since:
+            uids = [uid for uid in uids if uid >= since]
+        uids.sort()
+        self.log.debug('search "%s" matched %d messages%s',
+                       self.conf['search'], len(uids), os.linesep)
+        response = []
+        for i in range(0, len(uids), SEARCH_FETCH_UIDS):
+            response.extend(self._parse_imapuidcmdresponse(
+                'FETCH', self._uidset(uids[i:i + SEARCH_FETCH_UIDS]),
+                '(UID RFC822.SIZE)'
+            ))
+        return response
+
     def _getmsglist(self):
         self.log.trace()
         self.msgnum_by_msgid = {}
         self._mboxuids = {}
         self._mboxuidorder = []
         self.msgsizes = {}
-        for mailbox in self.conf['mailboxes']:
+        self._listedstate = {}
+        self._nextlisted = {}
+        self._plans = {}
+        # Last to first, leaving the first mailbox selected for retrieval
+        for mailbox in self.conf['mailboxes'][::-1]:
             try:
                 # Get number of messages in mailbox
                 msgcount = self._selectmailbox(mailbox)
-                if msgcount:
+                self._listedstate[mailbox] = (self.uidvalidity, self.uidnext)
+                since = self._incremental_start(mailbox)
+                if msgcount and self.conf['search']:
+                    self.log.debug('searching mailbox "%s"%s', mailbox,
+                                   os.linesep)
+                    response = self._searchlist(since)
+                elif msgcount and since:
+                    # Get UIDs and sizes for messages new since last session.
+                    # "n:*" always matches at least the highest UID, even if
+                    # that is below n, so filter the response below.
+                    self.log.debug('listing mailbox "%s" from UID %d%s',
+                                   mailbox, since, os.linesep)
+                    response = self._parse_imapuidcmdresponse(
+                        'FETCH', '%d:*' % since, '(UID RFC822.SIZE)'
+                    )
+                elif msgcount:
                     # Get UIDs and sizes for all messages in mailbox
                     response = self._parse_imapcmdresponse(
                         'FETCH', '1:%d' % msgcount, '(UID RFC822.SIZE)'
                     )
-                    for line in response:
-                        r = self._parse_imapattrresponse(line)
-                        msgid = (
-                            '%s/%s/%s' % (self.uidvalidity, mailbox, r['uid'])
-                        )
-                        self._mboxuids[msgid] = (mailbox, r['uid'])
-                        self._mboxuidorder.append(msgid)
-                        self.msgnum_by_msgid[msgid] = None
-                        self.msgsizes[msgid] = int(r['rfc822.size'])
+                else:
+                    response = []
+                self._nextlisted[mailbox] = self.uidnext or 1
+                self._addmsgs(mailbox, response, since)
             except imaplib.IMAP4.error, o:
                 raise getmailOperationError('IMAP error (%s)' % o)
+        # Put the messages back in mailbox order
+        bymailbox = {}
+        for msgid in self._mboxuidorder:
+            bymailbox.setdefault(self._mboxuids[msgid][0], []).append(msgid)
+        self._mboxuidorder = []
+        for mailbox in self.conf['mailboxes']:
+            self._mboxuidorder.extend(bymailbox.get(mailbox, []))
         self.gotmsglist = True
 
     def __getitem__(self, i):
         return self._mboxuidorder[i]
 
-    def _delmsgbyid(self, msgid):
+    def listnew(self, mailbox):
+        '''Select mailbox and list messages which arrived since it was last
+        listed.  Returns the new msgids.'''
         self.log.trace()
+        if not self.gotmsglist:
+            raise getmailOperationError('no message list yet')
         try:
-            mailbox, uid = self._getmboxuidbymsgid(msgid)
             self._selectmailbox(mailbox)
-            # Delete message
-            if self.conf['move_on_delete']:
-                self.log.debug('copying message to folder "%s"'
-                               % self.conf['move_on_delete'] + os.linesep)
+            since = self._nextlisted.get(mailbox, 1)
+            self.log.debug('listing mailbox "%s" from UID %d%s', mailbox,
+                           since, os.linesep)
+            if self.conf['search']:
+                response = self._searchlist(since)
+            else:
                 response = self._parse_imapuidcmdresponse(
-                    'COPY', uid, self.conf['move_on_delete']
+                    'FETCH', '%d:*' % since, '(UID RFC822.SIZE)'
                 )
-            self.log.debug('deleting message "%s"' % uid + os.linesep)
-            response = self._parse_imapuidcmdresponse(
-                'STORE', uid, 'FLAGS', '(\Deleted)'
-            )
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
+        msgids = self._addmsgs(mailbox, response, since)
+        self.log.debug('new msgids: %s%s', msgids, os.linesep)
+        return msgids
+
+    def idle(self, mailbox, timeout=IDLE_TIMEOUT):
+        '''Select mailbox and wait with IMAP IDLE until messages arrive in it
+        or timeout seconds pass.  Returns True if new messages may have
+        arrived.
+        '''
+        self.log.trace()
+        self._endfetch()
+        if not 'IDLE' in self.conn.capabilities:
+            raise getmailOperationError('IMAP server does not support IDLE')
+        self._selectmailbox(mailbox)
+        changed = False
+        tag = self.conn._new_tag()
+        self.conn.send('%s IDLE%s' % (tag, imaplib.CRLF))
+        line = self.conn._get_line()
+        if not line.startswith('+'):
+            raise getmailOperationError('IMAP error (IDLE refused: %s)' % line)
+        self.log.debug('idling on mailbox "%s"%s', mailbox, os.linesep)
+        oldtimeout = self.conn.sock.gettimeout()
+        self.conn.sock.settimeout(timeout)
+        try:
+            try:
+                while not changed:
+                    # Untagged "* n EXISTS" or "* n RECENT" means new mail
+                    line = self.conn._get_line()
+                    self.log.debug('IDLE response %s%s', line, os.linesep)
+                    parts = line.split()
+                    changed = (len(parts) >= 3 and parts[0] == '*'
+                               and parts[2].upper() in ('EXISTS', 'RECENT'))
+            except socket.timeout:
+                self.log.debug('IDLE timed out' + os.linesep)
+        finally:
+            self.conn.sock.settimeout(oldtimeout)
+        self.conn.send('DONE%s' % imaplib.CRLF)
+        while True:
+            line = self.conn._get_line()
+            if line.startswith(tag + ' '):
+                break
+            parts = line.split()
+            if (len(parts) >= 3 and parts[0] == '*'
+                    and parts[2].upper() in ('EXISTS', 'RECENT')):
+                changed = True
+        if not line[len(tag):].split()[0] == 'OK':
+            raise getmailOperationError('IMAP error (IDLE failed: %s)' % line)
+        return changed
+
+    def checkpoint(self):
+        self.log.trace()
+        self._flushdeletes()
+        deleted = self.deleted.keys()
+        # Expunge now rather than at CLOSE, which may be a long way off.
+        # The selected mailbox first, to save a SELECT; selecting another
+        # closes it, which expunges it too.
+        mailboxes = self._expunge.keys()
+        mailboxes.sort()
+        if self.mailbox in self._expunge:
+            mailboxes.remove(self.mailbox)
+            mailboxes.insert(0, self.mailbox)
+        for mailbox in mailboxes:
+            if not mailbox in self._expunge:
+                continue
+            self._selectmailbox(mailbox)
+            self.log.debug('expunging mailbox "%s"%s', mailbox, os.linesep)
+            self._parse_imapcmdresponse('EXPUNGE')
+            del self._expunge[mailbox]
+        self.__uidstate_written = False
+        RetrieverSkeleton.checkpoint(self)
+        # Stop tracking messages which are gone from the server
+        for msgid in deleted:
+            del self._mboxuids[msgid]
+            del self.msgnum_by_msgid[msgid]
+            del self.msgsizes[msgid]
+            if msgid in self.headercache:
+                del self.headercache[msgid]
+        if deleted:
+            self._mboxuidorder = [msgid for msgid in self._mboxuidorder
+                                  if msgid in self._mboxuids]
+            self._msgindex = None
+
+    def _delmsgbyid(self, msgid):
+        self.log.trace()
+        mailbox, uid = self._getmboxuidbymsgid(msgid)
+        self.log.debug('queueing deletion of message "%s"%s', uid, os.linesep)
+        if not mailbox in self._deletes:
+            self._deletes[mailbox] = []
+        self._deletes[mailbox].append((msgid, uid))
+        self._deletecount += 1
+        # Not while a batched FETCH is outstanding; the next deletion or
+        # the end of the session will do.
+        if (self._deletecount >= self.conf['delete_batch_size']
+                and self._fetchtag is None):
+            self._flushdeletes()
+
+    def _flushdeletes(self, mailbox=None):
+        '''Carry out the deletions queued for mailbox, or for all mailboxes.
+        If they fail, the messages are no longer counted as deleted.'''
+        if not self._deletecount:
+            return
+        self.log.trace()
+        if mailbox is None:
+            # Current mailbox first, to save a SELECT
+            mailboxes = self._deletes.keys()
+            mailboxes.sort()
+            if self.mailbox in self._deletes:
+                mailboxes.remove(self.mailbox)
+                mailboxes.insert(0, self.mailbox)
+        else:
+            mailboxes = [mailbox]
+        for mailbox in mailboxes:
+            queued = self._deletes.pop(mailbox, None)
+            if not queued:
+                continue
+            self._deletecount -= len(queued)
+            try:
+                self._selectmailbox(mailbox)
+                self._deletebatch([uid for (msgid, uid) in queued])
+            except (getmailOperationError, imaplib.IMAP4.error,
+                    socket.error), o:
+                for (msgid, uid) in queued:
+                    if msgid in self.deleted:
+                        del self.deleted[msgid]
+                if isinstance(o, getmailOperationError):
+                    raise
+                raise getmailOperationError('IMAP error (%s)' % o)
+
+    def _deletebatch(self, uids):
+        '''Delete (or move) the messages with UIDs uids from the selected
+        mailbox.'''
+        self.log.trace()
+        uidset = self._uidset(uids)
+        target = self.conf['move_on_delete']
+        if target and 'MOVE' in self.conn.capabilities:
+            self.log.debug('moving messages %s to folder "%s"%s', uidset,
+                           target, os.linesep)
+            self._parse_imapuidcmdresponse('MOVE', uidset, target)
+            return
+        if target:
+            self.log.debug('copying messages %s to folder "%s"%s', uidset,
+                           target, os.linesep)
+            self._parse_imapuidcmdresponse('COPY', uidset, target)
+        self.log.debug('deleting messages %s%s', uidset, os.linesep)
+        self._parse_imapuidcmdresponse('STORE', uidset, '+FLAGS.SILENT',
+                                       '(\\Deleted)')
+        self._expunge[self.mailbox] = None
 
     def _getmsgpartbyid(self, msgid, part):
         self.log.trace()
@@ -962,8 +2129,8 @@ class IMAPRetrieverBase(RetrieverSkeleton):
             mailbox, uid = self._getmboxuidbymsgid(msgid)
             self._selectmailbox(mailbox)
             # Retrieve message
-            self.log.debug('retrieving body for message "%s"' % uid
-                           + os.linesep)
+            self.log.debug('retrieving body for message "%s"%s', uid,
+                           os.linesep)
             try:
                 response = self._parse_imapuidcmdresponse('FETCH', uid, part)
             except (imaplib.IMAP4.error, getmailOperationError), o:
@@ -1005,14 +2172,758 @@ class IMAPRetrieverBase(RetrieverSkeleton):
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
+    def _uidset(self, uids):
+        '''Return an IMAP sequence set like "3:6,9" for a list of UIDs.'''
+        uids = [int(uid) for uid in uids]
+        uids.sort()
+        ranges = []
+        for uid in uids:
+            if ranges and uid == ranges[-1][1] + 1:
+                ranges[-1][1] = uid
+            else:
+                ranges.append([uid, uid])
+        parts = []
+        for (first, last) in ranges:
+            if first == last:
+                parts.append('%d' % first)
+            else:
+                parts.append('%d:%d' % (first, last))
+        return ','.join(parts)
+
+    def _readresponse(self, conn=None):
+        '''Read one complete server response, including any literals, from
+        conn (by default, self.conn).
+
+        Returns a list alternating between response text and literal data,
+        starting and ending with text.  Text segments keep any trailing
+        literal announcement ("{123}").  Literals are converted to native EOL
+        as they are read, except binary ones ("~{123}", and the contents of
+        BINARY items), which are kept as they are.
+        '''
+        self.log.trace()
+        conn = conn or self.conn
+        segments = []
+        while True:
+            line = conn._get_line()
+            segments.append(line)
+            match = IMAP_LITERAL_RE.search(line)
+            if not match:
+                break
+            size = int(match.group(1))
+            convert = not (match.group(0).startswith('~')
+                           or IMAP_BINARY_LITERAL_RE.search(line))
+            if self._spoolsize(size):
+                segments.append(self._spoolliteral(size, convert, conn))
+            else:
+                data = conn.read(size)
+                if convert and os.linesep != '\r\n':
+                    data = data.replace('\r\n', os.linesep)
+                segments.append(data)
+        return segments
+
+    def _spoolliteral(self, size, convert=True, conn=None):
+        '''Read a literal of size octets from the server into a spool file,
+        converting CRLF to native EOL if convert is set, and return the
+        file.'''
+        self.log.trace()
+        self.log.debug('spooling %d octet literal%s', size, os.linesep)
+        conn = conn or self.conn
+        spool = tempfile.TemporaryFile()
+        pending = ''
+        while size > 0:
+            data = conn.read(min(size, SPOOL_CHUNK_SIZE))
+            if not data:
+                raise getmailOperationError('IMAP error (connection closed '
+                                            'while reading message)')
+            size -= len(data)
+            if not convert:
+                spool.write(data)
+                continue
+            data = pending + data
+            pending = ''
+            if data.endswith('\r'):
+                # May be half of a CRLF split between reads
+                (data, pending) = (data[:-1], '\r')
+            spool.write(data.replace('\r\n', os.linesep))
+        spool.write(pending)
+        return spool
+
+    def _parseresponse(self, segments):
+        '''Parse the segments of a response from _readresponse() into a
+        nested list of strings, one list per parenthesized list.  Literals
+        and quoted strings become plain strings and NIL becomes None.
+        '''
+        self.log.trace()
+        result = []
+        stack = [result]
+        for (i, segment) in enumerate(segments):
+            if i % 2:
+                # literal
+                stack[-1].append(segment)
+                continue
+            pos = 0
+            while pos < len(segment):
+                match = IMAP_TOKEN_RE.match(segment, pos)
+                if not match or match.end() == pos:
+                    if segment[pos:].strip():
+                        raise getmailOperationError(
+                            'IMAP error (failed to parse response "%s")'
+                            % segment
+                        )
+                    break
+                pos = match.end()
+                if match.group('paren') == '(':
+                    stack.append([])
+                elif match.group('paren') == ')':
+                    if len(stack) < 2:
+                        raise getmailOperationError(
+                            'IMAP error (unbalanced response "%s")' % segment
+                        )
+                    item = stack.pop()
+                    stack[-1].append(item)
+                elif match.group('quoted') is not None:
+                    stack[-1].append(
+                        re.sub(r'\\(.)', r'\1', match.group('quoted'))
+                    )
+                elif match.group('atom') is not None:
+                    atom = match.group('atom')
+                    if atom.upper() == 'NIL':
+                        atom = None
+                    stack[-1].append(atom)
+        if len(stack) != 1:
+            raise getmailOperationError('IMAP error (unbalanced response)')
+        return result
+
+    def _fetchitems(self, items):
+        '''Turn the parenthesized item list of a FETCH response into a
+        dictionary keyed by upper-cased item name.'''
+        d = {}
+        for i in range(0, len(items) - 1, 2):
+            d[str(items[i]).upper()] = items[i + 1]
+        return d
+
+    def _uidfetch(self, uidset, items, conn=None):
+        '''Send a UID FETCH command for uidset in the selected mailbox and
+        return the items of each FETCH response, as from _fetchitems().  conn
+        is the connection to use, by default self.conn.'''
+        self.log.trace()
+        conn = conn or self.conn
+        tag = conn._command('UID', 'FETCH', uidset, items)
+        results = []
+        while True:
+            segments = self._readresponse(conn)
+            if segments[0].startswith(tag + ' '):
+                del conn.tagged_commands[tag]
+                status = segments[0][len(tag) + 1:]
+                if not status.upper().startswith('OK'):
+                    raise getmailOperationError(
+                        'IMAP error (command UID FETCH returned %s)' % status
+                    )
+                break
+            response = self._parseresponse(segments)
+            # Untagged "* n FETCH (...)"; ignore anything else (EXISTS, etc.)
+            if (len(response) == 4 and response[0] == '*'
+                    and str(response[2]).upper() == 'FETCH'
+                    and type(response[3]) == list):
+                results.append(self._fetchitems(response[3]))
+        return results
+
+    def _readahead(self, msgid):
+        '''Return msgid and the messages following it in the same mailbox
+        which are expected to be retrieved, up to fetch_batch_size bytes.'''
+        self.log.trace()
+        if self._msgindex is None:
+            self._msgindex = {}
+            for (i, _msgid) in enumerate(self._mboxuidorder):
+                self._msgindex[_msgid] = i
+        batch = [msgid]
+        size = self.msgsizes[msgid]
+        mailbox = self._mboxuids[msgid][0]
+        for _msgid in self._mboxuidorder[self._msgindex[msgid] + 1:]:
+            if self._mboxuids[_msgid][0] != mailbox:
+                break
+            if not self._willretrieve(_msgid):
+                continue
+            if self._partsmode():
+                if not _msgid in self._plans:
+                    break
+                if self._plans[_msgid] is not None:
+                    # Retrieved part by part
+                    continue
+            size += self.msgsizes[_msgid]
+            if size > self.conf['fetch_batch_size']:
+                break
+            batch.append(_msgid)
+        return batch
+
+    def _startfetch(self, msgid):
+        '''Send a UID FETCH command for msgid and the messages expected to
+        be retrieved after it.'''
+        self.log.trace()
+        mailbox, uid = self._getmboxuidbymsgid(msgid)
+        self._selectmailbox(mailbox)
+        batch = self._readahead(msgid)
+        self._fetched = {}
+        uids = [self._mboxuids[_msgid][1] for _msgid in batch]
+        self.log.debug('fetching %d messages from mailbox "%s" (UIDs %s)%s',
+                       len(batch), mailbox, self._uidset(uids), os.linesep)
+        try:
+            tag = self.conn._command('UID', 'FETCH', self._uidset(uids),
+                                     '(UID RFC822)')
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        self._fetchtag = tag
+        self._fetchmailbox = mailbox
+
+    def _readfetch(self):
+        '''Read the next response of the outstanding batched FETCH, keeping
+        any message in it.  Returns False once the command has completed.'''
+        self.log.trace()
+        tag = self._fetchtag
+        # Forget the command while reading, so that if the connection fails
+        # part-way nothing tries to read the rest of it.
+        self._fetchtag = None
+        segments = self._readresponse()
+        if segments[0].startswith(tag + ' '):
+            del self.conn.tagged_commands[tag]
+            status = segments[0][len(tag) + 1:]
+            if not status.upper().startswith('OK'):
+                raise getmailOperationError(
+                    'IMAP error (command UID FETCH returned %s)' % status
+                )
+            return False
+        self._fetchtag = tag
+        response = self._parseresponse(segments)
+        # Untagged "* n FETCH (...)"; ignore anything else (EXISTS, etc.)
+        if (len(response) == 4 and response[0] == '*'
+                and str(response[2]).upper() == 'FETCH'
+                and type(response[3]) == list):
+            items = self._fetchitems(response[3])
+            if items.get('UID') and items.get('RFC822'):
+                msgid = '%s/%s/%s' % (self.uidvalidity, self._fetchmailbox,
+                                      items['UID'])
+                if isinstance(items['RFC822'], str):
+                    self.log.debug('received %s (%d bytes)%s', msgid,
+                                   len(items['RFC822']), os.linesep)
+                else:
+                    self.log.debug('received %s (spooled)%s', msgid,
+                                   os.linesep)
+                self._fetched[msgid] = items['RFC822']
+        return True
+
+    def _endfetch(self):
+        '''Read the remainder of any outstanding batched FETCH.'''
+        if self._fetchtag is None:
+            return
+        self.log.trace()
+        while self._readfetch():
+            pass
+
+    def _getmsgbatchedbyid(self, msgid):
+        self.log.trace()
+        try:
+            if not msgid in self._fetched:
+                self._endfetch()
+            if not msgid in self._fetched:
+                self._startfetch(msgid)
+            while not msgid in self._fetched and self._readfetch():
+                pass
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        if not msgid in self._fetched:
+            raise getmailRetrievalError('failed to retrieve msgid %s' % msgid)
+        data = self._fetched.pop(msgid)
+        if not isinstance(data, str):
+            # Spooled
+            return Message(fromspool=data)
+        return Message(fromstring=data)
+
+    def _wantedtype(self, ctype):
+        '''Return True if MIME parts of content type ctype are to be
+        retrieved according to the fetch_content_types parameter.'''
+        for pattern in self.conf['fetch_content_types']:
+            pattern = pattern.strip().lower()
+            if pattern == ctype or (pattern.endswith('/*')
+                                    and ctype.startswith(pattern[:-1])):
+                return True
+        return False
+
+    def _bodyplan(self, structure, section=''):
+        '''Turn a (parsed) BODYSTRUCTURE into a plan of the message body:
+
+          ('multipart', section, boundary, [plans of the subparts])
+          ('part', section, content type, size, wanted, encoding)
+
+        Returns None if the structure can't be put back together (e.g. a
+        multipart without a boundary parameter).
+        '''
+        if not structure:
+            return None
+        if type(structure[0]) == list:
+            i = 0
+            while i < len(structure) and type(structure[i]) == list:
+                i += 1
+            boundary = None
+            if i + 1 < len(structure) and type(structure[i + 1]) == list:
+                params = structure[i + 1]
+                for j in range(0, len(params) - 1, 2):
+                    if str(params[j]).lower() == 'boundary':
+                        boundary = params[j + 1]
+            if not boundary:
+                return None
+            parts = []
+            for (n, substructure) in enumerate(structure[:i]):
+                if section:
+                    subsection = '%s.%d' % (section, n + 1)
+                else:
+                    subsection = '%d' % (n + 1)
+                plan = self._bodyplan(substructure, subsection)
+                if plan is None:
+                    return None
+                parts.append(plan)
+            return ('multipart', section, boundary, parts)
+        if len(structure) < 7:
+            return None
+        ctype = ('%s/%s' % (structure[0], structure[1])).lower()
+        try:
+            size = int(structure[6])
+        except (TypeError, ValueError):
+            size = 0
+        encoding = str(structure[5] or '7bit').lower()
+        if self.conf['fetch_content_types'] and section:
+            # The body of a message which is not multipart is always kept
+            wanted = self._wantedtype(ctype)
+        else:
+            wanted = True
+        return ('part', section, ctype, size, wanted, encoding)
+
+    def _planitems(self, plan, items, binary=False):
+        '''Add the FETCH items needed to reassemble plan to items, and
+        return the number of parts left out.  If binary is set,
+        base64-encoded parts (or the body of a message which is not
+        multipart) are fetched with BINARY.PEEK.'''
+        if plan[0] == 'multipart':
+            if plan[1]:
+                items.append('BODY.PEEK[%s.MIME]' % plan[1])
+            omitted = 0
+            for part in plan[3]:
+                omitted += self._planitems(part, items, binary)
+            return omitted
+        if not plan[4]:
+            return 1
+        section = plan[1]
+        if section:
+            items.append('BODY.PEEK[%s.MIME]' % section)
+        else:
+            # Not multipart; the message header is the part header
+            section = '1'
+        if binary and plan[5] == 'base64':
+            items.append('BINARY.PEEK[%s]' % section)
+        else:
+            items.append('BODY.PEEK[%s]' % section)
+        return 0
+
+    def _base64piece(self, data):
+        '''Return data, a string or a spool file of decoded octets, encoded
+        in base64 lines with native EOL, as a string or a spool file.'''
+        if isinstance(data, str):
+            encoded = base64.encodestring(data)
+            if os.linesep != '\n':
+                encoded = encoded.replace('\n', os.linesep)
+            return encoded
+        spool = tempfile.TemporaryFile()
+        data.seek(0)
+        while True:
+            chunk = data.read(BASE64_CHUNK_SIZE)
+            if not chunk:
+                break
+            encoded = base64.encodestring(chunk)
+            if os.linesep != '\n':
+                encoded = encoded.replace('\n', os.linesep)
+            spool.write(encoded)
+        data.close()
+        return spool
+
+    def _assemble(self, plan, fetched, pieces):
+        '''Append the pieces of the body described by plan, with native EOL,
+        to pieces.  Pieces are strings, or spool files for large literals.
+        '''
+        def literal(name):
+            data = fetched.get(name)
+            if data is None:
+                raise getmailRetrievalError('server returned no %s' % name)
+            pieces.append(data)
+        sep = os.linesep
+        if plan[0] == 'multipart':
+            (unused, section, boundary, parts) = plan
+            if section:
+                literal('BODY[%s.MIME]' % section)
+            for part in parts:
+                pieces.append('--%s%s' % (boundary, sep))
+                self._assemble(part, fetched, pieces)
+                pieces.append(sep)
+            pieces.append('--%s--%s' % (boundary, sep))
+            return
+        (unused, section, ctype, size, wanted, encoding) = plan
+        if wanted:
+            if section:
+                literal('BODY[%s.MIME]' % section)
+            data = fetched.get('BINARY[%s]' % (section or '1'))
+            if data is None:
+                literal('BODY[%s]' % (section or '1'))
+            else:
+                encoded = self._base64piece(data)
+                if not section:
+                    # Not multipart; no boundary follows
+                    pieces.append(encoded)
+                    return
+                # The EOL before the next boundary belongs to the boundary
+                if isinstance(encoded, str):
+                    if encoded.endswith(sep):
+                        encoded = encoded[:-len(sep)]
+                else:
+                    encoded.seek(0, 2)
+                    if encoded.tell() >= len(sep):
+                        encoded.truncate(encoded.tell() - len(sep))
+                pieces.append(encoded)
+            return
+        pieces.append(sep.join([
+            'Content-Type: text/plain; charset="us-ascii"',
+            'X-getmail-omitted-part: %s; %d octets' % (ctype, size),
+            '',
+            'The %s part (%d octets) of this message was not retrieved.'
+            % (ctype, size),
+        ]))
+
+    def _startcompression(self):
+        '''Turn on COMPRESS=DEFLATE if the server supports it.'''
+        self.log.trace()
+        if not 'COMPRESS=DEFLATE' in self.conn.capabilities:
+            # Some servers only list it once logged in
+            typ, data = self.conn.capability()
+            if typ == 'OK' and data and data[-1]:
+                self.conn.capabilities = tuple(data[-1].upper().split())
+        if not 'COMPRESS=DEFLATE' in self.conn.capabilities:
+            self.log.debug('server does not support COMPRESS=DEFLATE%s',
+                           os.linesep)
+            return
+        tag = self.conn._new_tag()
+        self.conn.send('%s COMPRESS DEFLATE%s' % (tag, imaplib.CRLF))
+        while True:
+            line = self.conn._get_line()
+            if line.startswith(tag + ' '):
+                break
+        status = line[len(tag) + 1:]
+        if not status.upper().startswith('OK'):
+            self.log.debug('COMPRESS DEFLATE refused (%s)%s', status,
+                           os.linesep)
+            return
+        self._deflate = deflate_connection(self.conn)
+        self.log.debug('compression enabled%s', os.linesep)
+
+    def _binary(self):
+        '''Return True if the server supports the BINARY extension.'''
+        return 'BINARY' in self.conn.capabilities
+
+    def _partsmode(self):
+        '''Return True if messages are to be retrieved part by part where
+        that saves anything (see _getmsgpartsbyid()).'''
+        return bool(self.conf['fetch_content_types']
+                    or (self.conf['use_binary'] and self._binary()))
+
+    def _planmsgs(self, msgids):
+        '''Fetch the BODYSTRUCTURE of msgids, all in the selected mailbox,
+        SEARCH_FETCH_UIDS at a time, and record in self._plans how to
+        retrieve each of them: (plan, FETCH items, parts left out, parts
+        decoded), or None if it is to be retrieved whole.'''
+        self.log.trace()
+        binary = self.conf['use_binary'] and self._binary()
+        mailbox = self._getmboxuidbymsgid(msgids[0])[0]
+        for i in range(0, len(msgids), SEARCH_FETCH_UIDS):
+            chunk = msgids[i:i + SEARCH_FETCH_UIDS]
+            uids = [self._mboxuids[msgid][1] for msgid in chunk]
+            structures = {}
+            for items in self._uidfetch(self._uidset(uids),
+                                        '(UID BODYSTRUCTURE)'):
+                structure = items.get('BODYSTRUCTURE')
+                if items.get('UID') and type(structure) == list:
+                    msgid = '%s/%s/%s' % (self.uidvalidity, mailbox,
+                                          items['UID'])
+                    structures[msgid] = structure
+            for msgid in chunk:
+                self._plans[msgid] = None
+                plan = self._bodyplan(structures.get(msgid))
+                if plan is None:
+                    continue
+                items = ['UID', 'BODY.PEEK[HEADER]']
+                omitted = self._planitems(plan, items, binary)
+                binaryparts = len([item for item in items
+                                   if item.startswith('BINARY')])
+                if omitted or binaryparts:
+                    self._plans[msgid] = (plan, items, omitted, binaryparts)
+
+    def _getmsgpartsbyid(self, msgid):
+        '''Retrieve only the header and the wanted MIME parts of msgid,
+        falling back to retrieving the whole message (returning None) when
+        no part would be left out or decoded.
+
+        The BODYSTRUCTURE of msgid is fetched along with that of the
+        messages following it in the same mailbox which are expected to be
+        retrieved, SEARCH_FETCH_UIDS at most.'''
+        self.log.trace()
+        try:
+            mailbox, uid = self._getmboxuidbymsgid(msgid)
+            if not msgid in self._plans:
+                if self._msgindex is None:
+                    self._msgindex = {}
+                    for (i, _msgid) in enumerate(self._mboxuidorder):
+                        self._msgindex[_msgid] = i
+                batch = [msgid]
+                for _msgid in self._mboxuidorder[self._msgindex[msgid] + 1:]:
+                    if (self._mboxuids[_msgid][0] != mailbox
+                            or len(batch) >= SEARCH_FETCH_UIDS):
+                        break
+                    if (self._willretrieve(_msgid)
+                            and not _msgid in self._plans):
+                        batch.append(_msgid)
+                self._endfetch()
+                self._selectmailbox(mailbox)
+                self.log.debug('fetching BODYSTRUCTURE of %d messages%s',
+                               len(batch), os.linesep)
+                self._planmsgs(batch)
+            parts = self._plans.pop(msgid)
+            if parts is None:
+                self.log.debug('retrieving all of message "%s"%s', uid,
+                               os.linesep)
+                return None
+            (plan, items, omitted, binaryparts) = parts
+            self.log.debug('retrieving message "%s" without %d parts, '
+                           '%d parts decoded%s', uid, omitted, binaryparts,
+                           os.linesep)
+            self._endfetch()
+            self._selectmailbox(mailbox)
+            fetched = {}
+            try:
+                results = self._uidfetch(uid, '(%s)' % ' '.join(items))
+            except getmailOperationError, o:
+                if not binaryparts:
+                    raise
+                # Most likely [UNKNOWN-CTE]; fetch the parts encoded
+                self.log.info('BINARY fetch failed for message "%s" (%s);'
+                              ' retrying without it%s' % (uid, o, os.linesep))
+                items = ['UID', 'BODY.PEEK[HEADER]']
+                self._planitems(plan, items)
+                results = self._uidfetch(uid, '(%s)' % ' '.join(items))
+            for _items in results:
+                if str(_items.get('UID')) == str(uid):
+                    fetched.update(_items)
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        header = fetched.get('BODY[HEADER]')
+        if not isinstance(header, str) or not header:
+            raise getmailRetrievalError('failed to retrieve msgid %s (server '
+                                        'returned no header)' % msgid)
+        pieces = [header]
+        try:
+            self._assemble(plan, fetched, pieces)
+        except getmailRetrievalError, o:
+            raise getmailRetrievalError('failed to retrieve msgid %s (%s)'
+                                        % (msgid, o))
+        if [piece for piece in pieces if not isinstance(piece, str)]:
+            # Some part was spooled; spool the whole message
+            spool = tempfile.TemporaryFile()
+            for piece in pieces:
+                if isinstance(piece, str):
+                    spool.write(piece)
+                    continue
+                piece.seek(0)
+                while True:
+                    data = piece.read(SPOOL_CHUNK_SIZE)
+                    if not data:
+                        break
+                    spool.write(data)
+                piece.close()
+            return Message(fromspool=spool)
+        return Message(fromstring=''.join(pieces))
+
+    def _backfillconnection(self):
+        '''Open another connection to the server and log in on it, leaving
+        self.conn alone, and return it.'''
+        self.log.trace()
+        (conn, deflate) = (self.conn, self._deflate)
+        try:
+            self._connect()
+            try:
+                self._login()
+            except:
+                try:
+                    self.conn.shutdown()
+                except (imaplib.IMAP4.error, socket.error), o:
+                    pass
+                raise
+            return self.conn
+        finally:
+            (self.conn, self._deflate) = (conn, deflate)
+
+    def _startbackfill(self, msgid):
+        '''Start a backfill of msgid and the messages following it in the
+        same mailbox which are expected to be retrieved, if there are enough
+        of them.'''
+        self.log.trace()
+        mailbox, uid = self._getmboxuidbymsgid(msgid)
+        if self._msgindex is None:
+            self._msgindex = {}
+            for (i, _msgid) in enumerate(self._mboxuidorder):
+                self._msgindex[_msgid] = i
+        batch = [msgid]
+        for _msgid in self._mboxuidorder[self._msgindex[msgid] + 1:]:
+            if self._mboxuids[_msgid][0] != mailbox:
+                break
+            if self._willretrieve(_msgid):
+                batch.append(_msgid)
+        if len(batch) < BACKFILL_MIN_MESSAGES:
+            return
+        self._endfetch()
+        self._selectmailbox(mailbox)
+        if self._partsmode():
+            # Only messages retrieved whole are backfilled
+            unplanned = [_msgid for _msgid in batch[1:]
+                         if not _msgid in self._plans]
+            if unplanned:
+                self._planmsgs(unplanned)
+            batch = [msgid] + [_msgid for _msgid in batch[1:]
+                               if self._plans[_msgid] is None]
+            if len(batch) < BACKFILL_MIN_MESSAGES:
+                return
+        conns = []
+        while len(conns) < self.conf['backfill_connections']:
+            try:
+                conns.append(self._backfillconnection())
+            except (getmailOperationError, imaplib.IMAP4.error,
+                    socket.error), o:
+                # Probably the server's limit on connections
+                self.log.info('could only open %d of %d backfill connections'
+                              ' (%s)%s' % (len(conns),
+                              self.conf['backfill_connections'], o,
+                              os.linesep))
+                break
+        if not conns:
+            return
+        self.log.debug('backfilling %d messages from mailbox "%s" over %d '
+                       'connections%s', len(batch), mailbox, len(conns),
+                       os.linesep)
+        self._backfill = IMAPBackfill(self, mailbox, batch, conns)
+
+    def _stopbackfill(self):
+        '''Stop any backfill, closing its connections.'''
+        if self._backfill is None:
+            return
+        self.log.trace()
+        self._backfill.stop()
+        self._backfill = None
+
+    def _getmsgbackfilledbyid(self, msgid):
+        '''Return msgid from the backfill of its mailbox (starting one the
+        first time a message of the mailbox is retrieved), or None if it has
+        to be retrieved over the main connection.'''
+        self.log.trace()
+        mailbox = self._getmboxuidbymsgid(msgid)[0]
+        if self._backfill is not None and self._backfill.mailbox != mailbox:
+            self._stopbackfill()
+        if self._backfill is None and not mailbox in self._backfilled:
+            self._backfilled[mailbox] = None
+            self._startbackfill(msgid)
+        if self._backfill is None:
+            return None
+        data = self._backfill.get(msgid)
+        if data is None:
+            return None
+        if not isinstance(data, str):
+            # Spooled
+            return Message(fromspool=data)
+        return Message(fromstring=data)
+
     def _getmsgbyid(self, msgid):
         self.log.trace()
+        mailbox = self._getmboxuidbymsgid(msgid)[0]
+        self._mailboxstats.setdefault(mailbox, [0, 0.0, 0])[2] += 1
+        if self._partsmode():
+            msg = self._getmsgpartsbyid(msgid)
+            if msg is not None:
+                return msg
+        if self.conf['backfill_connections'] > 0:
+            msg = self._getmsgbackfilledbyid(msgid)
+            if msg is not None:
+                return msg
+        if (self.conf['fetch_batch_size']
+                or self._spoolsize(self.msgsizes.get(msgid, 0))):
+            # Large messages always go through the batched FETCH code, which
+            # can spool them
+            return self._getmsgbatchedbyid(msgid)
         return self._getmsgpartbyid(msgid, '(RFC822)')
 
     def _getheaderbyid(self, msgid):
         self.log.trace()
         return self._getmsgpartbyid(msgid, '(RFC822[header])')
 
+    def _getheadersbyid(self, msgids, keep):
+        '''Retrieve headers with UID FETCH of BODY.PEEK[HEADER], for up to
+        SEARCH_FETCH_UIDS messages of a mailbox at a time.'''
+        self.log.trace()
+        headers = {}
+        mailboxes = []
+        uids = {}
+        for msgid in msgids:
+            mailbox, uid = self._getmboxuidbymsgid(msgid)
+            if not mailbox in uids:
+                mailboxes.append(mailbox)
+                uids[mailbox] = []
+            uids[mailbox].append(uid)
+        try:
+            self._endfetch()
+            for mailbox in mailboxes:
+                self._selectmailbox(mailbox)
+                self.log.debug('fetching %d headers from mailbox "%s"%s',
+                               len(uids[mailbox]), mailbox, os.linesep)
+                for i in range(0, len(uids[mailbox]), SEARCH_FETCH_UIDS):
+                    chunk = uids[mailbox][i:i + SEARCH_FETCH_UIDS]
+                    results = self._uidfetch(self._uidset(chunk),
+                                             '(UID BODY.PEEK[HEADER])')
+                    # Dropping each raw header once it has been parsed
+                    results.reverse()
+                    while results:
+                        items = results.pop()
+                        header = items.get('BODY[HEADER]')
+                        if not (items.get('UID') and isinstance(header, str)
+                                and header):
+                            continue
+                        msgid = '%s/%s/%s' % (self.uidvalidity, mailbox,
+                                              items['UID'])
+                        header = Message(fromstring=header)
+                        if keep(msgid, header):
+                            headers[msgid] = header
+        except imaplib.IMAP4.error, o:
+            raise getmailOperationError('IMAP error (%s)' % o)
+        return headers
+
+    def _login(self):
+        '''Log in on self.conn, and turn on compression if configured.'''
+        self.log.trace('logging in' + os.linesep)
+        if self.conf['use_kerberos'] and HAVE_KERBEROS_GSS:
+            self.gss_step = 0
+            self.gss_vc = None
+            self.conn.authenticate('GSSAPI', self.gssauth)
+        elif self.conf['use_cram_md5']:
+            self._parse_imapcmdresponse(
+                'login_cram_md5', self.conf['username'],
+                self.conf['password']
+            )
+        else:
+            self._parse_imapcmdresponse('login', self.conf['username'],
+                                        self.conf['password'])
+        if self.conf['use_compression']:
+            self._startcompression()
+
     def initialize(self, options):
         self.log.trace()
         # Handle password
@@ -1022,25 +2933,19 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 'Enter password for %s:  ' % self
             )
         RetrieverSkeleton.initialize(self, options)
+        self.uidstate_filename = self.oldmail_filename + '.uidstate'
+        if self.conf['incremental_sync']:
+            self._uidstate = self._read_uidstatefile()
         try:
             self.log.trace('trying self._connect()' + os.linesep)
             self._connect()
-            self.log.trace('logging in' + os.linesep)
-            if self.conf['use_kerberos'] and HAVE_KERBEROS_GSS:
-                self.conn.authenticate('GSSAPI', self.gssauth)
-            elif self.conf['use_cram_md5']:
-                self._parse_imapcmdresponse(
-                    'login_cram_md5', self.conf['username'],
-                    self.conf['password']
-                )
-            else:
-                self._parse_imapcmdresponse('login', self.conf['username'],
-                                            self.conf['password'])
+            self._login()
             self.log.trace('logged in, getting message list' + os.linesep)
             self._getmsglist()
-            self.log.debug('msgids: %s'
-                           % sorted(self.msgnum_by_msgid.keys()) + os.linesep)
-            self.log.debug('msgsizes: %s' % self.msgsizes + os.linesep)
+            if self.log.isEnabledFor(DEBUG):
+                self.log.debug('msgids: %s%s',
+                               sorted(self.msgnum_by_msgid.keys()), os.linesep)
+            self.log.debug('msgsizes: %s%s', self.msgsizes, os.linesep)
             # Remove messages from state file that are no longer in mailbox,
             # but only if the timestamp for them are old (30 days for now).
             # This is because IMAP users can have one state file but multiple
@@ -1049,12 +2954,17 @@ class IMAPRetrieverBase(RetrieverSkeleton):
                 timestamp = self.oldmail[msgid]
                 age = self.timestamp - timestamp
                 if not self.msgsizes.has_key(msgid) and age > VANISHED_AGE:
-                    self.log.debug('removing vanished old message id %s' % msgid
-                                   + os.linesep)
-                    del self.oldmail[msgid]
+                    self.log.debug('removing vanished old message id %s%s',
+                                   msgid, os.linesep)
+                    self._forget(msgid)
         except imaplib.IMAP4.error, o:
             raise getmailOperationError('IMAP error (%s)' % o)
 
+    def write_oldmailfile(self, forget_deleted=True):
+        RetrieverSkeleton.write_oldmailfile(self, forget_deleted)
+        if self.conf.get('incremental_sync'):
+            self._write_uidstatefile()
+
     def abort(self):
         self.log.trace()
         try:
@@ -1064,16 +2974,42 @@ class IMAPRetrieverBase(RetrieverSkeleton):
 
     def quit(self):
         self.log.trace()
+        self._stopbackfill()
+        if getattr(self, 'conn', None):
+            # Before the oldmail file is written, so that messages which
+            # could not be deleted are remembered
+            try:
+                self._flushdeletes()
+            except getmailOperationError, o:
+                self.log.warning('failed to delete messages (%s)%s'
+                                 % (o, os.linesep))
         self.write_oldmailfile()
+        self._finishcompaction()
         if not getattr(self, 'conn', None):
             return
         try:
+            self._endfetch()
             self.conn.close()
             self.conn.logout()
             self.conn = None
         except imaplib.IMAP4.error, o:
             #raise getmailOperationError('IMAP error (%s)' % o)
             self.log.warning('IMAP error during logout (%s)' % o + os.linesep)
+        self._deselected()
+        self._logmailboxstats()
+        if self._deflate:
+            stats = ('  IMAP compression: received %d bytes as %d, sent %d '
+                     'bytes as %d%s' % (
+                         self._deflate.received,
+                         self._deflate.received_compressed,
+                         self._deflate.sent, self._deflate.sent_compressed,
+                         os.linesep
+                     ))
+            if (self.app_options or {}).get('verbose', 0) > 1:
+                self.log.info(stats)
+            else:
+                self.log.debug(stats)
+            self._deflate = None
 
 #######################################
 class MultidropIMAPRetrieverBase(IMAPRetrieverBase):
@@ -1135,8 +3071,7 @@ class MultidropIMAPRetrieverBase(IMAPRetrieverBase):
         return msg
 
 
-# Choose right POP-over-SSL mix-in based on Python version being used.
-if sys.hexversion >= 0x02040000:
-    POP3SSLinitMixIn = Py24POP3SSLinitMixIn
-else:
-    POP3SSLinitMixIn = Py23POP3SSLinitMixIn
+# getmail's own POP3SSL class reads from the SSL connection in large blocks
+# and is considerably faster on big messages than poplib.POP3_SSL, so it is
+# used with all Python versions.
+POP3SSLinitMixIn = Py23POP3SSLinitMixIn
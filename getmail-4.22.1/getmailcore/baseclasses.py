@@ -6,6 +6,7 @@
 __all__ = [
     'ConfigurableBase',
     'ForkingBase',
+    'CHILD_TRANSPORTS',
     'ConfInstance',
     'ConfString',
     'ConfBool',
@@ -23,8 +24,19 @@ import sys
 import os
 import time
 import signal
+import select
+import errno
+import fcntl
+import tempfile
 import types
 
+try:
+    # For memfd_create(); not available before Python 2.5
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
 from getmailcore.exceptions import *
 from getmailcore.compatibility import *
 import getmailcore.logging
@@ -59,11 +71,11 @@ class ConfItem:
         if type(val) is not self.dtype and val != self.default:
             # Got value, but not of expected type.  Try to convert.
             if self.securevalue:
-                self.log.debug('converting %s to type %s\n'
-                               % (self.name, self.dtype))
+                self.log.debug('converting %s to type %s\n', self.name,
+                               self.dtype)
             else:
-                self.log.debug('converting %s (%s) to type %s\n'
-                               % (self.name, val, self.dtype))
+                self.log.debug('converting %s (%s) to type %s\n', self.name,
+                               val, self.dtype)
 
             try:
                 if self.dtype == bool:
@@ -256,10 +268,10 @@ class ConfigurableBase(object):
                                  '(value: %s)\n' % (name, value))
                 continue
             if name.lower() == 'password':
-                self.log.trace('setting %s to * (%s)\n' % (name, type(value)))
+                self.log.trace('setting %s to * (%s)\n', name, type(value))
             else:
-                self.log.trace('setting %s to "%s" (%s)\n'
-                               % (name, value, type(value)))
+                self.log.trace('setting %s to "%s" (%s)\n', name, value,
+                               type(value))
             self.conf[name] = value
         self.__confchecked = False
         self.checkconf()
@@ -270,7 +282,7 @@ class ConfigurableBase(object):
             return
         for item in self._confitems:
             # New class-based configuration item
-            self.log.trace('checking %s\n' % item.name)
+            self.log.trace('checking %s\n', item.name)
             self.conf[item.name] = item.validate(self.conf)
         unknown_params = frozenset(self.conf.keys()).difference(
             frozenset([item.name for item in self._confitems])
@@ -297,6 +309,81 @@ class ConfigurableBase(object):
                 confstring += '%s="%s"' % (name, self.conf[name])
         return confstring
 
+#######################################
+# How long _wait_for_child() waits between checks on a child if no SIGCHLD
+# arrives, and how long after SIGTERM it waits before sending SIGKILL to a
+# child which has timed out.  These are in seconds.
+CHILD_POLL_INTERVAL = 1.0
+CHILD_KILL_GRACE = 5.0
+
+# How a message is passed to a filter or MDA and its output read back:
+#   file - through temporary files on disk
+#   pipe - through pipes
+#   memfd - through anonymous files in memory, for commands which need to seek
+#           on their input
+CHILD_TRANSPORTS = ('file', 'pipe', 'memfd')
+
+# Largest chunk written to or read from a child's pipes at once
+CHILD_PIPE_CHUNK = 65536
+
+# Self-pipe which the SIGCHLD handler writes to, waking ForkingBase instances
+# waiting in select() for their children.
+_wakeup_pipe = None
+_children_in_flight = 0
+_orig_sigchld_handler = signal.SIG_DFL
+
+def _setup_wakeup_pipe():
+    '''Create the SIGCHLD wakeup pipe if it doesn't exist yet.'''
+    global _wakeup_pipe
+    if _wakeup_pipe is not None:
+        return
+    _wakeup_pipe = os.pipe()
+    for fd in _wakeup_pipe:
+        fcntl.fcntl(fd, fcntl.F_SETFL,
+                    fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+def _child_handler(sig, stackframe):
+    '''SIGCHLD handler; wake up whoever is waiting for a child.'''
+    try:
+        os.write(_wakeup_pipe[1], '\0')
+    except OSError:
+        # Pipe full; a wakeup is already pending
+        pass
+
+def _wait4(pid, options):
+    '''os.wait4(), or os.waitpid() without resource usage where wait4() is
+    not available (Python 2.4 and earlier).'''
+    if hasattr(os, 'wait4'):
+        return os.wait4(pid, options)
+    (pid, status) = os.waitpid(pid, options)
+    return (pid, status, None)
+
+_memfd_create = None
+
+def _memory_file():
+    '''Return an anonymous read-write file object which is kept in memory if
+    possible.'''
+    global _memfd_create
+    if _memfd_create is None:
+        _memfd_create = False
+        try:
+            if ctypes:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'))
+                _memfd_create = libc.memfd_create
+        except (AttributeError, OSError):
+            # No memfd_create() in this libc
+            pass
+    if _memfd_create:
+        # MFD_CLOEXEC; only the dup2()ed copy is passed to children
+        fd = _memfd_create('getmail', 1)
+        if fd >= 0:
+            return os.fdopen(fd, 'w+b')
+    if os.path.isdir('/dev/shm'):
+        return tempfile.TemporaryFile(dir='/dev/shm')
+    return tempfile.TemporaryFile()
+
 #######################################
 class ForkingBase(object):
     '''Base class for classes which fork children and wait for them to exit.
@@ -305,58 +392,250 @@ class ForkingBase(object):
 
         log - an object of type getmailcore.logging.Logger()
 
+    Call _prepare_child() before forking each child, and _wait_for_child()
+    with its pid afterwards.  Several children may be in flight at once; each
+    is reaped only by the _wait_for_child() call for its own pid, which wakes
+    as soon as the child exits.  After it returns, self.child_rusage holds the
+    child's resource usage (an object with ru_utime, ru_stime and ru_maxrss
+    attributes, as from resource.getrusage()), or None if the platform can't
+    report it.
     '''
-    def _child_handler(self, sig, stackframe):
-        self.log.trace('handler called for signal %s' % sig)
+    child_rusage = None
+
+    def _child_io(self, data, transport='file'):
+        '''Prepare the standard input, output and error for a child which is
+        about to be forked, with data as its input.  transport is one of
+        CHILD_TRANSPORTS.  The result is passed to _child_setio() in the
+        child and to _child_communicate() in the parent.
+
+        data may also be a function which writes the input to a file object
+        passed to it (see Message.flatten_data()); the input is then always
+        passed in a temporary file.
+        '''
+        self.log.trace()
+        if callable(data):
+            # A message too large to hold in memory
+            transport = 'file'
+        if transport == 'pipe':
+            return (transport, os.pipe(), os.pipe(), os.pipe(), data)
+        if transport == 'memfd':
+            files = (_memory_file(), _memory_file(), _memory_file())
+        else:
+            files = (tempfile.TemporaryFile(), tempfile.TemporaryFile(),
+                     tempfile.TemporaryFile())
+        if callable(data):
+            data(files[0])
+        else:
+            files[0].write(data)
+        files[0].flush()
+        if transport == 'file':
+            os.fsync(files[0].fileno())
+        # Rewind
+        files[0].seek(0)
+        return (transport, ) + files + (None, )
+
+    def _child_setio(self, childio):
+        '''In the child, set stdin to read the message and stdout and stderr to
+        write to where the parent will read them.'''
+        (transport, stdin, stdout, stderr, unused) = childio
+        if transport == 'pipe':
+            os.dup2(stdin[0], 0)
+            os.dup2(stdout[1], 1)
+            os.dup2(stderr[1], 2)
+            for fd in stdin + stdout + stderr:
+                os.close(fd)
+        else:
+            os.dup2(stdin.fileno(), 0)
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stderr.fileno(), 2)
+
+    def _child_communicate(self, childpid, childio, timeout=None,
+                           spool=False):
+        '''In the parent, feed the child its input, wait for it to exit, and
+        return (exitcode, stdout data, stderr data).  timeout is passed on to
+        _wait_for_child(), and also limits the time spent talking to the
+        child over pipes.
+
+        If spool is True, the child's stdout is returned as a file rather
+        than a string, positioned at its start, so that large output need not
+        be held in memory.
+        '''
+        self.log.trace()
+        (transport, stdin, stdout, stderr, data) = childio
+        if transport != 'pipe':
+            exitcode = self._wait_for_child(childpid, timeout)
+            stdout.seek(0)
+            stderr.seek(0)
+            if not spool:
+                stdout = stdout.read()
+            return (exitcode, stdout, stderr.read())
+        os.close(stdin[0])
+        os.close(stdout[1])
+        os.close(stderr[1])
+        output = {stdout[0] : [], stderr[0] : []}
+        if spool:
+            output[stdout[0]] = tempfile.TemporaryFile()
+        readers = [stdout[0], stderr[0]]
+        writers = [stdin[1]]
+        fcntl.fcntl(stdin[1], fcntl.F_SETFL,
+                    fcntl.fcntl(stdin[1], fcntl.F_GETFL) | os.O_NONBLOCK)
+        written = 0
+        deadline = None
+        if timeout:
+            deadline = time.time() + timeout
         try:
-            pid, r = os.wait()
+            while readers or writers:
+                if writers and written >= len(data):
+                    os.close(stdin[1])
+                    writers = []
+                    continue
+                delay = None
+                if deadline is not None:
+                    delay = deadline - time.time()
+                    if delay <= 0:
+                        # Stop talking to it; _wait_for_child() kills it
+                        for fd in readers + writers:
+                            os.close(fd)
+                        readers = writers = []
+                        break
+                try:
+                    (r, w, unused) = select.select(readers, writers, [],
+                                                   delay)
+                except select.error, o:
+                    if o[0] == errno.EINTR:
+                        continue
+                    raise
+                if w:
+                    try:
+                        written += os.write(
+                            stdin[1], buffer(data, written, CHILD_PIPE_CHUNK)
+                        )
+                    except OSError, o:
+                        if o.errno == errno.EPIPE:
+                            # Command exited or closed stdin without reading
+                            # the whole message
+                            written = len(data)
+                        elif o.errno not in (errno.EAGAIN, errno.EINTR):
+                            raise
+                for fd in r:
+                    chunk = os.read(fd, CHILD_PIPE_CHUNK)
+                    if chunk and spool and fd == stdout[0]:
+                        output[fd].write(chunk)
+                    elif chunk:
+                        output[fd].append(chunk)
+                    else:
+                        os.close(fd)
+                        readers.remove(fd)
         except OSError, o:
-            # No children on SIGCHLD.  Can't happen?
-            self.log.warning('handler called, but no children (%s)' % o)
-            return
-        signal.signal(signal.SIGCHLD, self.__orig_handler)
-        self.__child_pid = pid
-        self.__child_status = r
-        self.log.trace('handler reaped child %s with status %s' % (pid, r))
-        self.__child_exited = True
+            for fd in readers + writers:
+                os.close(fd)
+            # The child still has to be reaped
+            self._wait_for_child(childpid)
+            raise getmailOperationError('error communicating with child %d '
+                                        '(%s)' % (childpid, o))
+        exitcode = self._wait_for_child(childpid, timeout, deadline)
+        if spool:
+            out = output[stdout[0]]
+            out.seek(0)
+        else:
+            out = ''.join(output[stdout[0]])
+        return (exitcode, out, ''.join(output[stderr[0]]))
 
     def _prepare_child(self):
         self.log.trace('')
-        self.__child_exited = False
-        self.__child_pid = None
-        self.__child_status = None
-        self.__orig_handler = signal.signal(signal.SIGCHLD, self._child_handler)
-
-    def _wait_for_child(self, childpid):
-        while not self.__child_exited:
-            # Could implement a maximum wait time here
-            self.log.trace('waiting for child %d' % childpid)
-            time.sleep(1.0)
-            #raise getmailDeliveryError('failed waiting for commands %s %d (%s)'
-            #                           % (self.conf['command'], childpid, o))
-        if self.__child_pid != childpid:
-            #self.log.error('got child pid %d, not %d' % (pid, childpid))
+        global _children_in_flight, _orig_sigchld_handler
+        _setup_wakeup_pipe()
+        if not _children_in_flight:
+            _orig_sigchld_handler = signal.signal(signal.SIGCHLD,
+                                                  _child_handler)
+            if hasattr(signal, 'siginterrupt'):
+                signal.siginterrupt(signal.SIGCHLD, False)
+        _children_in_flight += 1
+
+    def _wait_for_child(self, childpid, timeout=None, deadline=None):
+        '''Wait for child childpid to exit, and return its exit code.
+
+        If timeout (in seconds) is given and the child is still running when
+        it expires, it is sent SIGTERM, then SIGKILL if it is still running
+        CHILD_KILL_GRACE seconds later, and getmailOperationError is raised
+        once it has been reaped.  deadline is the time at which the timeout
+        expires, if the caller started counting it earlier.
+        '''
+        global _children_in_flight
+        if timeout and deadline is None:
+            deadline = time.time() + timeout
+        try:
+            (status, rusage, killed) = self.__reap_child(childpid, deadline)
+        finally:
+            _children_in_flight -= 1
+            if _children_in_flight <= 0:
+                _children_in_flight = 0
+                signal.signal(signal.SIGCHLD, _orig_sigchld_handler)
+        self.child_rusage = rusage
+        if rusage is not None:
+            self.log.debug('child %d used %.3fs user, %.3fs system CPU, max '
+                           'RSS %d\n', childpid, rusage.ru_utime,
+                           rusage.ru_stime, rusage.ru_maxrss)
+        if killed:
             raise getmailOperationError(
-                'got child pid %d, not %d'
-                % (self.__child_pid, childpid)
+                'child pid %d timed out after %s seconds' % (childpid, timeout)
             )
-        if os.WIFSTOPPED(self.__child_status):
+        if os.WIFSTOPPED(status):
             raise getmailOperationError(
                 'child pid %d stopped by signal %d'
-                % (self.__child_pid, os.WSTOPSIG(self.__child_status))
+                % (childpid, os.WSTOPSIG(status))
             )
-        if os.WIFSIGNALED(self.__child_status):
+        if os.WIFSIGNALED(status):
             raise getmailOperationError(
                 'child pid %d killed by signal %d'
-                % (self.__child_pid, os.WTERMSIG(self.__child_status))
+                % (childpid, os.WTERMSIG(status))
             )
-        if not os.WIFEXITED(self.__child_status):
+        if not os.WIFEXITED(status):
             raise getmailOperationError('child pid %d failed to exit'
-                                        % self.__child_pid)
-        exitcode = os.WEXITSTATUS(self.__child_status)
+                                        % childpid)
+        exitcode = os.WEXITSTATUS(status)
 
         return exitcode
 
+    def __reap_child(self, childpid, deadline):
+        '''Wait for childpid to exit, killing it if deadline passes.  Return
+        its status, its resource usage, and whether it was killed.'''
+        killed = None
+        while True:
+            (pid, status, rusage) = _wait4(childpid, os.WNOHANG)
+            if pid == childpid:
+                self.log.trace('reaped child %d with status %s', pid, status)
+                return (status, rusage, killed)
+            delay = CHILD_POLL_INTERVAL
+            if deadline is not None:
+                now = time.time()
+                if now >= deadline:
+                    if killed is None:
+                        self.log.warning('child %d timed out, terminating\n'
+                                         % childpid)
+                        killed = signal.SIGTERM
+                        deadline = now + CHILD_KILL_GRACE
+                    else:
+                        killed = signal.SIGKILL
+                        deadline = None
+                    try:
+                        os.kill(childpid, killed)
+                    except OSError:
+                        # Exited in the meantime
+                        pass
+                    continue
+                delay = min(delay, deadline - now)
+            self.log.trace('waiting for child %d', childpid)
+            try:
+                select.select([_wakeup_pipe[0]], [], [], delay)
+            except select.error, o:
+                if o[0] != errno.EINTR:
+                    raise
+            try:
+                os.read(_wakeup_pipe[0], 512)
+            except OSError:
+                # Nothing to read
+                pass
 
 # For Python 2.3, which lacks the sorted() builtin
 if sys.hexversion < 0x02040000:
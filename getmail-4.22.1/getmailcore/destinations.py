@@ -26,6 +26,7 @@ __all__ = [
 
 import os
 import re
+import fcntl
 import tempfile
 import types
 import email.Utils
@@ -97,13 +98,32 @@ class DeliverySkeleton(ConfigurableBase):
         return self._deliver_message(msg, delivered_to, received)
 
 #######################################
-class Maildir(DeliverySkeleton, ForkingBase):
+class _ChunkedWriter(object):
+    '''File-like object which passes each string written to it on to file f
+    as a chunk:  a line holding its length, followed by the string.  Used to
+    send messages to the Maildir delivery worker a piece at a time.
+    '''
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, s):
+        if s:
+            self.f.write('%d\n' % len(s))
+            self.f.write(s)
+
+#######################################
+class Maildir(DeliverySkeleton):
     '''Maildir destination.
 
     Parameters:
 
       path - path to maildir, which will be expanded for leading '~/' or
       '~USER/', as well as environment variables.
+
+    Messages are written to the maildir directly when getmail is already
+    running as the delivery user.  When it has to switch to another user, a
+    single worker process is forked which switches user once and then delivers
+    each message it is sent over a pipe, acknowledging each delivery.
     '''
     _confitems = (
         ConfInstance(name='configparser', required=False),
@@ -112,16 +132,26 @@ class Maildir(DeliverySkeleton, ForkingBase):
         ConfString(name='filemode', required=False, default='0600'),
     )
 
+    # The request pipes of all running worker processes, which a worker
+    # forked later closes; otherwise the earlier worker wouldn't exit when
+    # its pipe is closed (say, when --daemon drops the destination on
+    # reloading an rcfile) for as long as the later one is running.
+    _worker_requests = {}
+
     def initialize(self):
         self.log.trace()
         self.hostname = localhostname()
         self.dcount = 0
+        self.__worker = None
         try:
             self.conf['filemode'] = int(self.conf['filemode'], 8)
         except ValueError, o:
             raise getmailConfigurationError('filemode %s not valid: %s'
                                             % (self.conf['filemode'], o))
 
+    def __del__(self):
+        self._stop_worker()
+
     def __str__(self):
         self.log.trace()
         return 'Maildir %s' % self.conf['path']
@@ -129,14 +159,18 @@ class Maildir(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('Maildir(%s)\n' % self._confstring())
 
-    def __deliver_message_maildir(self, uid, gid, msg, delivered_to, received,
-                                  stdout, stderr):
-        '''Delivery method run in separate child process.
+    def __maildir_worker(self, uid, gid, requests, responses):
+        '''Delivery loop run in the worker child process.
+
+        Each request is a line "<delivery count>" followed by the message
+        data in chunks (see _ChunkedWriter) and a terminating "0" line, and is
+        answered with a line "ok <filename>" or "error <reason>".  The worker
+        exits when the request pipe is closed.
         '''
         try:
-            if os.name == 'posix':
-                if uid:
-                    change_uidgid(None, uid, gid)
+            error = None
+            try:
+                change_uidgid(None, uid, gid)
                 if os.geteuid() == 0:
                     raise getmailConfigurationError(
                         'refuse to deliver mail as root'
@@ -145,21 +179,130 @@ class Maildir(DeliverySkeleton, ForkingBase):
                     raise getmailConfigurationError(
                         'refuse to deliver mail as GID 0'
                     )
-            f = deliver_maildir(
-                self.conf['path'], msg.flatten(delivered_to, received),
-                self.hostname, self.dcount, self.conf['filemode']
-            )
-            stdout.write(f)
-            stdout.flush()
-            os.fsync(stdout.fileno())
-            os._exit(0)
-        except StandardError, o:
-            # Child process; any error must cause us to exit nonzero for parent
-            # to detect it
-            stderr.write('maildir delivery process failed (%s)' % o)
-            stderr.flush()
-            os.fsync(stderr.fileno())
+            except StandardError, o:
+                error = o
+            while True:
+                line = requests.readline()
+                if not line:
+                    break
+                dcount = int(line)
+                copied = []
+                def write(f):
+                    copied.append(True)
+                    self.__copy_chunks(requests, f)
+                try:
+                    if error:
+                        raise error
+                    f = deliver_maildir(self.conf['path'], write,
+                                        self.hostname, dcount,
+                                        self.conf['filemode'])
+                    responses.write('ok %s\n' % f)
+                except StandardError, o:
+                    responses.write(
+                        'error maildir delivery process failed (%s)\n'
+                        % str(o).replace('\n', ' ')
+                    )
+                if not copied:
+                    # Delivery failed before reading the message
+                    self.__copy_chunks(requests, None)
+                responses.flush()
+        except:
+            # Child process; never return into the parent's code
             os._exit(127)
+        os._exit(0)
+
+    def __copy_chunks(self, requests, f):
+        '''In the worker, read the chunks of a message up to the terminating
+        "0" line, writing them to f unless it is None.  The whole message is
+        read even if writing fails, so the next request can be read.'''
+        error = None
+        while True:
+            length = int(requests.readline())
+            if not length:
+                break
+            data = requests.read(length)
+            if f is not None and error is None:
+                try:
+                    f.write(data)
+                except IOError, o:
+                    error = o
+        if error:
+            raise error
+
+    def _start_worker(self, uid, gid):
+        '''Fork the worker process which delivers as uid/gid.'''
+        self.log.trace()
+        (requests_r, requests_w) = os.pipe()
+        (responses_r, responses_w) = os.pipe()
+        childpid = os.fork()
+
+        if not childpid:
+            # Child
+            os.close(requests_w)
+            os.close(responses_r)
+            for fd in Maildir._worker_requests.keys():
+                os.close(fd)
+            self.__maildir_worker(uid, gid, os.fdopen(requests_r, 'rb'),
+                                  os.fdopen(responses_w, 'wb'))
+
+        # Parent
+        os.close(requests_r)
+        os.close(responses_w)
+        # Don't leak the pipes to commands run by other destinations or
+        # filters, which would keep the worker alive after we close them
+        for fd in (requests_w, responses_r):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        Maildir._worker_requests[requests_w] = None
+        self.__worker = (childpid, os.fdopen(requests_w, 'wb'),
+                         os.fdopen(responses_r, 'rb'))
+        self.log.debug('spawned maildir delivery process %d\n', childpid)
+
+    def _stop_worker(self):
+        '''Close the pipes to the worker process and wait for it to exit.'''
+        if not getattr(self, '_Maildir__worker', None):
+            return
+        (childpid, requests, responses) = self.__worker
+        self.__worker = None
+        Maildir._worker_requests.pop(requests.fileno(), None)
+        try:
+            requests.close()
+        except IOError:
+            pass
+        responses.close()
+        try:
+            os.waitpid(childpid, 0)
+        except OSError:
+            # Already reaped
+            pass
+
+    def _deliver_by_worker(self, uid, gid, data):
+        '''Deliver data through the worker process, starting it if
+        necessary, and return the maildir filename.'''
+        self.log.trace()
+        if self.__worker is None:
+            self._start_worker(uid, gid)
+        (childpid, requests, responses) = self.__worker
+        try:
+            requests.write('%d\n' % self.dcount)
+            if callable(data):
+                data(_ChunkedWriter(requests))
+            else:
+                _ChunkedWriter(requests).write(data)
+            requests.write('0\n')
+            requests.flush()
+            response = responses.readline()
+        except (IOError, OSError), o:
+            response = ''
+        if not response.endswith('\n'):
+            self._stop_worker()
+            raise getmailDeliveryError('maildir delivery process %d died'
+                                       % childpid)
+        (status, result) = response[:-1].split(' ', 1)
+        if status != 'ok':
+            raise getmailDeliveryError('maildir delivery %d error (%s)'
+                                       % (childpid, result))
+        return result
 
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
@@ -179,34 +322,26 @@ class Maildir(DeliverySkeleton, ForkingBase):
                     raise getmailConfigurationError(
                         'refuse to deliver mail as GID 0'
                     )
-        self._prepare_child()
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
-        childpid = os.fork()
-
-        if not childpid:
-            # Child
-            self.__deliver_message_maildir(uid, gid, msg, delivered_to,
-                                           received, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
-
-        # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
-
-        self.log.debug('maildir delivery process %d exited %d\n'
-                       % (childpid, exitcode))
-
-        if exitcode or err:
-            raise getmailDeliveryError('maildir delivery %d error (%d, %s)'
-                                       % (childpid, exitcode, err))
+        data = msg.flatten_data(delivered_to, received)
+        if uid:
+            out = self._deliver_by_worker(uid, gid, data)
+        else:
+            if os.name == 'posix':
+                if os.geteuid() == 0:
+                    raise getmailDeliveryError(
+                        'maildir delivery error (refuse to deliver mail as '
+                        'root)'
+                    )
+                if os.getegid() == 0:
+                    raise getmailDeliveryError(
+                        'maildir delivery error (refuse to deliver mail as '
+                        'GID 0)'
+                    )
+            out = deliver_maildir(self.conf['path'], data, self.hostname,
+                                  self.dcount, self.conf['filemode'])
 
         self.dcount += 1
-        self.log.debug('maildir file %s' % out)
+        self.log.debug('maildir file %s', out)
         return self
 
 #######################################
@@ -285,8 +420,9 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
             f.seek(0, 2)
             try:
                 # Write out message plus blank line with native EOL
-                f.write(msg.flatten(delivered_to, received, include_from=True,
-                                    mangle_from=True) + os.linesep)
+                msg.flatten_to(f, delivered_to, received, include_from=True,
+                               mangle_from=True)
+                f.write(os.linesep)
                 f.flush()
                 os.fsync(fd)
                 status_new = os.fstat(fd)
@@ -360,7 +496,7 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
             # Child
             self.__deliver_message_mbox(uid, gid, msg, delivered_to, received,
                                         stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+        self.log.debug('spawned child %d\n', childpid)
 
         # Parent
         exitcode = self._wait_for_child(childpid)
@@ -370,15 +506,15 @@ class Mboxrd(DeliverySkeleton, ForkingBase):
         out = stdout.read().strip()
         err = stderr.read().strip()
 
-        self.log.debug('mboxrd delivery process %d exited %d\n'
-                       % (childpid, exitcode))
+        self.log.debug('mboxrd delivery process %d exited %d\n', childpid,
+                       exitcode)
 
         if exitcode or err:
             raise getmailDeliveryError('mboxrd delivery %d error (%d, %s)'
                                        % (childpid, exitcode, err))
 
         if out:
-            self.log.debug('mbox delivery: %s' % out)
+            self.log.debug('mbox delivery: %s', out)
 
         return self
 
@@ -482,7 +618,7 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
                 self.conf['localdomain'], msginfo['sender'],
                 self.conf['defaultdelivery']
             )
-            self.log.debug('about to execl() with args %s\n' % str(args))
+            self.log.debug('about to execl() with args %s\n', str(args))
             # Modify message
             if self.conf['strip_delivered_to']:
                 msg.remove_header('delivered-to')
@@ -490,7 +626,7 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
                 delivered_to = None
             # Write out message
             msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(delivered_to, received))
+            msg.flatten_to(msgfile, delivered_to, received)
             msgfile.flush()
             os.fsync(msgfile.fileno())
             # Rewind
@@ -520,7 +656,6 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
 
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
-        self._prepare_child()
         if msg.recipient == None:
             raise getmailConfigurationError(
                 'MDA_qmaillocal destination requires a message source that '
@@ -531,19 +666,19 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
             'local' : '@'.join(msg.recipient.lower().split('@')[:-1])
         }
 
-        self.log.debug('recipient: extracted local-part "%s"\n'
-                       % msginfo['local'])
+        self.log.debug('recipient: extracted local-part "%s"\n',
+                       msginfo['local'])
         xlate_from, xlate_to = self.conf['localpart_translate']
         if xlate_from or xlate_to:
             if msginfo['local'].startswith(xlate_from):
-                self.log.debug('recipient: translating "%s" to "%s"\n'
-                               % (xlate_from, xlate_to))
+                self.log.debug('recipient: translating "%s" to "%s"\n',
+                               xlate_from, xlate_to)
                 msginfo['local'] = xlate_to + msginfo['local'][len(xlate_from):]
             else:
                 self.log.debug('recipient: does not start with xlate_from '
-                               '"%s"\n' % xlate_from)
-        self.log.debug('recipient: translated local-part "%s"\n'
-                       % msginfo['local'])
+                               '"%s"\n', xlate_from)
+        self.log.debug('recipient: translated local-part "%s"\n',
+                       msginfo['local'])
         if self.conf['conf-break'] in msginfo['local']:
             msginfo['dash'] = self.conf['conf-break']
             msginfo['ext'] = self.conf['conf-break'].join(
@@ -552,9 +687,10 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
         else:
             msginfo['dash'] = ''
             msginfo['ext'] = ''
-        self.log.debug('recipient: set dash to "%s", ext to "%s"\n'
-                       % (msginfo['dash'], msginfo['ext']))
+        self.log.debug('recipient: set dash to "%s", ext to "%s"\n',
+                       msginfo['dash'], msginfo['ext'])
 
+        self._prepare_child()
         stdout = tempfile.TemporaryFile()
         stderr = tempfile.TemporaryFile()
         childpid = os.fork()
@@ -563,7 +699,7 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
             # Child
             self._deliver_qmaillocal(msg, msginfo, delivered_to, received,
                                      stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+        self.log.debug('spawned child %d\n', childpid)
 
         # Parent
         exitcode = self._wait_for_child(childpid)
@@ -573,7 +709,7 @@ class MDA_qmaillocal(DeliverySkeleton, ForkingBase):
         out = stdout.read().strip()
         err = stderr.read().strip()
 
-        self.log.debug('qmail-local %d exited %d\n' % (childpid, exitcode))
+        self.log.debug('qmail-local %d exited %d\n', childpid, exitcode)
 
         if exitcode == 111:
             raise getmailDeliveryError('qmail-local %d temporary error (%s)'
@@ -634,6 +770,15 @@ class MDA_external(DeliverySkeleton, ForkingBase):
 
       ignore_stderr (boolean, optional) - if set, getmail will not consider the
             program writing to stderr to be an error.  The default is False.
+
+      transport (string, optional) - how the message is passed to the command
+            and its output read back: "file" (temporary files, the default),
+            "pipe", or "memfd" (files kept in memory, for commands which need
+            to seek on their input).
+
+      child_timeout (integer, optional) - if set, the command is terminated
+            if it hasn't exited this many seconds after it was started, and
+            the delivery fails.  The default, 0, is no limit.
     '''
     _confitems = (
         ConfInstance(name='configparser', required=False),
@@ -644,6 +789,8 @@ class MDA_external(DeliverySkeleton, ForkingBase):
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='unixfrom', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
+        ConfString(name='transport', required=False, default='file'),
+        ConfInt(name='child_timeout', required=False, default=0),
     )
 
     def initialize(self):
@@ -652,6 +799,10 @@ class MDA_external(DeliverySkeleton, ForkingBase):
         if not os.access(self.conf['path'], os.X_OK):
             raise getmailConfigurationError('%s not executable'
                                             % self.conf['path'])
+        if not self.conf['transport'] in CHILD_TRANSPORTS:
+            raise getmailConfigurationError(
+                'transport must be one of %s' % ', '.join(CHILD_TRANSPORTS)
+            )
         if type(self.conf['arguments']) != tuple:
             raise getmailConfigurationError(
                 'incorrect arguments format; see documentation (%s)'
@@ -666,22 +817,11 @@ class MDA_external(DeliverySkeleton, ForkingBase):
     def showconf(self):
         self.log.info('MDA_external(%s)\n' % self._confstring())
 
-    def _deliver_command(self, msg, msginfo, delivered_to, received,
-                         stdout, stderr):
+    def _deliver_command(self, msginfo, childio):
         try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(delivered_to, received,
-                                      include_from=self.conf['unixfrom']))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
+            # Set stdin to read the message, and stdout and stderr to write to
+            # where we read them back from
+            self._child_setio(childio)
             change_usergroup(self.log, self.conf['user'], self.conf['group'])
             # At least some security...
             if ((os.geteuid() == 0 or os.getegid() == 0)
@@ -696,48 +836,48 @@ class MDA_external(DeliverySkeleton, ForkingBase):
                 for (key, value) in msginfo.items():
                     arg = arg.replace('%%(%s)' % key, value)
                 args.append(arg)
-            self.log.debug('about to execl() with args %s\n' % str(args))
+            self.log.debug('about to execl() with args %s\n', str(args))
             os.execl(*args)
         except StandardError, o:
             # Child process; any error must cause us to exit nonzero for parent
             # to detect it
-            stderr.write('exec of command %s failed (%s)'
-                         % (self.conf['command'], o))
-            stderr.flush()
-            os.fsync(stderr.fileno())
+            os.write(2, 'exec of command %s failed (%s)'
+                     % (self.conf['command'], o))
             os._exit(127)
 
     def _deliver_message(self, msg, delivered_to, received):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
             msginfo['recipient'] = msg.recipient
             msginfo['domain'] = msg.recipient.lower().split('@')[-1]
             msginfo['local'] = '@'.join(msg.recipient.split('@')[:-1])
-        self.log.debug('msginfo "%s"\n' % msginfo)
+        self.log.debug('msginfo "%s"\n', msginfo)
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
+        # Write out message with native EOL convention
+        childio = self._child_io(
+            msg.flatten_data(delivered_to, received,
+                             include_from=self.conf['unixfrom']),
+            self.conf['transport']
+        )
+        self._prepare_child()
         childpid = os.fork()
 
         if not childpid:
             # Child
-            self._deliver_command(msg, msginfo, delivered_to, received,
-                                  stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+            self._deliver_command(msginfo, childio)
+        self.log.debug('spawned child %d\n', childpid)
 
         # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stdout.seek(0)
-        stderr.seek(0)
-        out = stdout.read().strip()
-        err = stderr.read().strip()
+        (exitcode, out, err) = self._child_communicate(
+            childpid, childio, self.conf['child_timeout']
+        )
+        out = out.strip()
+        err = err.strip()
 
-        self.log.debug('command %s %d exited %d\n'
-                       % (self.conf['command'], childpid, exitcode))
+        self.log.debug('command %s %d exited %d\n', self.conf['command'],
+                       childpid, exitcode)
 
         if exitcode:
             raise getmailDeliveryError(
@@ -784,10 +924,10 @@ class MultiDestinationBase(DeliverySkeleton):
                     % path
                 )
             # Construct destination instance
-            self.log.debug('  getting destination for %s\n' % path)
+            self.log.debug('  getting destination for %s\n', path)
             destination_type = self.conf['configparser'].get(destsectionname,
                                                              'type')
-            self.log.debug('    type="%s"\n' % destination_type)
+            self.log.debug('    type="%s"\n', destination_type)
             destination_func = globals().get(destination_type, None)
             if not callable(destination_func):
                 raise getmailConfigurationError(
@@ -799,10 +939,10 @@ class MultiDestinationBase(DeliverySkeleton):
             for (name, value) in self.conf['configparser'].items(destsectionname):
                 if name in ('type', 'configparser'):
                     continue
-                self.log.debug('    parameter %s="%s"\n' % (name, value))
+                self.log.debug('    parameter %s="%s"\n', name, value)
                 destination_args[name] = value
-            self.log.debug('    instantiating destination %s with args %s\n'
-                           % (destination_type, destination_args))
+            self.log.debug('    instantiating destination %s with args %s\n',
+                           destination_type, destination_args)
             dest = destination_func(**destination_args)
         elif (p.startswith('/') or p.startswith('.')) and p.endswith('/'):
             dest = Maildir(path=p)
@@ -989,19 +1129,19 @@ class MultiSorter(MultiSorterBase):
                 'source) that preserves the message envelope'
             )
         for (pattern, dest) in self.targets:
-            self.log.debug('checking recipient %s against pattern %s\n'
-                           % (msg.recipient, pattern.pattern))
+            self.log.debug('checking recipient %s against pattern %s\n',
+                           msg.recipient, pattern.pattern)
             if pattern.search(msg.recipient):
-                self.log.debug('recipient %s matched target %s\n'
-                               % (msg.recipient, dest))
+                self.log.debug('recipient %s matched target %s\n',
+                               msg.recipient, dest)
                 dest.deliver_message(msg, delivered_to, received)
                 matched.append(str(dest))
         if not matched:
             if self.targets:
-                self.log.debug('recipient %s not matched; using default %s\n'
-                               % (msg.recipient, self.default))
+                self.log.debug('recipient %s not matched; using default %s\n',
+                               msg.recipient, self.default)
             else:
-                self.log.debug('using default %s\n' % self.default)
+                self.log.debug('using default %s\n', self.default)
             return 'MultiSorter (default %s)' % self.default.deliver_message(
                 msg, delivered_to, received
             )
@@ -1045,9 +1185,8 @@ class MultiGuesser(MultiSorterBase):
         )
         for fields in fieldnames:
             for field in fields:
-                self.log.debug(
-                    'looking for addresses in %s header fields\n' % field
-                )
+                self.log.debug('looking for addresses in %s header fields\n',
+                               field)
                 header_addrs.extend(
                     [addr for (name, addr) in email.Utils.getaddresses(
                         msg.get_all(field, [])
@@ -1055,19 +1194,19 @@ class MultiGuesser(MultiSorterBase):
                 )
             if header_addrs:
                 # Got some addresses, quit here
-                self.log.debug('found total of %d addresses (%s)\n'
-                               % (len(header_addrs), header_addrs))
+                self.log.debug('found total of %d addresses (%s)\n',
+                               len(header_addrs), header_addrs)
                 break
             else:
                 self.log.debug('no addresses found, continuing\n')
 
         for (pattern, dest) in self.targets:
             for addr in header_addrs:
-                self.log.debug('checking address %s against pattern %s\n'
-                               % (addr, pattern.pattern))
+                self.log.debug('checking address %s against pattern %s\n',
+                               addr, pattern.pattern)
                 if pattern.search(addr):
-                    self.log.debug('address %s matched target %s\n'
-                                   % (addr, dest))
+                    self.log.debug('address %s matched target %s\n', addr,
+                                   dest)
                     dest.deliver_message(msg, delivered_to, received)
                     matched.append(str(dest))
                     # Only deliver once to each destination; this one matched,
@@ -1076,10 +1215,10 @@ class MultiGuesser(MultiSorterBase):
                     break
         if not matched:
             if self.targets:
-                self.log.debug('no addresses matched; using default %s\n'
-                               % self.default)
+                self.log.debug('no addresses matched; using default %s\n',
+                               self.default)
             else:
-                self.log.debug('using default %s\n' % self.default)
+                self.log.debug('using default %s\n', self.default)
             return 'MultiGuesser (default %s)' % self.default.deliver_message(
                 msg, delivered_to, received
             )
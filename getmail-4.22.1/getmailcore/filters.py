@@ -9,12 +9,22 @@ __all__ = [
     'FilterSkeleton',
     'Filter_external',
     'Filter_classifier',
+    'Filter_coprocess',
+    'Filter_python',
+    'RuleSet',
     'Filter_TMDA',
 ]
 
+import sys
 import os
-import tempfile
+import re
+import time
+import signal
+import select
+import errno
+import fcntl
 import types
+import cStringIO
 
 from getmailcore.exceptions import *
 from getmailcore.compatibility import *
@@ -77,8 +87,8 @@ class FilterSkeleton(ConfigurableBase):
         exitcode, newmsg, err = self._filter_message(msg)
         if exitcode in self.exitcodes_drop:
             # Drop message
-            self.log.debug('filter %s returned %d; dropping message\n'
-                           % (self, exitcode))
+            self.log.debug('filter %s returned %d; dropping message\n', self,
+                           exitcode)
             return None
         elif (exitcode not in self.exitcodes_keep):
             raise getmailFilterError('filter %s returned %d (%s)\n'
@@ -162,6 +172,15 @@ class Filter_external(FilterSkeleton, ForkingBase):
 
       ignore_stderr (boolean, optional) - if set, getmail will not consider the
             program writing to stderr to be an error.  The default is False.
+
+      transport (string, optional) - how the message is passed to the command
+            and its output read back: "file" (temporary files, the default),
+            "pipe", or "memfd" (files kept in memory, for commands which need
+            to seek on their input).
+
+      child_timeout (integer, optional) - if set, the command is terminated
+            if it hasn't exited this many seconds after it was started, and
+            the message is not delivered.  The default, 0, is no limit.
     '''
     _confitems = (
         ConfFile(name='path'),
@@ -175,6 +194,8 @@ class Filter_external(FilterSkeleton, ForkingBase):
         ConfString(name='group', required=False, default=None),
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
+        ConfString(name='transport', required=False, default='file'),
+        ConfInt(name='child_timeout', required=False, default=0),
         ConfInstance(name='configparser', required=False),
     )
 
@@ -185,6 +206,10 @@ class Filter_external(FilterSkeleton, ForkingBase):
             raise getmailConfigurationError(
                 '%s not executable' % self.conf['path']
             )
+        if not self.conf['transport'] in CHILD_TRANSPORTS:
+            raise getmailConfigurationError(
+                'transport must be one of %s' % ', '.join(CHILD_TRANSPORTS)
+            )
         if type(self.conf['arguments']) != tuple:
             raise getmailConfigurationError(
                 'incorrect arguments format; see documentation (%s)'
@@ -214,21 +239,11 @@ class Filter_external(FilterSkeleton, ForkingBase):
         self.log.trace()
         self.log.info('Filter_external(%s)\n' % self._confstring())
 
-    def _filter_command(self, msg, msginfo, stdout, stderr):
+    def _filter_command(self, msginfo, childio):
         try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(False, False,
-                                      include_from=self.conf['unixfrom']))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
+            # Set stdin to read the message, and stdout and stderr to write to
+            # where we read them back from
+            self._child_setio(childio)
             change_usergroup(None, self.conf['user'], self.conf['group'])
             args = [self.conf['path'], self.conf['path']]
             for arg in self.conf['arguments']:
@@ -249,14 +264,13 @@ class Filter_external(FilterSkeleton, ForkingBase):
 
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
             msginfo['recipient'] = msg.recipient
             msginfo['domain'] = msg.recipient.lower().split('@')[-1]
             msginfo['local'] = '@'.join(msg.recipient.split('@')[:-1])
-        self.log.debug('msginfo "%s"\n' % msginfo)
+        self.log.debug('msginfo "%s"\n', msginfo)
 
         # At least some security...
         if (os.geteuid() == 0 and not self.conf['allow_root_commands']
@@ -265,26 +279,34 @@ class Filter_external(FilterSkeleton, ForkingBase):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
+        # Write out message with native EOL convention
+        childio = self._child_io(
+            msg.flatten_data(False, False,
+                             include_from=self.conf['unixfrom']),
+            self.conf['transport']
+        )
+        self._prepare_child()
         childpid = os.fork()
 
         if not childpid:
             # Child
-            self._filter_command(msg, msginfo, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+            self._filter_command(msginfo, childio)
+        self.log.debug('spawned child %d\n', childpid)
 
-        # Parent
-        exitcode = self._wait_for_child(childpid)
+        # Parent; the output of a message too large to hold in memory is
+        # kept in a spool file too
+        (exitcode, out, err) = self._child_communicate(
+            childpid, childio, self.conf['child_timeout'], msg.spooled()
+        )
+        err = err.strip()
 
-        stdout.seek(0)
-        stderr.seek(0)
-        err = stderr.read().strip()
+        self.log.debug('command %s %d exited %d\n', self.conf['command'],
+                       childpid, exitcode)
 
-        self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
-                                                      childpid, exitcode))
-
-        newmsg = Message(fromfile=stdout)
+        if msg.spooled():
+            newmsg = Message(fromspool=out)
+        else:
+            newmsg = Message(fromfile=cStringIO.StringIO(out))
 
         return (exitcode, newmsg, err)
 
@@ -306,14 +328,13 @@ class Filter_classifier(Filter_external):
 
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         msginfo = {}
         msginfo['sender'] = msg.sender
         if msg.recipient != None:
             msginfo['recipient'] = msg.recipient
             msginfo['domain'] = msg.recipient.lower().split('@')[-1]
             msginfo['local'] = '@'.join(msg.recipient.split('@')[:-1])
-        self.log.debug('msginfo "%s"\n' % msginfo)
+        self.log.debug('msginfo "%s"\n', msginfo)
 
         # At least some security...
         if (os.geteuid() == 0 and not self.conf['allow_root_commands']
@@ -322,31 +343,572 @@ class Filter_classifier(Filter_external):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
+        # Write out message with native EOL convention
+        childio = self._child_io(
+            msg.flatten_data(False, False,
+                             include_from=self.conf['unixfrom']),
+            self.conf['transport']
+        )
+        self._prepare_child()
         childpid = os.fork()
 
         if not childpid:
             # Child
-            self._filter_command(msg, msginfo, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+            self._filter_command(msginfo, childio)
+        self.log.debug('spawned child %d\n', childpid)
 
         # Parent
-        exitcode = self._wait_for_child(childpid)
+        (exitcode, out, err) = self._child_communicate(
+            childpid, childio, self.conf['child_timeout']
+        )
+        err = err.strip()
 
-        stdout.seek(0)
-        stderr.seek(0)
-        err = stderr.read().strip()
+        self.log.debug('command %s %d exited %d\n', self.conf['command'],
+                       childpid, exitcode)
 
-        self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
-                                                      childpid, exitcode))
-
-        for line in [line.strip() for line in stdout.readlines()
+        for line in [line.strip() for line in out.splitlines()
                      if line.strip()]:
             msg.add_header('X-getmail-filter-classifier', line)
 
         return (exitcode, msg, err)
 
+#######################################
+# Seconds a coprocess is given to exit once its stdin is closed, and then
+# again after SIGTERM, before it is killed.
+COPROCESS_EXIT_GRACE = 2.0
+
+#######################################
+class Filter_coprocess(FilterSkeleton):
+    '''Filter which starts an external command once and passes it each
+    message in turn, rather than running the command once per message.
+
+    For each message, getmail writes a line containing the length of the
+    message in octets, followed by the message itself, to the command's
+    stdin.  The command must answer on its stdout with a line containing an
+    exit code and a length, followed by that many octets of filtered message.
+    A length of 0 means the message is unchanged.  The exit code is
+    interpreted as for Filter_external.  Anything the command writes to
+    stderr is passed through to getmail's stderr.
+
+    If the command dies or breaks the protocol, it is restarted and the
+    message is passed to it again once.
+
+    Parameters:
+
+      path - path to the external filter binary.
+
+      unixfrom - (boolean) whether to include a Unix From_ line at the beginning
+                 of the message.  Defaults to False.
+
+      arguments - a valid Python tuple of strings to be passed as arguments to
+                  the command.  As the command is started only once, the
+                  per-message replacements of Filter_external are not
+                  available.
+
+      exitcodes_keep - if provided, a tuple of integers representing filter exit
+                       codes that mean to pass the message to the next filter or
+                       destination.  Default is (0, ).
+
+      exitcodes_drop - if provided, a tuple of integers representing filter exit
+                       codes that mean to drop the message.  Default is
+                       (99, 100).
+
+      user (string, optional) - if provided, the external command will be run as
+                                the specified user.
+
+      group (string, optional) -  if provided, the external command will be run
+                                with the specified group ID.
+
+      allow_root_commands (boolean, optional) - if set, external commands are
+                                        allowed when running as root.  The
+                                        default is not to allow such behaviour.
+
+      child_timeout (integer, optional) - if set, the command is considered to
+            have failed if it hasn't answered this many seconds after being
+            passed a message, and is restarted.  The default, 0, is no limit.
+    '''
+    _confitems = (
+        ConfFile(name='path'),
+        ConfBool(name='unixfrom', required=False, default=False),
+        ConfTupleOfStrings(name='arguments', required=False, default="()"),
+        ConfTupleOfStrings(name='exitcodes_keep', required=False,
+                           default="(0, )"),
+        ConfTupleOfStrings(name='exitcodes_drop', required=False,
+                           default="(99, 100)"),
+        ConfString(name='user', required=False, default=None),
+        ConfString(name='group', required=False, default=None),
+        ConfBool(name='allow_root_commands', required=False, default=False),
+        ConfInt(name='child_timeout', required=False, default=0),
+        ConfInstance(name='configparser', required=False),
+    )
+
+    def initialize(self):
+        self.log.trace()
+        self.coprocess = None
+        self.conf['command'] = os.path.basename(self.conf['path'])
+        if not os.access(self.conf['path'], os.X_OK):
+            raise getmailConfigurationError(
+                '%s not executable' % self.conf['path']
+            )
+        if type(self.conf['arguments']) != tuple:
+            raise getmailConfigurationError(
+                'incorrect arguments format; see documentation (%s)'
+                % self.conf['arguments']
+            )
+        try:
+            self.exitcodes_keep = [int(i) for i in self.conf['exitcodes_keep']
+                                   if 0 <= int(i) <= 255]
+            self.exitcodes_drop = [int(i) for i in self.conf['exitcodes_drop']
+                                   if 0 <= int(i) <= 255]
+            if not self.exitcodes_keep:
+                raise getmailConfigurationError('exitcodes_keep set empty')
+            if frozenset(self.exitcodes_keep).intersection(
+                frozenset(self.exitcodes_drop)
+            ):
+                raise getmailConfigurationError('exitcode sets intersect')
+        except ValueError, o:
+            raise getmailConfigurationError('invalid exit code specified (%s)'
+                                            % o)
+
+    def __del__(self):
+        self._stop_coprocess()
+
+    def __str__(self):
+        self.log.trace()
+        return 'Filter_coprocess %s (%s)' % (self.conf['command'],
+                                             self._confstring())
+
+    def showconf(self):
+        self.log.trace()
+        self.log.info('Filter_coprocess(%s)\n' % self._confstring())
+
+    def _coprocess_command(self, stdin, stdout):
+        try:
+            os.dup2(stdin, 0)
+            os.dup2(stdout, 1)
+            change_usergroup(None, self.conf['user'], self.conf['group'])
+            args = [self.conf['path'], self.conf['path']]
+            for arg in self.conf['arguments']:
+                args.append(expand_user_vars(arg))
+            os.execl(*args)
+        except StandardError, o:
+            # Child process; any error must cause us to exit nonzero for parent
+            # to detect it
+            self.log.critical('exec of filter %s failed (%s)'
+                              % (self.conf['command'], o))
+            os._exit(127)
+
+    def _start_coprocess(self):
+        self.log.trace()
+        # At least some security...
+        if (os.geteuid() == 0 and not self.conf['allow_root_commands']
+                and self.conf['user'] == None):
+            raise getmailConfigurationError(
+                'refuse to invoke external commands as root by default'
+            )
+        (stdin_r, stdin_w) = os.pipe()
+        (stdout_r, stdout_w) = os.pipe()
+        childpid = os.fork()
+
+        if not childpid:
+            # Child
+            os.close(stdin_w)
+            os.close(stdout_r)
+            self._coprocess_command(stdin_r, stdout_w)
+
+        # Parent
+        os.close(stdin_r)
+        os.close(stdout_w)
+        # Don't leak our ends of the pipes to later children
+        for fd in (stdin_w, stdout_r):
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.coprocess = (childpid, os.fdopen(stdin_w, 'wb'), stdout_r)
+        self.log.debug('spawned coprocess %d\n', childpid)
+
+    def _stop_coprocess(self):
+        '''Close the coprocess's stdin and reap it, terminating it if it
+        doesn't exit on EOF within COPROCESS_EXIT_GRACE seconds, and killing
+        it if it ignores SIGTERM for as long again.'''
+        if not getattr(self, 'coprocess', None):
+            return
+        (childpid, tochild, fromchild) = self.coprocess
+        self.coprocess = None
+        try:
+            tochild.close()
+        except IOError:
+            pass
+        os.close(fromchild)
+        try:
+            for sig in (signal.SIGTERM, signal.SIGKILL):
+                if self._reap_coprocess(childpid, COPROCESS_EXIT_GRACE):
+                    return
+                self.log.debug('coprocess %d still running, sending signal '
+                               '%d\n', childpid, sig)
+                os.kill(childpid, sig)
+            os.waitpid(childpid, 0)
+        except OSError:
+            # Already reaped
+            pass
+
+    def _reap_coprocess(self, childpid, timeout):
+        '''Wait up to timeout seconds for childpid to exit, and return True
+        if it did.'''
+        deadline = time.time() + timeout
+        delay = 0.005
+        while True:
+            if os.waitpid(childpid, os.WNOHANG)[0]:
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+
+    def _read(self, size, deadline):
+        '''Read size octets from the coprocess, or a line if size is None,
+        raising getmailFilterError if deadline passes first.  Returns less if
+        the coprocess exits.'''
+        (childpid, unused, fromchild) = self.coprocess
+        data = []
+        got = 0
+        while size is None or got < size:
+            if deadline is not None:
+                delay = deadline - time.time()
+                ready = []
+                try:
+                    if delay > 0:
+                        (ready, unused, unused) = select.select(
+                            [fromchild], [], [], delay
+                        )
+                except select.error, o:
+                    if o[0] == errno.EINTR:
+                        continue
+                    raise
+                if not ready:
+                    raise getmailFilterError('coprocess %d timed out'
+                                             % childpid)
+            if size is None:
+                # The answer's first line is short; don't read past it
+                chunk = os.read(fromchild, 1)
+            else:
+                chunk = os.read(fromchild, min(size - got, 65536))
+            if not chunk:
+                break
+            data.append(chunk)
+            got += len(chunk)
+            if size is None and chunk == '\n':
+                break
+        return ''.join(data)
+
+    def _exchange(self, data):
+        '''Pass data to the coprocess and return (exitcode, filtered data or
+        None if unchanged).'''
+        (childpid, tochild, fromchild) = self.coprocess
+        deadline = None
+        if self.conf['child_timeout']:
+            deadline = time.time() + self.conf['child_timeout']
+        tochild.write('%d\n' % len(data))
+        tochild.write(data)
+        tochild.flush()
+        line = self._read(None, deadline)
+        if not line.endswith('\n'):
+            raise getmailFilterError('coprocess %d exited' % childpid)
+        try:
+            (exitcode, length) = [int(field) for field in line.split()]
+        except ValueError:
+            raise getmailFilterError('coprocess %d sent malformed response '
+                                     '"%s"' % (childpid, line.strip()))
+        if not length:
+            return (exitcode, None)
+        newdata = self._read(length, deadline)
+        if len(newdata) != length:
+            raise getmailFilterError('coprocess %d exited' % childpid)
+        return (exitcode, newdata)
+
+    def _filter_message(self, msg):
+        self.log.trace()
+        # Write out message with native EOL convention
+        data = msg.flatten(False, False, include_from=self.conf['unixfrom'])
+        for attempt in (1, 2):
+            if self.coprocess is None:
+                self._start_coprocess()
+            try:
+                (exitcode, newdata) = self._exchange(data)
+                break
+            except (IOError, OSError, getmailFilterError), o:
+                self._stop_coprocess()
+                if attempt == 2:
+                    raise getmailFilterError('filter %s failed (%s)'
+                                             % (self, o))
+                self.log.warning('filter %s failed (%s), restarting it\n'
+                                 % (self, o))
+
+        self.log.debug('command %s returned %d\n', self.conf['command'],
+                       exitcode)
+
+        if newdata is None:
+            return (exitcode, msg, '')
+        return (exitcode, Message(fromstring=newdata), '')
+
+#######################################
+class RuleSet(object):
+    '''A list of rules deciding what to do with a message from its header
+    fields and size, as used by Filter_python and getmail's header_triage
+    option.
+
+    rules is a string holding a valid Python tuple of rules, each a tuple of
+    strings (action, test, test arguments...), where action is one of actions;
+    see Filter_python for the tests.  Regular expressions are compiled once,
+    here.  match() returns the first rule matching a message, or None.
+
+    If headeronly is True, the rules will be matched against messages holding
+    only the header, so tests which need the body are refused.
+    '''
+    # Tests which look at the message body
+    body_tests = ('content_type', )
+
+    def __init__(self, rules, actions=('keep', 'drop'), headeronly=False):
+        try:
+            rules = eval(rules)
+            if type(rules) != tuple:
+                raise ValueError('not a tuple')
+        except (ValueError, SyntaxError), o:
+            raise getmailConfigurationError('rules: incorrect format (%s)' % o)
+        self.rules = []
+        for rule in rules:
+            if (type(rule) != tuple or len(rule) < 2
+                    or [part for part in rule if type(part) != str]):
+                raise getmailConfigurationError(
+                    'rules: rule %s not a tuple of strings' % str(rule)
+                )
+            (action, test, args) = (rule[0], rule[1], list(rule[2:]))
+            if not action in actions:
+                raise getmailConfigurationError(
+                    'rules: invalid action "%s" in rule %s' % (action, rule)
+                )
+            negate = test.startswith('!')
+            test = test.lstrip('!')
+            if headeronly and test in self.body_tests:
+                raise getmailConfigurationError(
+                    'rules: test "%s" needs the message body, which is not '
+                    'available here, in rule %s' % (test, str(rule))
+                )
+            try:
+                if test == 'header' and len(args) == 2:
+                    args[1] = re.compile(args[1], re.IGNORECASE)
+                elif test in ('sender', 'recipient', 'content_type') \
+                        and len(args) == 1:
+                    args[0] = re.compile(args[0], re.IGNORECASE)
+                elif (test == 'size' and len(args) == 2
+                        and args[0] in ('<', '<=', '>', '>=')):
+                    args[1] = int(args[1])
+                else:
+                    raise getmailConfigurationError(
+                        'rules: invalid test in rule %s' % str(rule)
+                    )
+            except (re.error, ValueError), o:
+                raise getmailConfigurationError(
+                    'rules: invalid rule %s (%s)' % (str(rule), o)
+                )
+            self.rules.append((rule, negate, getattr(self, '_test_' + test),
+                               tuple(args)))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __str__(self):
+        return str(tuple([rule for (rule, unused, unused, unused)
+                          in self.rules]))
+
+    def actions_used(self, action):
+        '''Return True if any rule has the given action.'''
+        for (rule, unused, unused, unused) in self.rules:
+            if rule[0] == action:
+                return True
+        return False
+
+    def match(self, msg, size=None):
+        '''Return the first rule whose test matches msg, or None.  size is
+        the size of the message if it is known better than from msg, e.g.
+        when msg holds only the header.'''
+        for (rule, negate, test, args) in self.rules:
+            if test(msg, size, *args) != negate:
+                return rule
+        return None
+
+    def _test_header(self, msg, size, name, regex):
+        for value in msg.get_all(name, []):
+            if regex.search(value):
+                return True
+        return False
+
+    def _test_sender(self, msg, size, regex):
+        return bool(regex.search(msg.sender or ''))
+
+    def _test_recipient(self, msg, size, regex):
+        return bool(regex.search(msg.recipient or ''))
+
+    def _test_content_type(self, msg, size, regex):
+        for part in msg.content().walk():
+            if regex.search(part.get_content_type()):
+                return True
+        return False
+
+    def _test_size(self, msg, size, op, octets):
+        if size is None:
+            size = msg.size()
+        if op == '<':
+            return size < octets
+        elif op == '<=':
+            return size <= octets
+        elif op == '>':
+            return size > octets
+        return size >= octets
+
+#######################################
+class Filter_python(FilterSkeleton):
+    '''Filter which runs inside the getmail process, applying a list of header
+    and size rules and/or calling a Python function, instead of running an
+    external command.
+
+    Parameters:
+
+      rules (optional) - a valid Python tuple of rules, each a tuple of strings
+            (action, test, test arguments...).  The first rule whose test
+            matches decides what happens to the message: action "keep" passes
+            it on, and "drop" drops it.  If no rule matches, the message is
+            passed to callable if one is configured, and kept otherwise.  The
+            available tests are:
+
+              ('header', name, regex) - a header field called name has a
+                                        value matching regex
+              ('sender', regex) - the envelope sender matches regex
+              ('recipient', regex) - the envelope recipient matches regex
+              ('content_type', regex) - the content type of the message, or
+                                        of one of its MIME parts, matches regex
+              ('size', op, octets) - the size of the message compares to
+                                     octets using op, one of <, <=, > or >=
+
+            Regular expressions are searched for anywhere in the value,
+            ignoring case.  Prefixing a test with "!" negates it.
+
+            example:
+
+              rules = (('drop', 'header', 'from', r'@spammer\.example>?$'),
+                       ('drop', '!content_type', '^image/jpeg$'))
+
+      callable (optional) - a Python function, named as module.function.  It
+            is imported once, and then called with each message (a
+            getmailcore.message.Message object).  It must return an exit code,
+            interpreted as for Filter_external, or a tuple of an exit code and
+            a new Message object to replace the message with.  Exceptions it
+            raises are reported as filter errors.
+
+      module_path (optional) - a directory to add to the start of the Python
+            module search path before importing callable.
+
+      exitcodes_keep - if provided, a tuple of integers representing exit
+                       codes that mean to pass the message to the next filter or
+                       destination.  Default is (0, ).
+
+      exitcodes_drop - if provided, a tuple of integers representing exit
+                       codes that mean to drop the message.  Default is
+                       (99, 100).
+    '''
+    _confitems = (
+        ConfString(name='rules', required=False, default='()'),
+        ConfString(name='callable', required=False, default=None),
+        ConfString(name='module_path', required=False, default=None),
+        ConfTupleOfStrings(name='exitcodes_keep', required=False,
+                           default="(0, )"),
+        ConfTupleOfStrings(name='exitcodes_drop', required=False,
+                           default="(99, 100)"),
+        ConfInstance(name='configparser', required=False),
+    )
+
+    def initialize(self):
+        self.log.trace()
+        try:
+            self.exitcodes_keep = [int(i) for i in self.conf['exitcodes_keep']
+                                   if 0 <= int(i) <= 255]
+            self.exitcodes_drop = [int(i) for i in self.conf['exitcodes_drop']
+                                   if 0 <= int(i) <= 255]
+            if not self.exitcodes_keep:
+                raise getmailConfigurationError('exitcodes_keep set empty')
+            if frozenset(self.exitcodes_keep).intersection(
+                frozenset(self.exitcodes_drop)
+            ):
+                raise getmailConfigurationError('exitcode sets intersect')
+        except ValueError, o:
+            raise getmailConfigurationError('invalid exit code specified (%s)'
+                                            % o)
+        self.rules = RuleSet(self.conf['rules'])
+        if self.rules.actions_used('drop') and not self.exitcodes_drop:
+            raise getmailConfigurationError('rules: drop action requires '
+                                            'exitcodes_drop')
+        self.function = None
+        if self.conf['callable']:
+            self.function = self._import_callable(self.conf['callable'])
+
+    def _import_callable(self, name):
+        self.log.trace()
+        if self.conf['module_path']:
+            path = expand_user_vars(self.conf['module_path'])
+            if not path in sys.path:
+                sys.path.insert(0, path)
+        i = name.rfind('.')
+        if i < 1:
+            raise getmailConfigurationError(
+                'callable must be given as module.function (%s)' % name
+            )
+        try:
+            module = __import__(name[:i], {}, {}, [name[i + 1:]])
+            function = getattr(module, name[i + 1:])
+        except (ImportError, AttributeError), o:
+            raise getmailConfigurationError('failed importing %s (%s)'
+                                            % (name, o))
+        if not callable(function):
+            raise getmailConfigurationError('%s is not callable' % name)
+        return function
+
+    def __str__(self):
+        self.log.trace()
+        return 'Filter_python (%s)' % self._confstring()
+
+    def showconf(self):
+        self.log.trace()
+        self.log.info('Filter_python(%s)\n' % self._confstring())
+
+    def _filter_message(self, msg):
+        self.log.trace()
+        rule = self.rules.match(msg)
+        if rule is not None:
+            if rule[0] == 'drop':
+                exitcode = self.exitcodes_drop[0]
+            else:
+                exitcode = self.exitcodes_keep[0]
+            self.log.debug('rule %s matched, returning %d\n', rule, exitcode)
+            return (exitcode, msg, '')
+        if self.function is None:
+            return (self.exitcodes_keep[0], msg, '')
+        try:
+            result = self.function(msg)
+        except StandardError, o:
+            raise getmailFilterError('filter %s: %s failed (%s)'
+                                     % (self, self.conf['callable'], o))
+        if type(result) == tuple and len(result) == 2:
+            (exitcode, newmsg) = result
+        else:
+            (exitcode, newmsg) = (result, msg)
+        if (not isinstance(exitcode, (int, long))
+                or not isinstance(newmsg, Message)):
+            raise getmailFilterError(
+                'filter %s: %s returned %r, not an exit code or a tuple of '
+                'an exit code and a Message' % (self, self.conf['callable'],
+                                                result)
+            )
+        return (exitcode, newmsg, '')
+
 #######################################
 class Filter_TMDA(FilterSkeleton, ForkingBase):
     '''Filter which runs the message through TMDA's tmda-filter program
@@ -375,6 +937,15 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
 
       conf-break - used to break envelope recipient to find EXT.  Defaults
                                 to "-".
+
+      transport (string, optional) - how the message is passed to the command
+            and its output read back: "file" (temporary files, the default),
+            "pipe", or "memfd" (files kept in memory, for commands which need
+            to seek on their input).
+
+      child_timeout (integer, optional) - if set, the command is terminated
+            if it hasn't exited this many seconds after it was started, and
+            the message is not delivered.  The default, 0, is no limit.
     '''
     _confitems = (
         ConfFile(name='path', default='/usr/local/bin/tmda-filter'),
@@ -383,6 +954,8 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
         ConfBool(name='allow_root_commands', required=False, default=False),
         ConfBool(name='ignore_stderr', required=False, default=False),
         ConfString(name='conf-break', required=False, default='-'),
+        ConfString(name='transport', required=False, default='file'),
+        ConfInt(name='child_timeout', required=False, default=0),
         ConfInstance(name='configparser', required=False),
     )
 
@@ -393,6 +966,10 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
             raise getmailConfigurationError(
                 '%s not executable' % self.conf['path']
             )
+        if not self.conf['transport'] in CHILD_TRANSPORTS:
+            raise getmailConfigurationError(
+                'transport must be one of %s' % ', '.join(CHILD_TRANSPORTS)
+            )
         self.exitcodes_keep = (0, )
         self.exitcodes_drop = (99, )
 
@@ -404,20 +981,11 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
         self.log.trace()
         self.log.info('Filter_TMDA(%s)\n' % self._confstring())
 
-    def _filter_command(self, msg, stdout, stderr):
+    def _filter_command(self, msg, childio):
         try:
-            # Write out message with native EOL convention
-            msgfile = tempfile.TemporaryFile()
-            msgfile.write(msg.flatten(True, True, include_from=True))
-            msgfile.flush()
-            os.fsync(msgfile.fileno())
-            # Rewind
-            msgfile.seek(0)
-            # Set stdin to read from this file
-            os.dup2(msgfile.fileno(), 0)
-            # Set stdout and stderr to write to files
-            os.dup2(stdout.fileno(), 1)
-            os.dup2(stderr.fileno(), 2)
+            # Set stdin to read the message, and stdout and stderr to write to
+            # where we read them back from
+            self._child_setio(childio)
             change_usergroup(None, self.conf['user'], self.conf['group'])
             args = [self.conf['path'], self.conf['path']]
             # Set environment for TMDA
@@ -430,7 +998,7 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
             )
             self.log.trace('SENDER="%(SENDER)s",RECIPIENT="%(RECIPIENT)s"'
                            ',EXT="%(EXT)s"' % os.environ)
-            self.log.debug('about to execl() with args %s\n' % str(args))
+            self.log.debug('about to execl() with args %s\n', str(args))
             os.execl(*args)
         except StandardError, o:
             # Child process; any error must cause us to exit nonzero for parent
@@ -441,7 +1009,6 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
 
     def _filter_message(self, msg):
         self.log.trace()
-        self._prepare_child()
         if msg.recipient == None or msg.sender == None:
             raise getmailConfigurationError(
                 'TMDA requires the message envelope and therefore a multidrop '
@@ -455,22 +1022,25 @@ class Filter_TMDA(FilterSkeleton, ForkingBase):
                 'refuse to invoke external commands as root by default'
             )
 
-        stdout = tempfile.TemporaryFile()
-        stderr = tempfile.TemporaryFile()
+        # Write out message with native EOL convention
+        childio = self._child_io(msg.flatten_data(True, True,
+                                                  include_from=True),
+                                 self.conf['transport'])
+        self._prepare_child()
         childpid = os.fork()
 
         if not childpid:
             # Child
-            self._filter_command(msg, stdout, stderr)
-        self.log.debug('spawned child %d\n' % childpid)
+            self._filter_command(msg, childio)
+        self.log.debug('spawned child %d\n', childpid)
 
         # Parent
-        exitcode = self._wait_for_child(childpid)
-
-        stderr.seek(0)
-        err = stderr.read().strip()
+        (exitcode, unused, err) = self._child_communicate(
+            childpid, childio, self.conf['child_timeout']
+        )
+        err = err.strip()
 
-        self.log.debug('command %s %d exited %d\n' % (self.conf['command'],
-                                                      childpid, exitcode))
+        self.log.debug('command %s %d exited %d\n', self.conf['command'],
+                       childpid, exitcode)
 
         return (exitcode, msg, err)
@@ -5,6 +5,13 @@ The new standard Python libary module logging didn't cut it for me; it doesn't
 seem capable of handling some very simple requirements like logging messages of
 a certain level to one fd, and other messages of higher levels to a different fd
 (i.e. info to stdout, warnings to stderr).
+
+All levels accept %-format arguments after the message, which are only
+applied when the message is actually going to be output.  trace(), debug() and
+moreinfo() are called a great deal, so they also return immediately when no
+handler accepts their level:
+
+  log.debug('msgsizes: %s%s', msgsizes, os.linesep)
 '''
 
 __all__ = [
@@ -26,6 +33,7 @@ class _Logger(object):
         '''Create a logger.'''
         self.handlers = []
         self.newline = False
+        self._setenabled()
 
     def __call__(self):
         return self
@@ -41,6 +49,7 @@ class _Logger(object):
         '''
         self.handlers.append({'minlevel' : minlevel, 'stream' : stream,
                               'newline' : True, 'maxlevel' : maxlevel})
+        self._setenabled()
 
     def clearhandlers(self):
         '''Clear the list of handlers.
@@ -49,6 +58,21 @@ class _Logger(object):
         would require an easy way for the caller to distinguish between them.
         '''
         self.handlers = []
+        self._setenabled()
+
+    def _setenabled(self):
+        '''Work out which levels any handler will output, for
+        isEnabledFor().'''
+        self.enabled = {}
+        for level in (TRACE, DEBUG, MOREINFO, INFO, WARNING, ERROR, CRITICAL):
+            self.enabled[level] = not self.handlers
+            for handler in self.handlers:
+                if handler['minlevel'] <= level <= handler['maxlevel']:
+                    self.enabled[level] = True
+
+    def isEnabledFor(self, level):
+        '''Return True if messages of level <level> would be output.'''
+        return self.enabled[level]
 
     def log(self, msglevel, msgtxt):
         '''Log a message of level <msglevel> containing text <msgtxt>.'''
@@ -73,13 +97,23 @@ class _Logger(object):
             else:
                 self.newline = False
 
-    def trace(self, msg='trace\n'):
+    def trace(self, msg='trace\n', *args):
         '''Log a message with level TRACE.
 
         The message will be prefixed with filename, line number, and function
         name of the calling code.
         '''
-        trace = traceback.extract_stack()[-2]
+        if not self.enabled[TRACE]:
+            return
+        if args:
+            msg = msg % args
+        try:
+            frame = sys._getframe(1)
+            trace = (frame.f_code.co_filename, frame.f_lineno,
+                     frame.f_code.co_name)
+        except AttributeError:
+            # No sys._getframe() in this Python implementation
+            trace = traceback.extract_stack()[-2]
         msg = '%s [%s:%i] %s' % (trace[FUNCNAME] + '()',
             os.path.basename(trace[FILENAME]),
             trace[LINENO],
@@ -87,28 +121,44 @@ class _Logger(object):
         )
         self.log(TRACE, msg)
 
-    def debug(self, msg):
+    def debug(self, msg, *args):
         '''Log a message with level DEBUG.'''
+        if not self.enabled[DEBUG]:
+            return
+        if args:
+            msg = msg % args
         self.log(DEBUG, msg)
 
-    def moreinfo(self, msg):
+    def moreinfo(self, msg, *args):
         '''Log a message with level MOREINFO.'''
+        if not self.enabled[MOREINFO]:
+            return
+        if args:
+            msg = msg % args
         self.log(MOREINFO, msg)
 
-    def info(self, msg):
+    def info(self, msg, *args):
         '''Log a message with level INFO.'''
+        if args:
+            msg = msg % args
         self.log(INFO, msg)
 
-    def warning(self, msg):
+    def warning(self, msg, *args):
         '''Log a message with level WARNING.'''
+        if args:
+            msg = msg % args
         self.log(WARNING, msg)
 
-    def error(self, msg):
+    def error(self, msg, *args):
         '''Log a message with level ERROR.'''
+        if args:
+            msg = msg % args
         self.log(ERROR, msg)
 
-    def critical(self, msg):
+    def critical(self, msg, *args):
         '''Log a message with level CRITICAL.'''
+        if args:
+            msg = msg % args
         self.log(CRITICAL, msg)
 
 Logger = _Logger()
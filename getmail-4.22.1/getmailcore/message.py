@@ -8,6 +8,8 @@ __all__ = [
 ]
 
 import os
+import re
+import mmap
 import time
 import cStringIO
 import email
@@ -29,6 +31,12 @@ message_attributes = (
     'recipient'
 )
 
+# Same as the email module's generator uses for mangle_from
+mangle_from_re = re.compile(r'^From ', re.MULTILINE)
+
+# Size of the pieces in which flatten_to() writes out the body of a message
+FLATTEN_CHUNK_SIZE = 1048576
+
 #######################################
 def corrupt_message(why, fromlines=None, fromstring=None):
     log = getmailcore.logging.Logger()
@@ -64,59 +72,178 @@ class Message(object):
     '''Message class for getmail.  Does sanity-checking on attribute accesses
     and provides some convenient interfaces to an underlying email.Message()
     object.
+
+    The message is kept as its raw header block and body, converted to native
+    EOL.  The header block is only parsed when a header is asked for, and the
+    whole message is only parsed when content() is called, as the caller may
+    then change the body.  Until then, flatten() writes out the (possibly
+    changed) header fields followed by the original body, as is.
+
+    A message can also be read from a spool file (fromspool), a temporary
+    file holding the message with native EOL, for messages too large to keep
+    in memory.  The file is then mapped into memory rather than read, and
+    destinations should use flatten_to() or flatten_data(), which write the
+    body out a piece at a time, instead of flatten().
     '''
     __slots__ = (
         '__msg',
-        '__raw',
+        '__headers',
+        '__headertext',
+        '__body',
+        '__bodystart',
+        '__sender',
         #'log',
-        'sender',
         'received_by',
         'received_from',
         'received_with',
         'recipient',
     )
-    def __init__(self, fromlines=None, fromstring=None, fromfile=None):
+    def __init__(self, fromlines=None, fromstring=None, fromfile=None,
+                 fromspool=None):
         #self.log = Logger()
         self.recipient = None
         self.received_by = None
         self.received_from = None
         self.received_with = None
-        self.__raw = None
-        parser = email.Parser.Parser()
+        self.__sender = None
+        self.__msg = None
+        self.__headers = None
 
         # Message is instantiated with fromlines for POP3, fromstring for
         # IMAP (both of which can be badly-corrupted or invalid, i.e. spam,
         # MS worms, etc).  It's instantiated with fromfile for the output
-        # of filters, etc, which should be saner.
+        # of filters, etc, which should be saner, and with fromspool for
+        # large messages retrieved into a spool file.  Parsing is deferred,
+        # so errors from the parser are handled when the message is used.
+        if fromfile:
+            # The output of a filter may be empty
+            fromstring = fromfile.read() or os.linesep
+        elif fromspool is not None:
+            fromspool.flush()
+            size = os.fstat(fromspool.fileno()).st_size
+            if size:
+                fromstring = mmap.mmap(fromspool.fileno(), size,
+                                       access=mmap.ACCESS_READ)
+            else:
+                fromstring = os.linesep
+        if (isinstance(fromstring, str) and os.linesep != '\r\n'
+                and '\r\n' in fromstring):
+            # IMAP data not converted to native EOL when it was read
+            fromstring = fromstring.replace('\r\n', os.linesep)
         if fromlines:
             try:
-                self.__msg = parser.parsestr(os.linesep.join(fromlines))
-            except email.Errors.MessageError, o:
-                self.__msg = corrupt_message(o, fromlines=fromlines)
-            self.__raw = os.linesep.join(fromlines)
+                i = fromlines.index('')
+            except ValueError:
+                i = len(fromlines)
+            self.__headertext = os.linesep.join(fromlines[:i] + [''])
+            self.__body = os.linesep.join(fromlines[i + 1:])
+            self.__bodystart = 0
         elif fromstring:
-            try:
-                self.__msg = parser.parsestr(fromstring)
-            except email.Errors.MessageError, o:
-                self.__msg = corrupt_message(o, fromstring=fromstring)
-            self.__raw = fromstring
-        elif fromfile:
-            try:
-                self.__msg = parser.parse(fromfile)
-            except email.Errors.MessageError, o:
-                # Shouldn't happen
-                self.__msg = corrupt_message(o, fromstring=fromfile.read())
-            # fromfile is only used by getmail_maildir, getmail_mbox, and
-            # from reading the output of a filter.  Ignore __raw here.
+            # The body is left in place, so that it is never copied
+            sep = os.linesep
+            if fromstring[:len(sep)] == sep:
+                i = 0
+            else:
+                i = fromstring.find(sep + sep)
+                if i == -1:
+                    i = len(fromstring)
+                else:
+                    i += len(sep)
+            self.__headertext = fromstring[:i]
+            self.__body = fromstring
+            self.__bodystart = min(i + len(sep), len(fromstring))
         else:
             # Can't happen?
             raise SystemExit('Message() called with wrong arguments')
 
-        self.sender = address_no_brackets(self.__msg['return-path']
-                                          or 'unknown')
+    def __raw(self):
+        '''Return the original message as a string.'''
+        # Concatenating buffers copies the body only once, into the result
+        return str(buffer(self.__headertext + os.linesep)
+                   + buffer(self.__body, self.__bodystart))
+
+    def __bodychunks(self, mangle_from=False):
+        '''Generate the body in pieces of about FLATTEN_CHUNK_SIZE octets,
+        split at line ends, with a final EOL added if it is missing.  A body
+        held in memory is generated whole, as a buffer object referring to it
+        rather than a copy, unless mangle_from is set.'''
+        body = self.__body
+        start = self.__bodystart
+        end = len(body)
+        while start < end:
+            if isinstance(body, str):
+                # Already in memory; one piece is cheapest
+                stop = end
+                chunk = buffer(body, start)
+            else:
+                stop = body.find('\n', min(start + FLATTEN_CHUNK_SIZE, end))
+                if stop == -1:
+                    stop = end
+                else:
+                    stop += 1
+                chunk = body[start:stop]
+            if mangle_from:
+                chunk = mangle_from_re.sub('>From ', chunk)
+            yield chunk
+            start = stop
+        sep = os.linesep
+        if end > self.__bodystart and body[end - len(sep):end] != sep:
+            yield sep
+
+    def spooled(self):
+        '''Return True if the message is kept in a spool file rather than in
+        memory.'''
+        return not isinstance(self.__body, str)
+
+    def __parse(self):
+        '''Parse the whole message, keeping any changes already made to its
+        header fields.'''
+        if self.__msg is not None:
+            return self.__msg
+        raw = self.__raw()
+        try:
+            msg = email.Parser.Parser().parsestr(raw)
+            if self.__headers is not None:
+                msg._headers = self.__headers._headers
+        except email.Errors.MessageError, o:
+            msg = corrupt_message(o, fromstring=raw)
+        self.__msg = msg
+        self.__headers = None
+        return msg
+
+    def __getheaders(self):
+        '''Return an email.Message() object holding the header fields of the
+        message (and, if the whole message has been parsed, its body).'''
+        if self.__msg is not None:
+            return self.__msg
+        if self.__headers is None:
+            try:
+                headers = email.Parser.HeaderParser().parsestr(
+                    self.__headertext
+                )
+            except email.Errors.MessageError, o:
+                return self.__parse()
+            if headers.get_payload():
+                # Malformed header block; the parser took part of it for the
+                # body, so the raw body can't simply be appended.
+                return self.__parse()
+            self.__headers = headers
+        return self.__headers
+
+    def __getsender(self):
+        if self.__sender is None:
+            self.__sender = address_no_brackets(
+                self.__getheaders()['return-path'] or 'unknown'
+            )
+        return self.__sender
+
+    def __setsender(self, sender):
+        self.__sender = sender
+
+    sender = property(__getsender, __setsender)
 
     def content(self):
-        return self.__msg
+        return self.__parse()
 
     def copyattrs(self, othermsg):
         for attr in message_attributes:
@@ -126,12 +253,69 @@ class Message(object):
                 include_from=False):
         '''Return a string with native EOL convention.
 
-        The email module apparently doesn't always use native EOL, so we force
-        it by writing out what we need, letting the generator write out the
-        message, splitting it into lines, and joining them with the platform
-        EOL.
+        If the body has not been parsed, the header fields are written out
+        followed by the original body.  Otherwise the email module's
+        generator writes out the message.  The email module apparently doesn't
+        always use native EOL, so in that case we force it by splitting its
+        output into lines, and joining them with the platform EOL.
         '''
         f = cStringIO.StringIO()
+        self.__writetrace(f, delivered_to, received, include_from)
+        if self.__msg is None:
+            self.__writefields(f)
+            if self.spooled():
+                return f.getvalue() + ''.join(self.__bodychunks(mangle_from))
+            data = buffer(f.getvalue())
+            for chunk in self.__bodychunks(mangle_from):
+                # Concatenating buffers gives a string; for a body held in
+                # memory, that is the only copy made of it
+                data = buffer(data) + chunk
+            return str(data)
+        gen = Generator(f, mangle_from, 0)
+        # From_ handled above, always tell the generator not to include it
+        try:
+            gen.flatten(self.__msg, False)
+            f.seek(0)
+            return os.linesep.join(f.read().splitlines() + [''])
+        except TypeError, o:
+            # email module chokes on some badly-misformatted messages, even
+            # late during flatten().  Hope this is fixed in Python 2.4.
+            self.__msg = corrupt_message(o, fromstring=self.__raw())
+            return self.flatten(delivered_to, received, mangle_from,
+                                include_from)
+
+    def flatten_to(self, fileobj, delivered_to, received, mangle_from=False,
+                   include_from=False):
+        '''Write the message to fileobj as flatten() would return it.  Unless
+        the body has been parsed, the header fields are written first and then
+        the body a piece at a time, so that the message is never held in
+        memory whole, and a body already in memory is not copied.'''
+        if self.__msg is not None:
+            fileobj.write(self.flatten(delivered_to, received, mangle_from,
+                                       include_from))
+            return
+        f = cStringIO.StringIO()
+        self.__writetrace(f, delivered_to, received, include_from)
+        self.__writefields(f)
+        fileobj.write(f.getvalue())
+        for chunk in self.__bodychunks(mangle_from):
+            fileobj.write(chunk)
+
+    def flatten_data(self, delivered_to, received, mangle_from=False,
+                     include_from=False):
+        '''Return the message as flatten() does, or for a spooled message, a
+        function which writes it to a file object passed to it as
+        flatten_to() does.'''
+        if not self.spooled():
+            return self.flatten(delivered_to, received, mangle_from,
+                                include_from)
+        def write(fileobj):
+            self.flatten_to(fileobj, delivered_to, received, mangle_from,
+                            include_from)
+        return write
+
+    def __writetrace(self, f, delivered_to, received, include_from):
+        '''Write the From_ line if requested, and the trace header fields.'''
         if include_from:
             # This needs to be written out first, so we can't rely on the
             # generator
@@ -140,7 +324,8 @@ class Message(object):
         # Write the Return-Path: header
         f.write(format_header('Return-Path', '<%s>' % self.sender))
         # Remove previous Return-Path: header fields.
-        del self.__msg['Return-Path']
+        headers = self.__getheaders()
+        del headers['Return-Path']
         if delivered_to:
             f.write(format_header('Delivered-To', self.recipient or 'unknown'))
         if received:
@@ -152,32 +337,27 @@ class Message(object):
             content += '; ' + time.strftime('%d %b %Y %H:%M:%S -0000',
                                             time.gmtime())
             f.write(format_header('Received', content))
-        gen = Generator(f, mangle_from, 0)
-        # From_ handled above, always tell the generator not to include it
-        try:
-            gen.flatten(self.__msg, False)
-            f.seek(0)
-            return os.linesep.join(f.read().splitlines() + [''])
-        except TypeError, o:
-            # email module chokes on some badly-misformatted messages, even
-            # late during flatten().  Hope this is fixed in Python 2.4.
-            if self.__raw is None:
-                # Argh -- a filter took a correctly-formatted message
-                # and returned a badly-misformatted one?
-                raise getmailDeliveryError('failed to parse retrieved message '
-                                           'and could not recover (%s)' % o)
-            self.__msg = corrupt_message(o, fromstring=self.__raw)
-            return self.flatten(delivered_to, received, mangle_from,
-                                include_from)
+
+    def __writefields(self, f):
+        '''Write the header fields of an unparsed message, and the blank line
+        ending them.'''
+        for (name, value) in self.__getheaders().items():
+            f.write('%s: %s%s' % (name, value, os.linesep))
+        f.write(os.linesep)
 
     def add_header(self, name, content):
-        self.__msg[name] = content.rstrip()
+        self.__getheaders()[name] = content.rstrip()
 
     def remove_header(self, name):
-        del self.__msg[name]
+        del self.__getheaders()[name]
 
     def headers(self):
-        return self.__msg._headers
+        return self.__getheaders()._headers
+
+    def size(self):
+        '''Return the size of the message as retrieved, with native EOL.'''
+        return (len(self.__headertext) + len(os.linesep) + len(self.__body)
+                - self.__bodystart)
 
     def get_all(self, name, failobj=None):
-        return self.__msg.get_all(name, failobj)
+        return self.__getheaders().get_all(name, failobj)
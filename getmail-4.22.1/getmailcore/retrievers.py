@@ -63,6 +63,7 @@ class SimplePOP3Retriever(POP3RetrieverBase, POP3initMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
         ConfBool(name='delete_dup_msgids', required=False, default=False),
     )
     received_from = None
@@ -96,9 +97,12 @@ class SimplePOP3SSLRetriever(POP3RetrieverBase, POP3SSLinitMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
         ConfBool(name='delete_dup_msgids', required=False, default=False),
         ConfFile(name='keyfile', required=False, default=None),
         ConfFile(name='certfile', required=False, default=None),
+        ConfInt(name='ssl_read_size', required=False,
+                default=SSL_READ_SIZE),
     )
     received_from = None
     received_with = 'POP3-SSL'
@@ -168,6 +172,7 @@ class BrokenUIDLPOP3Retriever(BrokenUIDLPOP3RetrieverBase, POP3initMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
     )
     received_with = 'POP3'
 
@@ -198,8 +203,11 @@ class BrokenUIDLPOP3SSLRetriever(BrokenUIDLPOP3RetrieverBase, POP3SSLinitMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
         ConfFile(name='keyfile', required=False, default=None),
         ConfFile(name='certfile', required=False, default=None),
+        ConfInt(name='ssl_read_size', required=False,
+                default=SSL_READ_SIZE),
     )
     received_with = 'POP3-SSL'
 
@@ -230,6 +238,7 @@ class MultidropPOP3Retriever(MultidropPOP3RetrieverBase, POP3initMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
         ConfString(name='envelope_recipient'),
     )
     received_from = None
@@ -263,9 +272,12 @@ class MultidropPOP3SSLRetriever(MultidropPOP3RetrieverBase, POP3SSLinitMixIn):
         ConfString(name='username'),
         ConfPassword(name='password', required=False, default=None),
         ConfBool(name='use_apop', required=False, default=False),
+        ConfInt(name='pipelining_window', required=False, default=0),
         ConfString(name='envelope_recipient'),
         ConfFile(name='keyfile', required=False, default=None),
         ConfFile(name='certfile', required=False, default=None),
+        ConfInt(name='ssl_read_size', required=False,
+                default=SSL_READ_SIZE),
     )
     received_from = None
     received_with = 'POP3-SSL'
@@ -359,6 +371,16 @@ class SimpleIMAPRetriever(IMAPRetrieverBase, IMAPinitMixIn):
         ConfTupleOfStrings(name='mailboxes', required=False,
                            default="('INBOX', )"),
         ConfString(name='move_on_delete', required=False, default=None),
+        ConfInt(name='delete_batch_size', required=False, default=100),
+        ConfBool(name='incremental_sync', required=False, default=False),
+        ConfString(name='search', required=False, default=None),
+        ConfInt(name='fetch_batch_size', required=False, default=0),
+        ConfInt(name='backfill_connections', required=False, default=0),
+        ConfBool(name='mailbox_connections', required=False, default=False),
+        ConfTupleOfStrings(name='fetch_content_types', required=False,
+                           default='()'),
+        ConfBool(name='use_binary', required=False, default=False),
+        ConfBool(name='use_compression', required=False, default=True),
         # imaplib.IMAP4.login_cram_md5() requires the (unimplemented)
         # .authenticate(), so we can't do this yet (?).
         ConfBool(name='use_cram_md5', required=False, default=False),
@@ -398,6 +420,16 @@ class SimpleIMAPSSLRetriever(IMAPRetrieverBase, IMAPSSLinitMixIn):
         ConfTupleOfStrings(name='mailboxes', required=False,
                            default="('INBOX', )"),
         ConfString(name='move_on_delete', required=False, default=None),
+        ConfInt(name='delete_batch_size', required=False, default=100),
+        ConfBool(name='incremental_sync', required=False, default=False),
+        ConfString(name='search', required=False, default=None),
+        ConfInt(name='fetch_batch_size', required=False, default=0),
+        ConfInt(name='backfill_connections', required=False, default=0),
+        ConfBool(name='mailbox_connections', required=False, default=False),
+        ConfTupleOfStrings(name='fetch_content_types', required=False,
+                           default='()'),
+        ConfBool(name='use_binary', required=False, default=False),
+        ConfBool(name='use_compression', required=False, default=True),
         ConfFile(name='keyfile', required=False, default=None),
         ConfFile(name='certfile', required=False, default=None),
         # imaplib.IMAP4.login_cram_md5() requires the (unimplemented)
@@ -438,6 +470,16 @@ class MultidropIMAPRetriever(MultidropIMAPRetrieverBase, IMAPinitMixIn):
         ConfTupleOfStrings(name='mailboxes', required=False,
                            default="('INBOX', )"),
         ConfString(name='move_on_delete', required=False, default=None),
+        ConfInt(name='delete_batch_size', required=False, default=100),
+        ConfBool(name='incremental_sync', required=False, default=False),
+        ConfString(name='search', required=False, default=None),
+        ConfInt(name='fetch_batch_size', required=False, default=0),
+        ConfInt(name='backfill_connections', required=False, default=0),
+        ConfBool(name='mailbox_connections', required=False, default=False),
+        ConfTupleOfStrings(name='fetch_content_types', required=False,
+                           default='()'),
+        ConfBool(name='use_binary', required=False, default=False),
+        ConfBool(name='use_compression', required=False, default=True),
         # imaplib.IMAP4.login_cram_md5() requires the (unimplemented)
         # .authenticate(), so we can't do this yet (?).
         ConfBool(name='use_cram_md5', required=False, default=False),
@@ -478,6 +520,16 @@ class MultidropIMAPSSLRetriever(MultidropIMAPRetrieverBase, IMAPSSLinitMixIn):
         ConfTupleOfStrings(name='mailboxes', required=False,
                            default="('INBOX', )"),
         ConfString(name='move_on_delete', required=False, default=None),
+        ConfInt(name='delete_batch_size', required=False, default=100),
+        ConfBool(name='incremental_sync', required=False, default=False),
+        ConfString(name='search', required=False, default=None),
+        ConfInt(name='fetch_batch_size', required=False, default=0),
+        ConfInt(name='backfill_connections', required=False, default=0),
+        ConfBool(name='mailbox_connections', required=False, default=False),
+        ConfTupleOfStrings(name='fetch_content_types', required=False,
+                           default='()'),
+        ConfBool(name='use_binary', required=False, default=False),
+        ConfBool(name='use_compression', required=False, default=True),
         ConfFile(name='keyfile', required=False, default=None),
         ConfFile(name='certfile', required=False, default=None),
         # imaplib.IMAP4.login_cram_md5() requires the (unimplemented)
@@ -225,6 +225,9 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600):
     for new files (modern delivery identifiers).  See
     http://cr.yp.to/proto/maildir.html and
     http://qmail.org/man/man5/maildir.html for details.
+
+    data is the message, or a function which writes the message to a file
+    object passed to it.
     '''
     if not is_maildir(maildirpath):
         raise getmailDeliveryError('not a Maildir (%s)' % maildirpath)
@@ -289,7 +292,10 @@ def deliver_maildir(maildirpath, data, hostname, dcount=None, filemode=0600):
     # Open file to write
     try:
         f = safe_open(fname_tmp, 'wb', filemode)
-        f.write(data)
+        if callable(data):
+            data(f)
+        else:
+            f.write(data)
         f.flush()
         os.fsync(f.fileno())
         f.close()
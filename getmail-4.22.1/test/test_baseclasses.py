@@ -0,0 +1,103 @@
+#!/usr/bin/env python2.3
+'''Tests for waiting on children in getmailcore.baseclasses.ForkingBase.'''
+
+import os
+import sys
+import time
+import signal
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore import logging, baseclasses
+from getmailcore.exceptions import getmailOperationError
+
+log = logging.Logger()
+
+#######################################
+class Forker(baseclasses.ForkingBase):
+    log = log
+
+    def fork(self, sleep=0, exitcode=0, ignore_term=False):
+        '''Fork a child which sleeps for sleep seconds, then exits with
+        exitcode.'''
+        self._prepare_child()
+        childpid = os.fork()
+        if not childpid:
+            try:
+                if ignore_term:
+                    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+                time.sleep(sleep)
+            finally:
+                os._exit(exitcode)
+        return childpid
+
+#######################################
+class WaitForChildTest(unittest.TestCase):
+    def setUp(self):
+        self.grace = baseclasses.CHILD_KILL_GRACE
+        baseclasses.CHILD_KILL_GRACE = 0.3
+        self.forker = Forker()
+        # Timing children out is expected here; don't warn about it
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.ERROR)
+
+    def tearDown(self):
+        baseclasses.CHILD_KILL_GRACE = self.grace
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.WARNING)
+
+    def reaped(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return True
+        return False
+
+    def test_exitcode(self):
+        pid = self.forker.fork(exitcode=3)
+        self.assertEqual(self.forker._wait_for_child(pid, 5), 3)
+        self.failUnless(self.reaped(pid))
+
+    def test_timeout(self):
+        pid = self.forker.fork(sleep=60)
+        started = time.time()
+        self.assertRaises(getmailOperationError, self.forker._wait_for_child,
+                          pid, 0.2)
+        # Terminated, without waiting for the grace period
+        self.failUnless(time.time() - started < 0.3 + 0.5)
+        self.failUnless(self.reaped(pid))
+
+    def test_timeout_kill(self):
+        # Ignores SIGTERM, so is only stopped by SIGKILL after the grace
+        # period
+        pid = self.forker.fork(sleep=60, ignore_term=True)
+        time.sleep(0.1)
+        started = time.time()
+        self.assertRaises(getmailOperationError, self.forker._wait_for_child,
+                          pid, 0.2)
+        self.failUnless(time.time() - started >= 0.2 + 0.3)
+        self.failUnless(self.reaped(pid))
+
+    def test_several_children(self):
+        # Each child is reaped by the call for its own pid, whichever exits
+        # first, and the call returns as soon as it has exited
+        slow = self.forker.fork(sleep=0.5, exitcode=1)
+        fast = self.forker.fork(sleep=0.1, exitcode=2)
+        started = time.time()
+        self.assertEqual(self.forker._wait_for_child(fast, 5), 2)
+        self.failUnless(time.time() - started < 0.4)
+        self.failIf(self.reaped(slow))
+        self.assertEqual(self.forker._wait_for_child(slow, 5), 1)
+        self.failUnless(self.reaped(slow))
+
+    def test_killed_by_signal(self):
+        pid = self.forker.fork(sleep=60)
+        os.kill(pid, signal.SIGKILL)
+        self.assertRaises(getmailOperationError, self.forker._wait_for_child,
+                          pid)
+        self.failUnless(self.reaped(pid))
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
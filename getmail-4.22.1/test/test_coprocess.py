@@ -0,0 +1,161 @@
+#!/usr/bin/env python2.3
+'''Tests for Filter_coprocess in getmailcore.filters.'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore import logging, filters
+from getmailcore.exceptions import getmailFilterError
+from getmailcore.message import Message
+
+log = logging.Logger()
+
+# The coprocess.  argv[1] is how it behaves, and argv[2] a file to which it
+# appends its pid when it is ready.
+COPROCESS = '''#!%s
+import os, sys, time, signal
+(mode, starts) = sys.argv[1:3]
+if mode == 'noterm':
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+crashed = os.path.exists(starts)
+open(starts, 'a').write('%%d\\n' %% os.getpid())
+count = 0
+while True:
+    line = sys.stdin.readline()
+    if not line:
+        break
+    data = sys.stdin.read(int(line))
+    count += 1
+    if mode == 'crash-once' and not crashed:
+        sys.exit(1)
+    if mode in ('hang', 'noterm'):
+        time.sleep(60)
+    if mode == 'same':
+        sys.stdout.write('0 0\\n')
+    elif mode == 'drop':
+        sys.stdout.write('99 0\\n')
+    else:
+        data = 'X-Count: %%d%%s%%s' %% (count, os.linesep, data)
+        sys.stdout.write('0 %%d\\n%%s' %% (len(data), data))
+    sys.stdout.flush()
+''' % sys.executable
+
+#######################################
+class CoprocessTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'coprocess')
+        f = open(self.path, 'w')
+        f.write(COPROCESS)
+        f.close()
+        os.chmod(self.path, 0755)
+        self.starts = os.path.join(self.dir, 'starts')
+        self.grace = filters.COPROCESS_EXIT_GRACE
+        filters.COPROCESS_EXIT_GRACE = 0.2
+        self.filters = []
+        # Restarting the coprocess is expected here; don't warn about it
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.ERROR)
+
+    def tearDown(self):
+        for f in self.filters:
+            f._stop_coprocess()
+        filters.COPROCESS_EXIT_GRACE = self.grace
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.WARNING)
+        shutil.rmtree(self.dir)
+
+    def filter(self, mode, timeout=0):
+        f = filters.Filter_coprocess(
+            path=self.path, arguments=str((mode, self.starts)),
+            allow_root_commands=True, child_timeout=timeout
+        )
+        self.filters.append(f)
+        return f
+
+    def msg(self):
+        return Message(fromstring='Subject: test%s%sbody%s'
+                       % (os.linesep, os.linesep, os.linesep))
+
+    def pids(self):
+        '''Return the pids of the coprocesses started so far.'''
+        try:
+            return [int(line) for line in open(self.starts)]
+        except IOError:
+            return []
+
+    def running(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def test_protocol(self):
+        f = self.filter('count')
+        for count in ('1', '2'):
+            (exitcode, msg, err) = f._filter_message(self.msg())
+            self.assertEqual(exitcode, 0)
+            self.assertEqual(msg.get_all('x-count'), [count])
+            self.assertEqual(msg.get_all('subject'), ['test'])
+        # Both messages went to the same process
+        self.assertEqual(len(self.pids()), 1)
+
+    def test_unchanged_and_drop(self):
+        msg = self.msg()
+        self.assertEqual(self.filter('same')._filter_message(msg),
+                         (0, msg, ''))
+        self.assertEqual(self.filter('drop')._filter_message(msg)[0], 99)
+
+    def test_restart_after_crash(self):
+        (exitcode, msg, err) = self.filter('crash-once')._filter_message(
+            self.msg()
+        )
+        self.assertEqual(msg.get_all('x-count'), ['1'])
+        pids = self.pids()
+        self.assertEqual(len(pids), 2)
+        self.failIf(self.running(pids[0]))
+
+    def test_timeout(self):
+        f = self.filter('hang', timeout=1)
+        started = time.time()
+        self.assertRaises(getmailFilterError, f._filter_message, self.msg())
+        # Timed out once, restarted, and timed out again
+        self.failUnless(time.time() - started >= 2)
+        pids = self.pids()
+        self.assertEqual(len(pids), 2)
+        for pid in pids:
+            self.failIf(self.running(pid))
+        self.assertEqual(f.coprocess, None)
+
+    def test_stop(self):
+        f = self.filter('count')
+        f._start_coprocess()
+        pid = f.coprocess[0]
+        f._stop_coprocess()
+        # Exited on EOF
+        self.failIf(self.running(pid))
+        self.assertEqual(f.coprocess, None)
+
+    def test_stop_kills(self):
+        # Ignores EOF (busy) and SIGTERM, so is only stopped by SIGKILL
+        f = self.filter('noterm')
+        f._start_coprocess()
+        while not self.pids():
+            time.sleep(0.01)
+        f.coprocess[1].write('2\nab')
+        f.coprocess[1].flush()
+        started = time.time()
+        f._stop_coprocess()
+        self.failUnless(time.time() - started >= 0.4)
+        self.failIf(self.running(self.pids()[0]))
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python2.3
+'''Tests for the Maildir delivery worker in getmailcore.destinations.'''
+
+import os
+import sys
+import pwd
+import signal
+import shutil
+import tempfile
+import unittest
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore import logging
+from getmailcore.exceptions import getmailDeliveryError
+from getmailcore.message import Message
+from getmailcore.destinations import Maildir, _ChunkedWriter
+
+log = logging.Logger()
+log.clearhandlers()
+log.addhandler(sys.stderr, logging.WARNING)
+
+#######################################
+class ChunkedWriterTest(unittest.TestCase):
+    def test_write(self):
+        f = cStringIO.StringIO()
+        w = _ChunkedWriter(f)
+        w.write('abc')
+        w.write('')
+        w.write('de\nf')
+        self.assertEqual(f.getvalue(), '3\nabc4\nde\nf')
+
+#######################################
+class MaildirWorkerTest(unittest.TestCase):
+    '''Delivery through the worker process, which is only used when getmail
+    has to switch to another user, so these only run as root.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.maildir = None
+        try:
+            self.user = pwd.getpwnam('nobody')
+        except KeyError:
+            return
+        if os.geteuid() != 0:
+            return
+        os.chmod(self.dir, 0755)
+        for subdir in ('cur', 'new', 'tmp'):
+            os.mkdir(os.path.join(self.dir, subdir))
+            os.chmod(os.path.join(self.dir, subdir), 0777)
+        self.maildir = Maildir(path=self.dir + '/', user='nobody')
+
+    def tearDown(self):
+        if self.maildir is not None:
+            self.maildir._stop_worker()
+        shutil.rmtree(self.dir)
+
+    def deliver(self, data):
+        return self.maildir._deliver_by_worker(self.user.pw_uid,
+                                               self.user.pw_gid, data)
+
+    def worker(self):
+        return self.maildir._Maildir__worker
+
+    def delivered(self):
+        '''Return the contents of the delivered messages.'''
+        new = os.path.join(self.dir, 'new')
+        names = os.listdir(new)
+        names.sort()
+        result = []
+        for name in names:
+            path = os.path.join(new, name)
+            self.assertEqual(os.stat(path).st_uid, self.user.pw_uid)
+            result.append(open(path).read())
+        return result
+
+    def test_deliveries(self):
+        if self.maildir is None:
+            return
+        self.deliver('A: 1\n\none\n')
+        pid = self.worker()[0]
+        # A message too large to hold in memory is written in pieces
+        def write(f):
+            f.write('A: 2\n\n')
+            f.write('')
+            f.write('two\n' * 20000)
+        self.deliver(write)
+        msg = Message(fromstring='A: 3\n\nthree\n')
+        msg.sender = 'someone@example.org'
+        self.maildir._deliver_message(msg, False, False)
+        # All through the one worker
+        self.assertEqual(self.worker()[0], pid)
+        contents = self.delivered()
+        contents.sort()
+        self.assertEqual(contents, ['A: 1\n\none\n',
+                                    'A: 2\n\n' + 'two\n' * 20000,
+                                    'Return-Path: <someone@example.org>\n'
+                                    'A: 3\n\nthree\n'])
+
+    def test_error_keeps_worker(self):
+        if self.maildir is None:
+            return
+        self.deliver('A: 1\n\none\n')
+        pid = self.worker()[0]
+        os.chmod(os.path.join(self.dir, 'tmp'), 0755)
+        self.assertRaises(getmailDeliveryError, self.deliver,
+                          'A: 2\n\ntwo\n')
+        os.chmod(os.path.join(self.dir, 'tmp'), 0777)
+        # The failed message was read to its end, and the worker carries on
+        self.deliver('A: 3\n\nthree\n')
+        self.assertEqual(self.worker()[0], pid)
+        contents = self.delivered()
+        contents.sort()
+        self.assertEqual(contents, ['A: 1\n\none\n', 'A: 3\n\nthree\n'])
+
+    def test_worker_died(self):
+        if self.maildir is None:
+            return
+        self.deliver('A: 1\n\none\n')
+        pid = self.worker()[0]
+        os.kill(pid, signal.SIGKILL)
+        self.assertRaises(getmailDeliveryError, self.deliver,
+                          'A: 2\n\ntwo\n')
+        self.assertEqual(self.worker(), None)
+        # Reaped
+        self.assertRaises(OSError, os.kill, pid, 0)
+        # A new worker is started for the next message
+        self.deliver('A: 3\n\nthree\n')
+        self.failIfEqual(self.worker()[0], pid)
+
+    def test_stop(self):
+        if self.maildir is None:
+            return
+        self.deliver('A: 1\n\none\n')
+        pid = self.worker()[0]
+        self.maildir._stop_worker()
+        self.assertEqual(self.worker(), None)
+        self.assertRaises(OSError, os.kill, pid, 0)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python2.3
+'''Tests for getmailcore._imapdeflate.'''
+
+import os
+import sys
+import zlib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore._imapdeflate import DeflateStream
+from getmailcore.exceptions import getmailOperationError
+
+#######################################
+def deflate(data):
+    '''Return data compressed as raw DEFLATE, as a server would send it.'''
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                  -15)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+#######################################
+class FakeConnection(object):
+    '''Stands in for the socket; recv() returns data in the given pieces,
+    never more than asked for, and sendall() keeps what it is given.'''
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.sent = []
+
+    def recv(self, size):
+        if not self.pieces:
+            return ''
+        data = self.pieces.pop(0)
+        if len(data) > size:
+            self.pieces.insert(0, data[size:])
+            data = data[:size]
+        return data
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+#######################################
+class DeflateStreamTest(unittest.TestCase):
+    def stream(self, pieces, readsize=16384):
+        self.conn = FakeConnection(pieces)
+        return DeflateStream(self.conn.recv, self.conn.sendall, readsize)
+
+    def lines(self, s):
+        out = []
+        while True:
+            line = s.readline()
+            if not line:
+                return out
+            out.append(line)
+
+    def test_readline(self):
+        data = ''.join(['* %d EXISTS\r\n' % i for i in range(500)])
+        compressed = deflate(data)
+        for readsize in (1, 5, 64, 16384):
+            s = self.stream([compressed], readsize)
+            self.assertEqual(''.join(self.lines(s)), data)
+            self.assertEqual(s.received, len(data))
+            self.assertEqual(s.received_compressed, len(compressed))
+
+    def test_read_across_lines(self):
+        # A literal is read with read() after the line announcing it
+        s = self.stream([deflate('* 1 FETCH (RFC822 {10}\r\n0123456789)\r\n'
+                                 'A1 OK done\r\n')], 7)
+        self.assertEqual(s.readline(), '* 1 FETCH (RFC822 {10}\r\n')
+        self.assertEqual(s.read(10), '0123456789')
+        self.assertEqual(s.readline(), ')\r\n')
+        self.assertEqual(s.readline(), 'A1 OK done\r\n')
+        self.assertEqual(s.read(5), '')
+
+    def test_partial_line_at_eof(self):
+        s = self.stream([deflate('one\r\ntw')])
+        self.assertEqual(self.lines(s), ['one\r\n', 'tw'])
+
+    def test_send(self):
+        s = self.stream([])
+        s.send('A1 NOOP\r\n')
+        s.send('A2 LOGOUT\r\n')
+        # Each command can be decompressed as soon as it arrives
+        decompressor = zlib.decompressobj(-15)
+        self.assertEqual(decompressor.decompress(self.conn.sent[0]),
+                         'A1 NOOP\r\n')
+        self.assertEqual(decompressor.decompress(self.conn.sent[1]),
+                         'A2 LOGOUT\r\n')
+        self.assertEqual(s.sent, 20)
+        self.assertEqual(s.sent_compressed,
+                         len(self.conn.sent[0]) + len(self.conn.sent[1]))
+
+    def test_bad_data(self):
+        s = self.stream(['\xff' * 16])
+        self.assertRaises(getmailOperationError, s.readline)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python2.3
+'''Tests for getmailcore.logging.'''
+
+import os
+import sys
+import unittest
+import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore.constants import *
+from getmailcore.logging import Logger
+
+#######################################
+class LoggerTest(unittest.TestCase):
+    def setUp(self):
+        self.log = Logger()
+        self.out = StringIO.StringIO()
+        self.log.clearhandlers()
+        self.log.addhandler(self.out, INFO)
+
+    def tearDown(self):
+        # Leave the shared logger as the other tests expect it
+        self.log.clearhandlers()
+        self.log.addhandler(sys.stderr, WARNING)
+
+    def test_all_levels_format_arguments(self):
+        for method in (self.log.info, self.log.warning, self.log.error,
+                       self.log.critical):
+            method('%s of %d\n', 'one', 2)
+        self.assertEqual(self.out.getvalue(), 'one of 2\n' * 4)
+
+    def test_message_without_arguments_is_not_formatted(self):
+        self.log.info('100% done\n')
+        self.assertEqual(self.out.getvalue(), '100% done\n')
+
+    def test_disabled_levels_skip_formatting(self):
+        # A bad format would raise if it were applied
+        self.log.debug('%d\n', 'not a number')
+        self.log.trace('%d\n', 'not a number')
+        self.assertEqual(self.out.getvalue(), '')
+        self.failIf(self.log.isEnabledFor(DEBUG))
+        self.failUnless(self.log.isEnabledFor(WARNING))
+
+    def test_enabled_lower_level(self):
+        self.log.addhandler(self.out, DEBUG, DEBUG)
+        self.log.debug('%s=%d\n', 'x', 1)
+        self.assertEqual(self.out.getvalue(), 'x=1\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python2.3
+'''Tests for getmailcore.message.'''
+
+import os
+import sys
+import unittest
+import tempfile
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore.message import Message
+
+HEADER = 'From: a@example.org\nSubject: test\n'
+BODY = 'line one\nFrom here\nline three\n'
+
+#######################################
+class MessageTest(unittest.TestCase):
+    def flat(self, msg, **kwargs):
+        return msg.flatten(False, False, **kwargs).replace(os.linesep, '\n')
+
+    def native(self, s):
+        return s.replace('\n', os.linesep)
+
+    def test_crlf_and_native_input_agree(self):
+        native = Message(fromstring=self.native(HEADER + '\n' + BODY))
+        crlf = Message(fromstring=(HEADER + '\n' + BODY).replace('\n', '\r\n'))
+        lines = Message(fromlines=(HEADER + '\n' + BODY).split('\n'))
+        for msg in (native, crlf, lines):
+            self.assertEqual(self.flat(msg),
+                             'Return-Path: <unknown>\n' + HEADER
+                             + '\n' + BODY)
+            self.assertEqual(msg.get_all('subject'), ['test'])
+
+    def test_header_change_keeps_body(self):
+        msg = Message(fromstring=self.native(HEADER + '\n' + BODY))
+        msg.add_header('X-Test', 'yes')
+        out = self.flat(msg)
+        self.failUnless('\nX-Test: yes\n\n' + BODY in out)
+
+    def test_mangle_from_and_missing_final_eol(self):
+        msg = Message(fromstring=self.native(HEADER + '\n' + BODY.rstrip()))
+        out = self.flat(msg, mangle_from=True)
+        self.failUnless(out.endswith('\n>From here\nline three\n'))
+
+    def test_no_body(self):
+        msg = Message(fromstring=self.native(HEADER.rstrip()))
+        self.assertEqual(msg.get_all('from'), ['a@example.org'])
+        self.failUnless(self.flat(msg).endswith('Subject: test\n\n'))
+
+    def test_flatten_to_matches_flatten(self):
+        for text in (HEADER + '\n' + BODY, HEADER + '\n' + BODY.rstrip()):
+            msg = Message(fromstring=self.native(text))
+            f = cStringIO.StringIO()
+            msg.flatten_to(f, False, False, mangle_from=True)
+            self.assertEqual(f.getvalue(),
+                             msg.flatten(False, False, mangle_from=True))
+
+    def test_spooled(self):
+        spool = tempfile.TemporaryFile()
+        spool.write(self.native(HEADER + '\n' + BODY))
+        msg = Message(fromspool=spool)
+        self.failUnless(msg.spooled())
+        self.assertEqual(msg.size(), len(self.native(HEADER + '\n' + BODY)))
+        f = cStringIO.StringIO()
+        msg.flatten_to(f, False, False)
+        self.assertEqual(f.getvalue().replace(os.linesep, '\n'),
+                         'Return-Path: <unknown>\n' + HEADER + '\n'
+                         + BODY)
+
+    def test_parsed_content(self):
+        msg = Message(fromstring=self.native(HEADER + '\n' + BODY))
+        self.assertEqual(msg.content().get_payload().replace(os.linesep, '\n'),
+                         BODY)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python2.3
+'''Tests for getmailcore._pop3ssl.'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore._pop3ssl import sslsocket
+
+#######################################
+class FakeSSL(object):
+    '''Stands in for an SSL object; read() returns data in the given pieces,
+    never more than asked for.'''
+    def __init__(self, pieces):
+        self.pieces = list(pieces)
+        self.reads = []
+
+    def read(self, size):
+        self.reads.append(size)
+        if not self.pieces:
+            return ''
+        data = self.pieces.pop(0)
+        if len(data) > size:
+            self.pieces.insert(0, data[size:])
+            data = data[:size]
+        return data
+
+#######################################
+class ReadlineTest(unittest.TestCase):
+    def sock(self, pieces, readsize=16384):
+        # Bypass __init__, which wants a connected socket
+        s = object.__new__(sslsocket)
+        s.ssl = FakeSSL(pieces)
+        s.readsize = readsize
+        s.buf = ''
+        s.pos = 0
+        return s
+
+    def lines(self, s):
+        out = []
+        while True:
+            line = s.readline()
+            if not line:
+                return out
+            out.append(line)
+
+    def test_lines_in_one_block(self):
+        s = self.sock(['+OK\r\nline one\r\n.\r\n'])
+        self.assertEqual(self.lines(s), ['+OK\r\n', 'line one\r\n', '.\r\n'])
+
+    def test_lines_split_across_reads(self):
+        data = ''.join(['line %d\r\n' % i for i in range(100)])
+        for readsize in (1, 3, 7, 64, 16384):
+            s = self.sock([data], readsize)
+            self.assertEqual(''.join(self.lines(s)), data)
+            self.failIf([n for n in s.ssl.reads if n != readsize])
+
+    def test_partial_line_at_eof(self):
+        s = self.sock(['one\r\ntw', 'o'])
+        self.assertEqual(self.lines(s), ['one\r\n', 'two'])
+
+    def test_reads_in_large_blocks(self):
+        data = 'x' * 100 + '\r\n'
+        s = self.sock([data * 1000], 16384)
+        self.assertEqual(len(self.lines(s)), 1000)
+        self.failUnless(len(s.ssl.reads) <= len(data) * 1000 / 16384 + 2)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
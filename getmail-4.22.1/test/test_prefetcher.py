@@ -0,0 +1,140 @@
+#!/usr/bin/env python2.3
+'''Tests for the Prefetcher in the getmail script.'''
+
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore.exceptions import getmailRetrievalError, \
+    getmailOperationError
+
+# The getmail script isn't a module; run it without calling main()
+script = {'__name__' : 'getmail'}
+execfile(os.path.join(os.path.dirname(__file__), os.pardir, 'getmail'),
+         script)
+Prefetcher = script['Prefetcher']
+
+#######################################
+class FakeRetriever:
+    '''Retrieves each message as its msgid, raising errors[msgid] instead if
+    there is one.'''
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.calls = []
+        self.busy = threading.Lock()
+        self.overlapped = False
+
+    def record(self, call):
+        if not self.busy.acquire(False):
+            self.overlapped = True
+            return
+        try:
+            self.calls.append(call)
+            time.sleep(0.01)
+        finally:
+            self.busy.release()
+
+    def getmsg(self, msgid):
+        self.record(('getmsg', msgid))
+        if msgid in self.errors:
+            raise self.errors[msgid]
+        return 'message %s' % msgid
+
+    def delivered(self, msgid):
+        self.record(('delivered', msgid))
+
+    def delmsg(self, msgid):
+        self.record(('delmsg', msgid))
+
+    def retrieved(self):
+        return [msgid for (call, msgid) in self.calls if call == 'getmsg']
+
+#######################################
+class PrefetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.prefetchers = []
+
+    def tearDown(self):
+        for p in self.prefetchers:
+            p.stop()
+
+    def prefetcher(self, retriever, msgids, depth=2):
+        p = Prefetcher(retriever, msgids, depth)
+        self.prefetchers.append(p)
+        return p
+
+    def test_order(self):
+        r = FakeRetriever()
+        msgids = ['1', '2', '3', '4', '5']
+        p = self.prefetcher(r, msgids)
+        for msgid in msgids:
+            self.assertEqual(p.getmsg(msgid), 'message %s' % msgid)
+            p.delivered(msgid)
+            p.delmsg(msgid)
+        self.assertEqual(r.retrieved(), msgids)
+        # The acknowledgements went to the retriever in order, and no call
+        # overlapped one made by the retrieval thread
+        self.assertEqual([c for c in r.calls if c[0] != 'getmsg'],
+                         [(call, msgid) for msgid in msgids
+                          for call in ('delivered', 'delmsg')])
+        self.failIf(r.overlapped)
+
+    def test_depth(self):
+        r = FakeRetriever()
+        p = self.prefetcher(r, ['1', '2', '3', '4', '5'], depth=1)
+        time.sleep(0.3)
+        # One message queued, and the thread blocked with the next
+        self.assertEqual(r.retrieved(), ['1', '2'])
+        self.assertEqual(p.getmsg('1'), 'message 1')
+        time.sleep(0.3)
+        self.assertEqual(r.retrieved(), ['1', '2', '3'])
+
+    def test_skipped(self):
+        r = FakeRetriever()
+        p = self.prefetcher(r, ['1', '2', '3'])
+        self.assertEqual(p.getmsg('1'), 'message 1')
+        # Not wanted after all; its prefetched copy is discarded
+        self.assertEqual(p.getmsg('3'), 'message 3')
+        # Messages not expected are retrieved directly
+        self.assertEqual(p.getmsg('9'), 'message 9')
+        self.assertEqual(r.retrieved(), ['1', '2', '3', '9'])
+
+    def test_retrieval_error(self):
+        r = FakeRetriever({'2' : getmailRetrievalError('gone')})
+        p = self.prefetcher(r, ['1', '2', '3'])
+        self.assertEqual(p.getmsg('1'), 'message 1')
+        # Raised for its own message only, and retrieval carries on
+        self.assertRaises(getmailRetrievalError, p.getmsg, '2')
+        self.assertEqual(p.getmsg('3'), 'message 3')
+        self.assertEqual(r.retrieved(), ['1', '2', '3'])
+
+    def test_other_error(self):
+        r = FakeRetriever({'2' : getmailOperationError('connection lost')})
+        p = self.prefetcher(r, ['1', '2', '3'])
+        self.assertRaises(getmailOperationError, p.getmsg, '2')
+        # The thread stopped at the error; later messages are retrieved
+        # directly, where the error surfaces again if it persists
+        p.thread.join(5)
+        self.failIf(p.thread.isAlive())
+        self.assertEqual(r.retrieved(), ['1', '2'])
+        self.assertEqual(p.getmsg('3'), 'message 3')
+        self.assertEqual(r.retrieved(), ['1', '2', '3'])
+
+    def test_stop(self):
+        r = FakeRetriever()
+        p = self.prefetcher(r, [str(i) for i in range(100)], depth=1)
+        self.assertEqual(p.getmsg('0'), 'message 0')
+        (elapsed, retrieving, delivering) = p.stop()
+        self.failIf(p.thread.isAlive())
+        self.failUnless(len(r.retrieved()) < 100)
+        self.failUnless(elapsed > 0)
+        self.failUnless(0 <= retrieving <= 1)
+        self.failUnless(0 <= delivering <= 1)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,683 @@
+#!/usr/bin/env python2.3
+'''Tests for the IMAP retriever internals in getmailcore._retrieverbases.'''
+
+import os
+import sys
+import email
+import shutil
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore import logging, _retrieverbases
+from getmailcore.exceptions import getmailOperationError, \
+    getmailRetrievalError
+from getmailcore.retrievers import SimpleIMAPRetriever
+
+log = logging.Logger()
+log.clearhandlers()
+log.addhandler(sys.stderr, logging.WARNING)
+
+#######################################
+def imap_retriever(getmaildir, **args):
+    '''Return a SimpleIMAPRetriever which is never connected.'''
+    return SimpleIMAPRetriever(server='imap.example.org', username='user',
+                               password='password', getmaildir=getmaildir,
+                               **args)
+
+#######################################
+class UIDStateTest(unittest.TestCase):
+    '''_write_uidstatefile() after a session which listed UIDs 1 to 5 of
+    INBOX, whose UIDNEXT is 6.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        r = imap_retriever(self.dir, incremental_sync=True)
+        r.uidstate_filename = os.path.join(self.dir, 'uidstate')
+        r.app_options = {'max_message_size' : 0, 'max_bytes_per_session' : 0}
+        r.gotmsglist = True
+        r._listedstate = {'INBOX' : ('7', 6)}
+        r._mboxuids = {}
+        r._mboxuidorder = []
+        for uid in range(1, 6):
+            msgid = '7/INBOX/%d' % uid
+            r._mboxuids[msgid] = ('INBOX', str(uid))
+            r._mboxuidorder.append(msgid)
+            r.msgsizes[msgid] = 100
+        self.retriever = r
+
+    def tearDown(self):
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def seen(self, *uids):
+        for uid in uids:
+            self.retriever.oldmail['7/INBOX/%d' % uid] = 1
+
+    def saved(self):
+        self.retriever._write_uidstatefile()
+        return self.retriever._read_uidstatefile()
+
+    def test_all_retrieved(self):
+        self.seen(1, 2, 3, 4, 5)
+        self.assertEqual(self.saved(), {'INBOX' : ('7', 6)})
+
+    def test_unretrieved_message_is_listed_again(self):
+        self.seen(1, 2, 4, 5)
+        self.assertEqual(self.saved(), {'INBOX' : ('7', 3)})
+
+    def test_oversized_message_does_not_hold_back(self):
+        self.seen(1, 2, 4, 5)
+        self.retriever.msgsizes['7/INBOX/3'] = 5000
+        self.retriever.app_options['max_message_size'] = 1000
+        self.assertEqual(self.saved(), {'INBOX' : ('7', 6)})
+
+    def test_max_bytes_per_session(self):
+        self.seen(1, 2, 5)
+        self.retriever.msgsizes['7/INBOX/3'] = 5000
+        self.retriever.app_options['max_bytes_per_session'] = 1000
+        # Message 3 can never be retrieved, but 4 can in a later session
+        self.assertEqual(self.saved(), {'INBOX' : ('7', 4)})
+
+    def test_triage_skip_does_not_hold_back(self):
+        self.seen(1, 2, 4, 5)
+        self.retriever.not_retrieving('7/INBOX/3')
+        self.assertEqual(self.saved(), {'INBOX' : ('7', 6)})
+
+#######################################
+class FakeConnection(object):
+    '''Stands in for an imaplib connection, serving data as if it came from
+    the server.'''
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def _get_line(self):
+        end = self.data.index('\r\n', self.pos)
+        line = self.data[self.pos:end]
+        self.pos = end + 2
+        return line
+
+    def read(self, size):
+        data = self.data[self.pos:self.pos + size]
+        self.pos += len(data)
+        return data
+
+#######################################
+class ResponseTest(unittest.TestCase):
+    '''_readresponse() and _parseresponse().'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = imap_retriever(self.dir)
+        self.retriever.app_options = {}
+        self.chunksize = _retrieverbases.SPOOL_CHUNK_SIZE
+
+    def tearDown(self):
+        _retrieverbases.SPOOL_CHUNK_SIZE = self.chunksize
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def read(self, data):
+        return self.retriever._readresponse(FakeConnection(data))
+
+    def test_no_literal(self):
+        self.assertEqual(self.read('* 1 EXISTS\r\n* 2 EXISTS\r\n'),
+                         ['* 1 EXISTS'])
+
+    def test_literals(self):
+        segments = self.read('* 1 FETCH (UID 7 RFC822.HEADER {12}\r\n'
+                             'A: b\r\nC: d\r\n RFC822.TEXT {3}\r\nx\r\n)\r\n')
+        self.assertEqual(segments, [
+            '* 1 FETCH (UID 7 RFC822.HEADER {12}',
+            'A: b' + os.linesep + 'C: d' + os.linesep,
+            ' RFC822.TEXT {3}', 'x' + os.linesep, ')',
+        ])
+        self.assertEqual(self.retriever._parseresponse(segments), [
+            '*', '1', 'FETCH', ['UID', '7',
+                                'RFC822.HEADER', segments[1],
+                                'RFC822.TEXT', segments[3]],
+        ])
+
+    def test_binary_literals_kept(self):
+        # Decoded BINARY content is not converted, whether the server sends
+        # it as a binary literal or, having no NULs, as an ordinary one
+        self.assertEqual(self.read('* 1 FETCH (BINARY[2] ~{5}\r\n'
+                                   '\0\r\n\r\n)\r\n'),
+                         ['* 1 FETCH (BINARY[2] ~{5}', '\0\r\n\r\n', ')'])
+        self.assertEqual(self.read('* 1 FETCH (BINARY[2] {4}\r\n'
+                                   'a\r\nb)\r\n'),
+                         ['* 1 FETCH (BINARY[2] {4}', 'a\r\nb', ')'])
+
+    def test_spooled_literal(self):
+        # A CRLF split between two reads is still converted
+        _retrieverbases.SPOOL_CHUNK_SIZE = 5
+        self.retriever.app_options['max_in_memory_message_size'] = 4
+        segments = self.read('* 1 FETCH (RFC822 {12}\r\n'
+                             'abcd\r\nefgh\r\n)\r\n')
+        self.assertEqual(len(segments), 3)
+        spool = segments[1]
+        spool.seek(0)
+        self.assertEqual(spool.read(),
+                         'abcd' + os.linesep + 'efgh' + os.linesep)
+        self.assertEqual(segments[2], ')')
+
+    def test_parse(self):
+        self.assertEqual(self.retriever._parseresponse(
+            ['* 3 FETCH (FLAGS (\\Seen) BODY[HEADER.FIELDS (FROM)] NIL '
+             'X "a \\"quoted\\" \\\\ string")']
+        ), [
+            '*', '3', 'FETCH', ['FLAGS', ['\\Seen'],
+                                'BODY[HEADER.FIELDS (FROM)]', None,
+                                'X', 'a "quoted" \\ string'],
+        ])
+
+    def test_parse_unbalanced(self):
+        self.assertRaises(getmailOperationError,
+                          self.retriever._parseresponse, ['* 1 FETCH (UID 1'])
+        self.assertRaises(getmailOperationError,
+                          self.retriever._parseresponse, ['* 1 FETCH UID 1)'])
+
+#######################################
+class UIDSetTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = imap_retriever(self.dir)
+
+    def tearDown(self):
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def test_uidset(self):
+        uidset = self.retriever._uidset
+        self.assertEqual(uidset(['5']), '5')
+        self.assertEqual(uidset(['3', '4', '5', '6', '9']), '3:6,9')
+        self.assertEqual(uidset(['9', '10', '1', '3', '2']), '1:3,9:10')
+        self.assertEqual(uidset(['1', '3', '5']), '1,3,5')
+
+#######################################
+class BodyPlanTest(unittest.TestCase):
+    '''_bodyplan(), _planitems() and _assemble() for a multipart/mixed
+    message with a text part and a JPEG part, keeping only the JPEG.'''
+    structure = [
+        ['TEXT', 'PLAIN', ['CHARSET', 'us-ascii'], None, None, '7BIT', '6',
+         '1'],
+        ['IMAGE', 'JPEG', ['NAME', 'a.jpg'], None, None, 'BASE64', '1000'],
+        'MIXED', ['BOUNDARY', 'xyz'], None, None
+    ]
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = imap_retriever(
+            self.dir, fetch_content_types="('image/*', )"
+        )
+
+    def tearDown(self):
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def test_plan(self):
+        plan = self.retriever._bodyplan(self.structure)
+        self.assertEqual(plan, ('multipart', '', 'xyz', [
+            ('part', '1', 'text/plain', 6, False, '7bit'),
+            ('part', '2', 'image/jpeg', 1000, True, 'base64'),
+        ]))
+        items = []
+        self.assertEqual(self.retriever._planitems(plan, items), 1)
+        self.assertEqual(items, ['BODY.PEEK[2.MIME]', 'BODY.PEEK[2]'])
+        items = []
+        self.retriever._planitems(plan, items, binary=True)
+        self.assertEqual(items, ['BODY.PEEK[2.MIME]', 'BINARY.PEEK[2]'])
+
+    def test_no_boundary(self):
+        structure = self.structure[:3] + [['CHARSET', 'x']]
+        self.assertEqual(self.retriever._bodyplan(structure), None)
+
+    def test_assemble(self):
+        jpeg = ''.join([chr(i % 256) for i in range(1000)])
+        pieces = ['Content-Type: multipart/mixed; boundary="xyz"' + os.linesep
+                  + os.linesep]
+        self.retriever._assemble(self.retriever._bodyplan(self.structure), {
+            'BODY[2.MIME]' : ('Content-Type: image/jpeg' + os.linesep
+                              + 'Content-Transfer-Encoding: base64'
+                              + os.linesep + os.linesep),
+            'BINARY[2]' : jpeg,
+        }, pieces)
+        msg = email.message_from_string(''.join(pieces))
+        parts = msg.get_payload()
+        self.assertEqual(len(parts), 2)
+        self.assertEqual(parts[0]['x-getmail-omitted-part'],
+                         'text/plain; 6 octets')
+        self.assertEqual(parts[1].get_content_type(), 'image/jpeg')
+        self.assertEqual(parts[1].get_payload(decode=True), jpeg)
+
+    def test_assemble_missing_part(self):
+        self.assertRaises(getmailRetrievalError, self.retriever._assemble,
+                          self.retriever._bodyplan(self.structure), {}, [])
+
+#######################################
+class FetchConnection(FakeConnection):
+    '''A FakeConnection which also takes commands, keeping them.'''
+    capabilities = ('IMAP4REV1', 'BINARY')
+
+    def __init__(self, data):
+        FakeConnection.__init__(self, data)
+        self.commands = []
+        self.tagged_commands = {}
+
+    def _command(self, *args):
+        self.commands.append(' '.join(args))
+        tag = 'A%d' % len(self.commands)
+        self.tagged_commands[tag] = None
+        return tag
+
+#######################################
+class PartsFetchTest(unittest.TestCase):
+    '''_getmsgbyid() with fetch_content_types, for two plain text messages
+    which are retrieved whole.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = r = imap_retriever(
+            self.dir, fetch_content_types="('image/*', )",
+            fetch_batch_size=100000
+        )
+        r.app_options = {}
+        r.mailbox = 'INBOX'
+        r.uidvalidity = '1'
+        r._mboxuids = {}
+        r._mboxuidorder = []
+        for uid in ('1', '2'):
+            msgid = '1/INBOX/%s' % uid
+            r._mboxuids[msgid] = ('INBOX', uid)
+            r._mboxuidorder.append(msgid)
+            r.msgnum_by_msgid[msgid] = None
+            r.msgsizes[msgid] = 500
+        r.conn = FetchConnection(
+            '* 1 FETCH (UID 1 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL '
+            '"7BIT" 5 1))\r\n'
+            '* 2 FETCH (UID 2 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL '
+            '"7BIT" 5 1))\r\n'
+            'A1 OK done\r\n'
+            '* 1 FETCH (UID 1 RFC822 {10}\r\nA: 1\r\n\r\nab)\r\n'
+            '* 2 FETCH (UID 2 RFC822 {10}\r\nA: 2\r\n\r\ncd)\r\n'
+            'A2 OK done\r\n'
+        )
+
+    def tearDown(self):
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def test_fetches(self):
+        r = self.retriever
+        self.assertEqual(r._getmsgbyid('1/INBOX/1').content().get_payload(),
+                         'ab')
+        self.assertEqual(r._getmsgbyid('1/INBOX/2').content().get_payload(),
+                         'cd')
+        # One BODYSTRUCTURE fetch, and the messages retrieved whole are
+        # batched
+        self.assertEqual(r.conn.commands, [
+            'UID FETCH 1:2 (UID BODYSTRUCTURE)',
+            'UID FETCH 1:2 (UID RFC822)',
+        ])
+
+#######################################
+class BinaryFetchTest(unittest.TestCase):
+    '''_getmsgbyid() with use_binary, for a single-part base64 message
+    followed by two plain text ones.'''
+    jpeg = ''.join([chr(i % 256) for i in range(300)])
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = r = imap_retriever(self.dir, use_binary=True,
+                                            fetch_batch_size=100000)
+        r.app_options = {}
+        r.mailbox = 'INBOX'
+        r.uidvalidity = '1'
+        r._mboxuids = {}
+        r._mboxuidorder = []
+        for uid in ('1', '2', '3'):
+            msgid = '1/INBOX/%s' % uid
+            r._mboxuids[msgid] = ('INBOX', uid)
+            r._mboxuidorder.append(msgid)
+            r.msgnum_by_msgid[msgid] = None
+            r.msgsizes[msgid] = 500
+        header = ('Content-Type: image/jpeg\r\n'
+                  'Content-Transfer-Encoding: base64\r\n\r\n')
+        r.conn = FetchConnection(
+            '* 1 FETCH (UID 1 BODYSTRUCTURE ("IMAGE" "JPEG" NIL NIL NIL '
+            '"BASE64" 406))\r\n'
+            '* 2 FETCH (UID 2 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL '
+            '"7BIT" 5 1))\r\n'
+            '* 3 FETCH (UID 3 BODYSTRUCTURE ("TEXT" "PLAIN" NIL NIL NIL '
+            '"7BIT" 5 1))\r\n'
+            'A1 OK done\r\n'
+            '* 1 FETCH (UID 1 BODY[HEADER] {%d}\r\n%s BINARY[1] ~{%d}\r\n'
+            '%s)\r\nA2 OK done\r\n'
+            '* 2 FETCH (UID 2 RFC822 {10}\r\nA: 2\r\n\r\nab)\r\n'
+            '* 3 FETCH (UID 3 RFC822 {10}\r\nA: 3\r\n\r\ncd)\r\n'
+            'A3 OK done\r\n'
+            % (len(header), header, len(self.jpeg), self.jpeg)
+        )
+
+    def tearDown(self):
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def test_fetches(self):
+        r = self.retriever
+        msg = email.message_from_string(r._getmsgbyid('1/INBOX/1').content()
+                                        .as_string())
+        self.assertEqual(msg.get_payload(decode=True), self.jpeg)
+        self.assertEqual(r._getmsgbyid('1/INBOX/2').content().get_payload(),
+                         'ab')
+        self.assertEqual(r._getmsgbyid('1/INBOX/3').content().get_payload(),
+                         'cd')
+        # The base64 body is fetched decoded, and the messages retrieved
+        # whole are batched
+        self.assertEqual(r.conn.commands, [
+            'UID FETCH 1:3 (UID BODYSTRUCTURE)',
+            'UID FETCH 1 (UID BODY.PEEK[HEADER] BINARY.PEEK[1])',
+            'UID FETCH 2:3 (UID RFC822)',
+        ])
+
+#######################################
+class HeadersTest(unittest.TestCase):
+    '''getheaders() over IMAP, keeping only some headers.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fetch_uids = _retrieverbases.SEARCH_FETCH_UIDS
+        _retrieverbases.SEARCH_FETCH_UIDS = 2
+        self.retriever = r = imap_retriever(self.dir)
+        r._RetrieverSkeleton__initialized = True
+        r.app_options = {}
+        r.mailbox = 'INBOX'
+        r.uidvalidity = '1'
+        r._mboxuids = {}
+        for uid in ('1', '2', '3'):
+            msgid = '1/INBOX/%s' % uid
+            r._mboxuids[msgid] = ('INBOX', uid)
+            r.msgnum_by_msgid[msgid] = None
+        r.conn = FetchConnection(
+            '* 1 FETCH (UID 1 BODY[HEADER] {8}\r\nA: 1\r\n\r\n)\r\n'
+            '* 2 FETCH (UID 2 BODY[HEADER] {8}\r\nA: 2\r\n\r\n)\r\n'
+            'A1 OK done\r\n'
+            '* 3 FETCH (UID 3 BODY[HEADER] {8}\r\nA: 3\r\n\r\n)\r\n'
+            'A2 OK done\r\n'
+        )
+
+    def tearDown(self):
+        _retrieverbases.SEARCH_FETCH_UIDS = self.fetch_uids
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def test_keep(self):
+        r = self.retriever
+        seen = []
+        def keep(msgid, header):
+            seen.append((msgid, header.get_all('a')[0]))
+            return msgid == '1/INBOX/2'
+        headers = r.getheaders(['1/INBOX/1', '1/INBOX/2', '1/INBOX/3'], keep)
+        self.assertEqual(seen, [('1/INBOX/1', '1'), ('1/INBOX/2', '2'),
+                                ('1/INBOX/3', '3')])
+        self.assertEqual(headers.keys(), ['1/INBOX/2'])
+        self.assertEqual(r.headercache.keys(), ['1/INBOX/2'])
+        self.assertEqual(r.conn.commands, [
+            'UID FETCH 1:2 (UID BODY.PEEK[HEADER])',
+            'UID FETCH 3 (UID BODY.PEEK[HEADER])',
+        ])
+
+#######################################
+class BackfillConnection(FetchConnection):
+    '''An extra connection for IMAPBackfill, answering each UID FETCH with
+    message "A: uid" for every UID asked for, or NO for the sets in fail.'''
+    def __init__(self, uidvalidity='1', fail=()):
+        FetchConnection.__init__(self, '')
+        self.uidvalidity = uidvalidity
+        self.fail = fail
+        self.selected = None
+        self.loggedout = False
+
+    def select(self, mailbox, readonly):
+        self.selected = (mailbox, readonly)
+        return ('OK', ['60'])
+
+    def response(self, code):
+        return (code, [self.uidvalidity])
+
+    def logout(self):
+        self.loggedout = True
+
+    def _command(self, *args):
+        tag = FetchConnection._command(self, *args)
+        uidset = args[2]
+        if uidset in self.fail:
+            self.data += '%s NO failed\r\n' % tag
+            return tag
+        for part in uidset.split(','):
+            (first, last) = (part.split(':') * 2)[:2]
+            for uid in range(int(first), int(last) + 1):
+                msg = 'A: %d\r\n\r\n' % uid
+                self.data += ('* %d FETCH (UID %d RFC822 {%d}\r\n%s)\r\n'
+                              % (uid, uid, len(msg), msg))
+        self.data += '%s OK done\r\n' % tag
+        return tag
+
+#######################################
+class BackfillTest(unittest.TestCase):
+    '''IMAPBackfill over fake connections, for 60 messages in chunks of
+    25.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.retriever = r = imap_retriever(self.dir)
+        r.app_options = {}
+        r.uidvalidity = '1'
+        r._mboxuids = {}
+        self.msgids = []
+        for uid in range(1, 61):
+            msgid = '1/INBOX/%d' % uid
+            r._mboxuids[msgid] = ('INBOX', str(uid))
+            self.msgids.append(msgid)
+        self.backfill = None
+
+    def tearDown(self):
+        if self.backfill is not None:
+            self.backfill.stop()
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.WARNING)
+        del self.retriever
+        shutil.rmtree(self.dir)
+
+    def start(self, conns, msgids=None):
+        self.backfill = _retrieverbases.IMAPBackfill(
+            self.retriever, 'INBOX', msgids or self.msgids, conns
+        )
+        return self.backfill
+
+    def get(self, uid):
+        data = self.backfill.get('1/INBOX/%d' % uid)
+        if data is not None:
+            data = email.message_from_string(data).get('a')
+        return data
+
+    def quiet(self):
+        # Losing a connection is expected; don't warn about it
+        log.clearhandlers()
+        log.addhandler(sys.stderr, logging.ERROR)
+
+    def commands(self, conns):
+        commands = []
+        for conn in conns:
+            commands.extend(conn.commands)
+        commands.sort()
+        return commands
+
+    def test_get(self):
+        conns = [BackfillConnection(), BackfillConnection()]
+        self.start(conns)
+        for uid in range(1, 61):
+            self.assertEqual(self.get(uid), str(uid))
+        self.backfill.stop()
+        # Each chunk fetched once, from the mailbox EXAMINEd read-only
+        self.assertEqual(self.commands(conns), [
+            'UID FETCH 1:25 (UID RFC822)',
+            'UID FETCH 26:50 (UID RFC822)',
+            'UID FETCH 51:60 (UID RFC822)',
+        ])
+        for conn in conns:
+            self.assertEqual(conn.selected, ('INBOX', True))
+            self.failUnless(conn.loggedout)
+
+    def test_skipped(self):
+        self.start([BackfillConnection()])
+        self.assertEqual(self.get(30), '30')
+        # Passed over, so thrown away
+        self.assertEqual(self.get(5), None)
+        self.assertEqual(self.backfill.get('1/INBOX/99'), None)
+        self.assertEqual(self.get(31), '31')
+        self.backfill.stop()
+        self.assertEqual(self.backfill.fetched, {})
+
+    def test_failed_chunk(self):
+        self.quiet()
+        conns = [BackfillConnection(fail=('26:50', )),
+                 BackfillConnection(fail=('26:50', ))]
+        self.start(conns)
+        self.assertEqual(self.get(1), '1')
+        # Not retried; its messages are left to the main connection
+        for uid in range(26, 51):
+            self.assertEqual(self.get(uid), None)
+        self.assertEqual(self.get(51), '51')
+        self.assertEqual(self.commands(conns).count(
+            'UID FETCH 26:50 (UID RFC822)'), 1)
+
+    def test_uidvalidity_changed(self):
+        self.quiet()
+        conns = [BackfillConnection(uidvalidity='2')]
+        self.start(conns)
+        for uid in range(1, 61):
+            self.assertEqual(self.get(uid), None)
+        self.assertEqual(conns[0].commands, [])
+        self.failUnless(conns[0].loggedout)
+
+    def test_bounded(self):
+        # Two chunks per connection are held at most
+        for uid in range(61, 201):
+            msgid = '1/INBOX/%d' % uid
+            self.retriever._mboxuids[msgid] = ('INBOX', str(uid))
+            self.msgids.append(msgid)
+        conn = BackfillConnection()
+        self.start([conn])
+        time.sleep(0.3)
+        self.assertEqual(len(conn.commands), 2)
+        self.assertEqual(self.get(1), '1')
+        time.sleep(0.3)
+        self.assertEqual(len(conn.commands), 3)
+        self.backfill.stop()
+        self.assertEqual(len(conn.commands), 3)
+        self.assertEqual(self.backfill.fetched, {})
+
+#######################################
+class JournalTest(unittest.TestCase):
+    '''Reading and saving the oldmail state of INBOX through the journal.'''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.oldmail = os.path.join(self.dir, 'oldmail-INBOX')
+        self.journal = self.oldmail + '.journal'
+        self.compact_records = _retrieverbases.JOURNAL_COMPACT_RECORDS
+        self.retrievers = []
+
+    def tearDown(self):
+        _retrieverbases.JOURNAL_COMPACT_RECORDS = self.compact_records
+        for r in self.retrievers:
+            if r._compactor is not None:
+                r._compactor.join()
+        del self.retrievers
+        shutil.rmtree(self.dir)
+
+    def retriever(self):
+        '''Return a retriever which has read the oldmail state.'''
+        r = imap_retriever(self.dir)
+        r.oldmail_filename = os.path.join(self.dir, 'oldmail')
+        r._read_oldmailfile()
+        r._RetrieverSkeleton__initialized = True
+        r.gotmsglist = True
+        self.retrievers.append(r)
+        return r
+
+    def write(self, filename, data):
+        f = open(filename, 'wb')
+        f.write(data)
+        f.close()
+
+    def test_replay(self):
+        self.write(self.oldmail, '1/INBOX/1\x00100\n1/INBOX/2\x00100\n')
+        self.write(self.journal, '+1/INBOX/3\x00300\n-1/INBOX/1\n'
+                                 'garbage\n+1/INBOX/4\x00')
+        # The last record is incomplete, as after a crash
+        self.assertEqual(self.retriever().oldmail,
+                         {'1/INBOX/2' : 100, '1/INBOX/3' : 300})
+
+    def test_delivered_survives_crash(self):
+        self.write(self.oldmail, '')
+        r = self.retriever()
+        r.delivered('1/INBOX/5')
+        # Not saved with write_oldmailfile()
+        self.failUnless('1/INBOX/5' in self.retriever().oldmail)
+
+    def test_deleted_forgotten(self):
+        self.write(self.oldmail, '1/INBOX/1\x00100\n')
+        r = self.retriever()
+        r.deleted['1/INBOX/1'] = True
+        r.write_oldmailfile()
+        self.assertEqual(self.retriever().oldmail, {})
+
+    def test_compaction(self):
+        _retrieverbases.JOURNAL_COMPACT_RECORDS = 3
+        self.write(self.oldmail, '1/INBOX/1\x00100\n')
+        r = self.retriever()
+        for uid in range(2, 6):
+            r.delivered('1/INBOX/%d' % uid)
+        r.write_oldmailfile()
+        r._compactor.join()
+        self.failIf(os.path.exists(self.journal + '.old'))
+        lines = open(self.oldmail, 'rb').read().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(len(self.retriever().oldmail), 5)
+
+    def test_interrupted_compaction(self):
+        # A compaction renamed the journal aside and a new one was started,
+        # but the oldmail file was not written
+        self.write(self.oldmail, '')
+        self.write(self.journal + '.old', '+1/INBOX/1\x00100\n')
+        self.write(self.journal, '-1/INBOX/1\n+1/INBOX/2\x00200\n')
+        self.assertEqual(self.retriever().oldmail, {'1/INBOX/2' : 200})
+
+    def test_compaction_finished_before_exit(self):
+        # As a --parallel or mailbox_connections session leaves
+        _retrieverbases.JOURNAL_COMPACT_RECORDS = 3
+        self.write(self.oldmail, '')
+        childpid = os.fork()
+        if not childpid:
+            exitcode = 1
+            try:
+                r = self.retriever()
+                write = r._writeoldmailfiles
+                def slow_write(*args):
+                    time.sleep(0.5)
+                    write(*args)
+                r._writeoldmailfiles = slow_write
+                for uid in range(1, 5):
+                    r.delivered('1/INBOX/%d' % uid)
+                r.quit()
+                exitcode = 0
+            finally:
+                os._exit(exitcode)
+        (unused, status) = os.waitpid(childpid, 0)
+        self.assertEqual(status, 0)
+        self.failIf(os.path.exists(self.journal + '.old'))
+        lines = open(self.oldmail, 'rb').read().splitlines()
+        self.assertEqual(len(lines), 4)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python2.3
+'''Tests for the header and size rules of getmailcore.filters.'''
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from getmailcore.exceptions import getmailConfigurationError, \
+    getmailFilterError
+from getmailcore.message import Message
+from getmailcore.filters import RuleSet, Filter_python
+
+MULTIPART = '''From: Someone <someone@example.org>
+To: user@example.com
+Subject: photos
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="b"
+
+--b
+Content-Type: text/plain
+
+see attached
+--b
+Content-Type: image/jpeg
+Content-Transfer-Encoding: base64
+
+/9j/4AAQ
+--b--
+'''
+
+#######################################
+class RuleSetTest(unittest.TestCase):
+    def msg(self, text=MULTIPART, sender='someone@example.org'):
+        msg = Message(fromstring=text.replace('\n', os.linesep))
+        msg.sender = sender
+        msg.recipient = 'user@example.com'
+        return msg
+
+    def test_first_matching_rule_wins(self):
+        rules = RuleSet('''(('keep', 'header', 'subject', '^photos$'),
+                            ('drop', 'sender', 'example'))''')
+        self.assertEqual(rules.match(self.msg())[0], 'keep')
+        self.assertEqual(len(rules), 2)
+
+    def test_no_match(self):
+        rules = RuleSet('''(('drop', 'recipient', '^other@'), )''')
+        self.assertEqual(rules.match(self.msg()), None)
+
+    def test_negation_and_content_type(self):
+        rules = RuleSet('''(('drop', '!content_type', '^image/png$'), )''')
+        self.failUnless(rules.match(self.msg()))
+        rules = RuleSet('''(('drop', '!content_type', '^image/jpeg$'), )''')
+        self.assertEqual(rules.match(self.msg()), None)
+
+    def test_size(self):
+        rules = RuleSet('''(('drop', 'size', '>', '100000'), )''')
+        self.assertEqual(rules.match(self.msg()), None)
+        self.failUnless(rules.match(self.msg(), 200000))
+
+    def test_actions_used(self):
+        rules = RuleSet('''(('skip', 'size', '>=', '10'), )''',
+                        ('keep', 'drop', 'skip'))
+        self.failUnless(rules.actions_used('skip'))
+        self.failIf(rules.actions_used('drop'))
+
+    def test_invalid_rules(self):
+        for rules in ('not a tuple', '(("drop", "header", "x"), )',
+                      '(("bounce", "sender", "x"), )',
+                      '(("drop", "size", "~", "1"), )',
+                      '(("drop", "sender", "("), )', '("drop", )'):
+            self.assertRaises(getmailConfigurationError, RuleSet, rules)
+
+    def test_headeronly_refuses_body_tests(self):
+        self.assertRaises(getmailConfigurationError, RuleSet,
+                          '''(('drop', '!content_type', '^image/'), )''',
+                          headeronly=True)
+        rules = RuleSet('''(('drop', 'header', 'subject', 'photos'), )''',
+                        headeronly=True)
+        self.failUnless(rules.match(self.msg()))
+
+#######################################
+class FakeRetriever(object):
+    received_from = 'imap.example.org'
+    received_with = 'IMAP4'
+    received_by = 'localhost'
+
+#######################################
+class PythonFilterTest(unittest.TestCase):
+    def filter(self, function):
+        f = Filter_python(callable=None)
+        f.function = function
+        f.conf['callable'] = 'filters.test'
+        msg = Message(fromstring=MULTIPART.replace('\n', os.linesep))
+        return f.filter_message(msg, FakeRetriever())
+
+    def test_exit_code(self):
+        self.failUnless(isinstance(self.filter(lambda msg: 0), Message))
+        self.assertEqual(self.filter(lambda msg: 99), None)
+
+    def test_new_message(self):
+        newmsg = Message(fromstring=MULTIPART.replace('photos', 'new')
+                         .replace('\n', os.linesep))
+        self.assertEqual(self.filter(lambda msg: (0, newmsg)), newmsg)
+
+    def test_bad_result(self):
+        for result in (None, '0', (0, 'not a message'), (0, )):
+            self.assertRaises(getmailFilterError, self.filter,
+                              lambda msg: result)
+
+#######################################
+if __name__ == '__main__':
+    unittest.main()